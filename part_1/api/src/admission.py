@@ -0,0 +1,85 @@
+import time
+import logging
+import threading
+
+logger = logging.getLogger('challenge_part_1')
+
+
+class AdmissionController:
+    '''
+    Rejects new products while the queue of the worker is too deep or has too few consumers.
+    The queue is sampled at most once per sample_interval seconds.
+    '''
+    def __init__(self, sampler, max_depth=0, min_consumers=0, sample_interval=1.0, retry_after=30):
+        self.sampler = sampler
+        self.max_depth = max_depth
+        self.min_consumers = min_consumers
+        self.sample_interval = sample_interval
+        self.retry_after = retry_after
+        self.sample = None
+        self._sampled_at = None
+        self._lock = threading.Lock()
+
+    def check(self):
+        '''
+        Return None when a product can be accepted, otherwise the HTTP status to answer with
+        '''
+        if self._is_stale() and self._lock.acquire(blocking=False):
+            # Only one thread refreshes the sample, the others use the previous one
+            try:
+                try:
+                    self._update(self.sampler())
+                except Exception as exc:
+                    self._update(None, exc)
+            finally:
+                self._lock.release()
+        return self._evaluate()
+
+    def _is_stale(self):
+        return self._sampled_at is None or time.monotonic() - self._sampled_at >= self.sample_interval
+
+    def _update(self, sample, error=None):
+        if error is not None:
+            # Fail open: the broker itself refuses messages when it is down
+            logger.error(f'Queue sampling error: {error}')
+        self.sample = sample
+        self._sampled_at = time.monotonic()
+
+    def _evaluate(self):
+        if self.sample is None:
+            return None
+        depth, consumers = self.sample
+        if self.min_consumers and consumers < self.min_consumers:
+            return 503
+        if self.max_depth and depth >= self.max_depth:
+            return 429
+        return None
+
+
+class AsyncAdmissionController(AdmissionController):
+    '''
+    AdmissionController with a coroutine sampler
+    '''
+    async def check(self):
+        if self._is_stale() and self._lock.acquire(blocking=False):
+            try:
+                try:
+                    self._update(await self.sampler())
+                except Exception as exc:
+                    self._update(None, exc)
+            finally:
+                self._lock.release()
+        return self._evaluate()
+
+
+def celery_queue_sampler(celery, queue):
+    '''
+    Sampler returning (message count, consumer count) of a queue through a passive declare
+    '''
+    def sample():
+        with celery.connection_or_acquire() as connection:
+            # A failed passive declare closes the channel, so it gets its own
+            with connection.channel() as channel:
+                result = channel.queue_declare(queue=queue, passive=True)
+                return result.message_count, result.consumer_count
+    return sample
@@ -0,0 +1,311 @@
+import os
+import json
+import asyncio
+import hashlib
+import logging
+import tempfile
+import src.cache as dedup
+import src.admission as admission
+import src.encoding as encodings
+import src.storage as storage
+import src.metrics as metrics
+import src.publisher as publishers
+import src.fingerprint as fingerprints
+from collections import Counter
+
+# Asyncio counterpart of src.routes: same route, same responses,
+# with async cache and broker clients (run with: uvicorn src.asgi:app)
+
+# Load parameters
+queue = os.environ.get('BROKER_QUEUE')
+task = os.environ.get('CELERY_TASK')
+cache_time = int(os.environ.get('CACHE_TIME', 600))
+stream_ingest = os.environ.get('STREAM_INGEST') == 'True'
+stream_chunk_size = int(os.environ.get('STREAM_CHUNK_SIZE', fingerprints.DEFAULT_CHUNK_SIZE))
+spool_max_size = int(os.environ.get('SPOOL_MAX_SIZE', 4 * 1024 * 1024))
+# Largest decoded content of a compressed body (0 for no limit), larger ones get a 413
+max_decoded_size = int(os.environ.get('MAX_DECODED_SIZE', 64 * 1024 * 1024)) or None
+near_cache_size = int(os.environ.get('NEAR_CACHE_SIZE', 0))
+cache_endpoints = os.environ.get('CACHE_ENDPOINTS') or os.environ.get('CACHE_ENDPOINT')
+cache_vnodes = int(os.environ.get('CACHE_VNODES', 160))
+cache_max_connections = int(os.environ.get('CACHE_MAX_CONNECTIONS', 50))
+broker_compression = os.environ.get('BROKER_COMPRESSION') or None
+queue_max_depth = int(os.environ.get('QUEUE_MAX_DEPTH', 0))
+queue_min_consumers = int(os.environ.get('QUEUE_MIN_CONSUMERS', 0))
+queue_sample_interval = float(os.environ.get('QUEUE_SAMPLE_INTERVAL', 1.0))
+retry_after = int(os.environ.get('RETRY_AFTER', 30))
+
+# Same logger name as the flask app
+logger = logging.getLogger('challenge_part_1')
+
+# Load Cache (one shard per endpoint) and broker publisher
+cache = dedup.AsyncShardedDedupCache(
+    [endpoint.strip() for endpoint in cache_endpoints.split(',') if endpoint.strip()],
+    vnodes=cache_vnodes,
+    max_connections=cache_max_connections
+)
+publisher = publishers.AsyncCeleryPublisher(os.environ.get('BROKER_ENDPOINT'), broker_compression)
+
+# Payload store for claim-check publishing (only used in stream mode)
+store = storage.from_url(os.environ['PAYLOAD_STORE']) if os.environ.get('PAYLOAD_STORE') else None
+
+# Optional load shedding based on the depth and consumers of the worker queue
+admission_controller = None
+if queue_max_depth > 0 or queue_min_consumers > 0:
+    admission_controller = admission.AsyncAdmissionController(
+        lambda: publisher.queue_stats(queue),
+        max_depth=queue_max_depth,
+        min_consumers=queue_min_consumers,
+        sample_interval=queue_sample_interval,
+        retry_after=retry_after
+    )
+
+# Optional per-process cache of recently seen fingerprints
+near_cache = dedup.NearCache(near_cache_size) if near_cache_size > 0 else None
+
+# Hit/miss counters of both cache tiers
+stats = Counter()
+
+# Methods of each route, as declared in src.routes
+ROUTES = {
+    '/v1/products': ('POST',),
+    '/v1/cache/stats': ('GET',),
+    '/metrics': ('GET',),
+}
+
+
+class BodyReader:
+    '''
+    Async file-like view of the body of an ASGI request
+    '''
+    def __init__(self, receive):
+        self.receive = receive
+        self._buffer = b''
+        self._more_body = True
+
+    async def read(self, size=-1):
+        while self._more_body and (size < 0 or len(self._buffer) < size):
+            message = await self.receive()
+            if message['type'] == 'http.disconnect':
+                raise ConnectionError('Client disconnected')
+            self._buffer += message.get('body', b'')
+            self._more_body = message.get('more_body', False)
+        if size < 0:
+            chunk, self._buffer = self._buffer, b''
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+
+    # Same routes as src.routes: exact paths (no trailing slash), 405 for another method
+    path = scope['path']
+    methods = ROUTES.get(path)
+    if methods is None:
+        await respond(send, 404, {'msg': 'Not found'})
+    elif scope['method'] not in methods:
+        await respond(send, 405, {'msg': 'Method not allowed'})
+    elif path == '/v1/cache/stats':
+        await respond(send, 200, cache_stats())
+    elif path == '/metrics':
+        if not metrics.enabled:
+            await respond(send, 404, {'msg': 'Not found'})
+            return
+        content, content_type = metrics.exposition()
+        await respond_raw(send, 200, content, content_type.encode('latin-1'))
+    else:
+        headers = dict(scope.get('headers', []))
+        status, body = await receive_product(receive, headers.get(b'content-encoding', b'').decode('latin-1'),
+                                             headers.get(b'content-type', b'').decode('latin-1'))
+        extra_headers = []
+        metrics.count_response(status)
+        if status in (429, 503):
+            extra_headers.append((b'retry-after', str(retry_after).encode('ascii')))
+        await respond(send, status, body, extra_headers)
+
+
+async def receive_product(receive, content_encoding=None, content_type=None):
+    # Check if the worker queue can take another product
+    # Nothing was read or claimed yet, so the client can simply retry later
+    if admission_controller is not None:
+        with metrics.stage('admission'):
+            status = await admission_controller.check()
+        if status is not None:
+            logger.info(f'Product rejected by admission control: {status}')
+            return too_many_requests_response() if status == 429 else service_unavailable_response()
+
+    # Check if the body is compressed with a supported encoding
+    try:
+        decoder = encodings.get_decoder(content_encoding)
+    except encodings.UnsupportedEncoding as exc:
+        logger.error(f'Payload error: {exc}')
+        return unsupported_media_type_response()
+
+    # Check if payload is in a correct json format
+    # And if a fingerprint can be computed from it (over the decoded content),
+    # with the fingerprint of the flask app in the same mode (both share the cache)
+    spool = open_spool() if stream_ingest else None
+    try:
+        started = metrics.now()
+        timed = metrics.timed_reader(BodyReader(receive), metrics.AsyncTimedReader)
+        # Plain bodies are not limited, as in the flask app
+        identity = isinstance(decoder, encodings.IdentityDecoder)
+        body = encodings.AsyncDecodingReader(timed, decoder, stream_chunk_size, spool,
+                                             None if identity else max_decoded_size)
+        if stream_ingest:
+            fingerprint = await fingerprints.canonical_fingerprint_async(body, stream_chunk_size)
+            metrics.observe_read(timed, started)
+        else:
+            data = await body.read()
+            # Like flask's request.get_json, a plain body is only json with a json content type
+            if identity and not is_json(content_type or ''):
+                payload = None
+            else:
+                payload = json.loads(data)
+            metrics.observe_read(timed, started, 'parse')
+            with metrics.stage('hash'):
+                fingerprint = hashlib.sha256(json.dumps(payload).encode('utf-8')).hexdigest()
+        metrics.observe_payload(body.bytes_read)
+    except Exception as exc:
+        logger.error(f'Payload error: {exc}')
+        if spool is not None:
+            discard_spool(spool)
+        if isinstance(exc, encodings.DecodedSizeExceeded):
+            return payload_too_large_response()
+        return bad_request_response()
+
+    # The spool is closed (and its file removed) whatever happens from here on,
+    # also when the cache or the broker fail
+    try:
+        # Check if the fingerprint was recently seen by this process
+        if near_cache is not None:
+            if fingerprint in near_cache:
+                stats['near_cache_hits'] += 1
+                metrics.count_cache('near', 'hit')
+                logger.info(f'Near cache hit for fingerprint: {fingerprint}')
+                return forbidden_response()
+            stats['near_cache_misses'] += 1
+            metrics.count_cache('near', 'miss')
+
+        # Store the fingerprint unless it is already stored (single atomic operation)
+        with metrics.stage('cache'):
+            remaining_ttl = await cache.claim(fingerprint, cache_time)
+        if remaining_ttl is not None:
+            stats['cache_hits'] += 1
+            metrics.count_cache('shared', 'hit')
+            logger.info(f'Cache hit for fingerprint: {fingerprint}')
+            if near_cache is not None:
+                near_cache.add(fingerprint, remaining_ttl / 1000)
+            return forbidden_response()
+
+        stats['cache_misses'] += 1
+        metrics.count_cache('shared', 'miss')
+        logger.info(f'Cache miss for fingerprint: {fingerprint}')
+        if near_cache is not None:
+            near_cache.add(fingerprint, cache_time)
+        loop = asyncio.get_event_loop()
+        if spool is not None and store is not None:
+            # Claim-check: the body stays in the store, only a reference is published
+            # (the commit syncs the file to disk, so it runs out of the event loop)
+            with metrics.stage('store'):
+                reference = await loop.run_in_executor(None, store.commit, spool, fingerprint)
+            with metrics.stage('publish'):
+                try:
+                    await publisher.send_task(task, kwargs={'reference': reference}, queue=queue)
+                except Exception:
+                    # No task will ever read the stored body
+                    store.delete(reference['key'])
+                    raise
+        else:
+            if spool is not None:
+                # Large bodies were spooled to disk
+                payload = await loop.run_in_executor(None, load_spool, spool)
+            with metrics.stage('publish'):
+                await publisher.send_task(task, args=[payload], queue=queue)
+        return 200, {'msg': f'Product successfully received'}
+    finally:
+        if spool is not None:
+            discard_spool(spool)
+
+
+def cache_stats():
+    return {
+        'near_cache_hits': stats['near_cache_hits'],
+        'near_cache_misses': stats['near_cache_misses'],
+        'near_cache_size': len(near_cache) if near_cache is not None else 0,
+        'cache_hits': stats['cache_hits'],
+        'cache_misses': stats['cache_misses']
+    }
+
+
+def bad_request_response():
+    return 400, {'msg': f'Invalid json format'}
+
+def payload_too_large_response():
+    return 413, {'msg': f'Decoded payload larger than {max_decoded_size} bytes'}
+
+def unsupported_media_type_response():
+    return 415, {'msg': f'Unsupported content encoding'}
+
+def too_many_requests_response():
+    return 429, {'msg': f'Too many products waiting to be processed, try again later'}
+
+def service_unavailable_response():
+    return 503, {'msg': f'Products cannot be processed right now, try again later'}
+
+def forbidden_response():
+    return 403, {'msg': f'Product already sent in the last {cache_time/60} minutes'}
+
+
+def is_json(content_type):
+    # Same check as flask's request.is_json
+    mimetype = content_type.split(';', 1)[0].strip().lower()
+    return mimetype == 'application/json' or (mimetype.startswith('application/') and mimetype.endswith('+json'))
+
+
+def open_spool():
+    # Write straight into the payload store when there is one
+    if store is not None:
+        return store.open_writer()
+    return tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+
+def load_spool(spool):
+    spool.seek(0)
+    return json.load(spool)
+
+def discard_spool(spool):
+    # Also called once the spool was committed to the store (nothing left to remove)
+    if store is not None:
+        store.discard(spool)
+    else:
+        spool.close()
+
+
+async def respond(send, status, body, extra_headers=()):
+    await respond_raw(send, status, json.dumps(body).encode('utf-8'), b'application/json', extra_headers)
+
+async def respond_raw(send, status, content, content_type, extra_headers=()):
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', content_type),
+            (b'content-length', str(len(content)).encode('ascii')),
+        ] + list(extra_headers),
+    })
+    await send({'type': 'http.response.body', 'body': content})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await publisher.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
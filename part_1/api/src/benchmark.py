@@ -0,0 +1,338 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import contextlib
+import argparse
+import platform
+import resource
+import itertools
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Benchmark mode: drives /v1/products with generated payloads over a matrix of
+# body sizes and client concurrency, against the in-memory cache and broker
+# (no redis or rabbitmq needed). Every case runs in a fresh process, so the
+# reported peak RSS belongs to that case only.
+#
+# Usage: python -m src.benchmark [--sizes 1K,1M] [--concurrency 1,64] [--duplicates 0.2]
+#                                [--save-baseline benchmark/baseline.json]
+#                                [--baseline benchmark/baseline.json]
+
+# Implementations that can be benchmarked
+MODES = ('flask', 'flask-stream', 'asgi')
+
+DEFAULT_SIZES = '1K,64K,1M,16M'
+DEFAULT_CONCURRENCY = '1,32,256'
+DEFAULT_MODES = 'flask,flask-stream,asgi'
+
+# Generated products are about this size, the last one is padded to the exact body size
+PRODUCT_SIZE = 512
+MIN_BODY_SIZE = 64
+
+# The api modules read their config when imported, nothing ever connects to these
+STANDIN_ENVIRON = {
+    'CACHE_ENDPOINT': 'redis://localhost:6379',
+    'BROKER_QUEUE': 'insert_into_database',
+    'CELERY_TASK': 'insert_into_database',
+}
+
+# Size suffixes accepted in --sizes
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# A case regresses when it gets slower (or uses more) than the baseline by more than the tolerance
+COMPARED = (
+    ('p50_ms', 1), ('p99_ms', 1), ('requests_per_second', -1),
+    ('peak_rss_mb', 1), ('redis_ops_per_request', 1),
+)
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def payload_chunks(size, seed, chunk_size=64 * 1024):
+    '''
+    Yield a json array of products of exactly size bytes, always the same for a seed
+    '''
+    if size < MIN_BODY_SIZE:
+        raise ValueError(f'Body size must be at least {MIN_BODY_SIZE} bytes')
+    buffer = bytearray(b'[')
+    written = 0
+    for index in itertools.count():
+        head = f'{"," if index else ""}{{"id": "{seed}-{index}", "price": {index % 997}.5, "name": "'
+        tail = '"}'
+        remaining = size - written - len(buffer) - 1
+        fill = PRODUCT_SIZE - len(head) - len(tail)
+        last = remaining - len(head) - len(tail) < 2 * PRODUCT_SIZE
+        if last:
+            fill = remaining - len(head) - len(tail)
+        buffer += (head + 'x' * fill + tail).encode('ascii')
+        if last:
+            buffer += b']'
+        while len(buffer) >= chunk_size or (last and buffer):
+            yield bytes(buffer[:chunk_size])
+            written += min(len(buffer), chunk_size)
+            del buffer[:chunk_size]
+        if last:
+            return
+
+
+class PayloadStream(io.RawIOBase):
+    '''
+    File-like view of a generated payload
+    '''
+    def __init__(self, size, seed, chunk_size=64 * 1024):
+        self.size = size
+        self._chunks = payload_chunks(size, seed, chunk_size)
+        self._chunk = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if not self._chunk:
+            self._chunk = next(self._chunks, b'')
+        count = min(len(buffer), len(self._chunk))
+        buffer[:count] = self._chunk[:count]
+        self._chunk = self._chunk[count:]
+        return count
+
+
+def request_seeds(requests, duplicates, rng):
+    '''
+    Seeds of the payloads to send: a duplicate reuses the seed of an earlier request
+    '''
+    seeds = []
+    for index in range(requests):
+        if seeds and rng.random() < duplicates:
+            seeds.append(rng.choice(seeds))
+        else:
+            seeds.append(index)
+    return seeds
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def run_flask(seeds, size, concurrency, stream_ingest):
+    import src.routes as routes
+    import src.standins as standins
+    from src.app import app
+    from werkzeug.test import EnvironBuilder
+
+    cache, broker = standins.MemoryDedupCache(), standins.MemoryBroker(False)
+    environ = EnvironBuilder('/v1/products', method='POST', content_type='application/json').get_environ()
+
+    def post(seed):
+        # Straight through the wsgi interface, so the body is never buffered by a test client
+        request_environ = dict(environ, CONTENT_LENGTH=str(size))
+        request_environ['wsgi.input'] = io.BufferedReader(PayloadStream(size, seed))
+        status = []
+        started = time.perf_counter()
+        response = app(request_environ, lambda code, headers, exc_info=None: status.append(code))
+        for _ in response:
+            pass
+        getattr(response, 'close', lambda: None)()
+        return time.perf_counter() - started, int(status[0].split()[0])
+
+    started = time.perf_counter()
+    with standins_for(routes, cache, broker, stream_ingest=stream_ingest):
+        with ThreadPoolExecutor(max_workers=min(concurrency, len(seeds))) as executor:
+            results = list(executor.map(post, seeds))
+    return results, time.perf_counter() - started, cache, broker
+
+
+def run_asgi(seeds, size, concurrency):
+    import src.asgi as asgi
+    import src.standins as standins
+
+    cache, broker = standins.AsyncMemoryDedupCache(), standins.AsyncMemoryBroker(False)
+    pending = iter(seeds)
+    results = []
+
+    async def post(seed):
+        chunks = payload_chunks(size, seed)
+        status = {}
+
+        async def receive():
+            chunk = next(chunks, None)
+            return {'type': 'http.request', 'body': chunk or b'', 'more_body': chunk is not None}
+
+        async def send(message):
+            if message['type'] == 'http.response.start':
+                status['code'] = message['status']
+
+        started = time.perf_counter()
+        scope = {'type': 'http', 'method': 'POST', 'path': '/v1/products',
+                 'headers': [(b'content-type', b'application/json')]}
+        await asgi.app(scope, receive, send)
+        return time.perf_counter() - started, status['code']
+
+    async def client():
+        # Each client sends its next request as soon as the previous one is answered
+        for seed in pending:
+            results.append(await post(seed))
+
+    async def clients():
+        await asyncio.gather(*[client() for _ in range(min(concurrency, len(seeds)))])
+
+    loop = asyncio.new_event_loop()
+    started = time.perf_counter()
+    try:
+        with standins_for(asgi, cache, broker, stream_ingest=True):
+            loop.run_until_complete(clients())
+    finally:
+        loop.close()
+    return results, time.perf_counter() - started, cache, broker
+
+
+@contextlib.contextmanager
+def standins_for(module, cache, broker, **settings):
+    '''
+    Replace the external services (and some settings) of an api module while the benchmark runs
+    '''
+    broker_name = 'celery' if hasattr(module, 'celery') else 'publisher'
+    replaced = dict(settings, cache=cache, store=None, admission_controller=None)
+    replaced[broker_name] = broker
+    saved = {name: getattr(module, name) for name in replaced}
+    for name, value in replaced.items():
+        setattr(module, name, value)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            setattr(module, name, value)
+
+
+def run_case(case):
+    '''
+    Run one case of the matrix and return its measurements (called in a fresh process)
+    '''
+    for name, value in STANDIN_ENVIRON.items():
+        os.environ.setdefault(name, value)
+    rng = random.Random(case['seed'])
+    seeds = request_seeds(case['requests'], case['duplicates'], rng)
+    if case['mode'] == 'asgi':
+        results, elapsed, cache, broker = run_asgi(seeds, case['size'], case['concurrency'])
+    else:
+        results, elapsed, cache, broker = run_flask(
+            seeds, case['size'], case['concurrency'], case['mode'] == 'flask-stream')
+
+    latencies = [latency for latency, _ in results]
+    statuses = Counter(str(status) for _, status in results)
+    # ru_maxrss is in kilobytes on linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    return dict(
+        case,
+        p50_ms=round(percentile(latencies, 0.5) * 1000, 3),
+        p99_ms=round(percentile(latencies, 0.99) * 1000, 3),
+        requests_per_second=round(len(results) / elapsed, 1),
+        peak_rss_mb=round(peak_rss, 1),
+        redis_ops_per_request=round(sum(cache.operations.values()) / len(results), 3),
+        published=broker.sent,
+        statuses=dict(statuses)
+    )
+
+
+def build_matrix(modes, sizes, concurrency, requests, max_bytes, duplicates, seed):
+    cases = []
+    for mode, size, clients in itertools.product(modes, sizes, concurrency):
+        # Large bodies get fewer requests (and so at most as many clients)
+        count = max(1, min(requests, max_bytes // size))
+        cases.append({'mode': mode, 'size': size, 'concurrency': clients, 'requests': count,
+                      'duplicates': duplicates, 'seed': seed})
+    return cases
+
+
+def case_key(case):
+    return case['mode'], case['size'], case['concurrency']
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    '''
+    Return a list with the measurements that regressed against the baseline
+    '''
+    expected = {case_key(case): case for case in baseline['cases']}
+    regressions = []
+    for result in results:
+        previous = expected.get(case_key(result))
+        if previous is None:
+            continue
+        for name, direction in COMPARED:
+            before, after = previous[name], result[name]
+            if direction > 0 and after > before * (1 + tolerance) and after - before > 1e-3:
+                regressions.append(f'{case_key(result)} {name}: {before} -> {after}')
+            elif direction < 0 and after < before * (1 - tolerance):
+                regressions.append(f'{case_key(result)} {name}: {before} -> {after}')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the products api with in-memory stand-ins')
+    parser.add_argument('--modes', default=DEFAULT_MODES, help=f'comma separated, from {", ".join(MODES)}')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES, help='comma separated body sizes (K, M and G suffixes)')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY, help='comma separated client counts')
+    parser.add_argument('--requests', type=int, default=200, help='requests per case')
+    parser.add_argument('--max-bytes', default='64M', help='upper bound of the bytes sent per case')
+    parser.add_argument('--duplicates', type=float, default=0.2, help='fraction of repeated payloads')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the duplicate choice')
+    parser.add_argument('--baseline', help='baseline file to compare the results with')
+    parser.add_argument('--tolerance', type=float, default=0.5, help='allowed relative regression')
+    parser.add_argument('--save-baseline', help='file to save the results to')
+    args = parser.parse_args(argv)
+
+    modes = [mode.strip() for mode in args.modes.split(',') if mode.strip()]
+    for mode in modes:
+        if mode not in MODES:
+            parser.error(f'Unknown mode: {mode}')
+    cases = build_matrix(
+        modes,
+        [parse_size(size) for size in args.sizes.split(',')],
+        [int(clients) for clients in args.concurrency.split(',')],
+        args.requests,
+        parse_size(args.max_bytes),
+        args.duplicates,
+        args.seed
+    )
+
+    results = []
+    context = multiprocessing.get_context('spawn')
+    print(f'{"mode":<13}{"size":>12}{"clients":>9}{"requests":>10}{"p50 ms":>10}{"p99 ms":>10}'
+          f'{"req/s":>10}{"rss MB":>9}{"redis/req":>11}')
+    for case in cases:
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case,))
+        results.append(result)
+        print(f'{result["mode"]:<13}{result["size"]:>12}{result["concurrency"]:>9}{result["requests"]:>10}'
+              f'{result["p50_ms"]:>10}{result["p99_ms"]:>10}{result["requests_per_second"]:>10}'
+              f'{result["peak_rss_mb"]:>9}{result["redis_ops_per_request"]:>11}')
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'cases': results}, baseline_file, indent=2)
+            baseline_file.write('\n')
+
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f'Regression: {regression}')
+        print(f'{len(results)} cases compared, {len(regressions)} regressions')
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
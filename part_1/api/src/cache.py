@@ -0,0 +1,132 @@
+import time
+import bisect
+import hashlib
+import threading
+import redis
+import redis.asyncio
+from collections import OrderedDict
+
+# Set the key only if it does not exist yet (single round trip).
+# Returns nil when the key was claimed, otherwise its remaining ttl in milliseconds.
+CLAIM_SCRIPT = '''
+if redis.call('set', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return nil
+end
+return redis.call('pttl', KEYS[1])
+'''
+
+
+class DedupCache:
+    '''
+    Fingerprint cache where checking and storing a fingerprint is one atomic operation
+    '''
+    def __init__(self, client):
+        self.client = client
+        self._claim = client.register_script(CLAIM_SCRIPT)
+
+    def claim(self, fingerprint, ttl):
+        '''
+        Store the fingerprint for ttl seconds if it is not stored yet.
+        Return None when it was claimed, otherwise the remaining ttl (ms) of the stored one.
+        '''
+        return self._claim(keys=[fingerprint], args=[bin(1), ttl])
+
+
+class AsyncDedupCache(DedupCache):
+    '''
+    DedupCache for asyncio clients
+    '''
+    async def claim(self, fingerprint, ttl):
+        return await self._claim(keys=[fingerprint], args=[bin(1), ttl])
+
+
+class HashRing:
+    '''
+    Consistent-hash ring with virtual nodes. Adding or removing a node only
+    moves the keys of the ring segments it owns (about 1/N of them).
+    '''
+    def __init__(self, nodes, vnodes=160):
+        if not nodes:
+            raise ValueError('At least one node is required')
+        self.nodes = sorted(set(nodes))
+        points = []
+        for node in self.nodes:
+            for index in range(vnodes):
+                points.append((_ring_hash(f'{node}#{index}'), node))
+        points.sort()
+        self._points = [point for point, _ in points]
+        self._owners = [node for _, node in points]
+
+    def get_node(self, key):
+        index = bisect.bisect(self._points, _ring_hash(key)) % len(self._points)
+        return self._owners[index]
+
+
+class ShardedDedupCache:
+    '''
+    Fingerprint cache spread over several cache servers through a consistent-hash ring.
+    Every api instance builds the same ring, so a fingerprint always lives in the same shard.
+    '''
+    def __init__(self, endpoints, vnodes=160, max_connections=None):
+        self.ring = HashRing(endpoints, vnodes)
+        self.shards = {}
+        for endpoint in self.ring.nodes:
+            self.shards[endpoint] = self._make_shard(endpoint, max_connections)
+
+    def _make_shard(self, endpoint, max_connections):
+        pool = redis.ConnectionPool.from_url(endpoint, max_connections=max_connections)
+        return DedupCache(redis.Redis(connection_pool=pool))
+
+    def claim(self, fingerprint, ttl):
+        return self.shards[self.ring.get_node(fingerprint)].claim(fingerprint, ttl)
+
+
+class AsyncShardedDedupCache(ShardedDedupCache):
+    '''
+    ShardedDedupCache for asyncio clients
+    '''
+    def _make_shard(self, endpoint, max_connections):
+        pool = redis.asyncio.ConnectionPool.from_url(endpoint, max_connections=max_connections)
+        return AsyncDedupCache(redis.asyncio.Redis(connection_pool=pool))
+
+    async def claim(self, fingerprint, ttl):
+        return await self.shards[self.ring.get_node(fingerprint)].claim(fingerprint, ttl)
+
+
+class NearCache:
+    '''
+    Per-process cache of recently seen fingerprints, each one kept until its
+    deadline in the shared cache so it never outlives the dedup window
+    '''
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, fingerprint):
+        with self._lock:
+            deadline = self._entries.get(fingerprint)
+            if deadline is None:
+                return False
+            if deadline <= time.monotonic():
+                del self._entries[fingerprint]
+                return False
+            self._entries.move_to_end(fingerprint)
+            return True
+
+    def add(self, fingerprint, ttl):
+        if ttl <= 0:
+            return
+        with self._lock:
+            self._entries[fingerprint] = time.monotonic() + ttl
+            self._entries.move_to_end(fingerprint)
+            # Evict the least recently seen fingerprints
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _ring_hash(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
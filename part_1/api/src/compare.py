@@ -0,0 +1,143 @@
+import sys
+import json
+import asyncio
+import argparse
+import src.asgi as asgi
+import src.routes as routes
+import src.standins as standins
+from src.app import app
+
+# Comparison mode: sends the same payloads to the flask and the asyncio
+# implementations (each one with fresh in-memory cache and broker) and
+# reports every difference in status, response body, claimed fingerprint
+# or published task. Both run in the mode set by STREAM_INGEST.
+#
+# Usage: python -m src.compare [payload.json ...]
+
+# Used when no payload file is given: valid, repeated, invalid and empty bodies
+DEFAULT_PAYLOADS = [
+    b'[{"id": "123", "name": "mesa"}]',
+    b'[{"id": "123", "name": "mesa"}]',
+    b'[{"id": "456", "name": "cadeira"}]',
+    b'[{"id": "123", "name": "mesa"',
+    b'',
+    b'{"id": "789", "tags": ["a", "b"], "price": 10.5}',
+]
+
+# Content type of the payloads, and requests sent with another one
+JSON_HEADERS = {'Content-Type': 'application/json'}
+DEFAULT_REQUESTS = [(payload, JSON_HEADERS) for payload in DEFAULT_PAYLOADS] + [
+    (b'[{"id": "321", "name": "mesa"}]', {'Content-Type': 'text/plain'}),
+    (b'[{"id": "654", "name": "mesa"}]', {'Content-Type': 'application/vnd.products+json; charset=utf-8'}),
+]
+
+
+def call_asgi(application, method, path, body=b'', chunk_size=65536, headers=None):
+    '''
+    Run one request through an ASGI application and return (status, json body)
+    '''
+    chunks = [body[index:index + chunk_size] for index in range(0, len(body), chunk_size)] or [b'']
+    headers = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+               for name, value in (headers or {}).items()]
+    scope = {'type': 'http', 'method': method, 'path': path, 'headers': headers}
+    response = {}
+
+    async def receive():
+        chunk = chunks.pop(0)
+        return {'type': 'http.request', 'body': chunk, 'more_body': bool(chunks)}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        else:
+            response['body'] = message.get('body', b'')
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(application(scope, receive, send))
+    finally:
+        loop.close()
+    return response['status'], json.loads(response['body'])
+
+
+def run_flask(requests):
+    cache, broker = standins.MemoryDedupCache(), standins.MemoryBroker()
+    backends = routes.cache, routes.celery
+    routes.cache, routes.celery = cache, broker
+    try:
+        client = app.test_client()
+        results = []
+        for payload, headers in requests:
+            result = client.post('/v1/products', data=payload, headers=headers)
+            results.append((result.status_code, result.get_json()))
+    finally:
+        routes.cache, routes.celery = backends
+    return results, list(cache.entries), broker.messages
+
+
+def run_asgi(requests):
+    cache, broker = standins.AsyncMemoryDedupCache(), standins.AsyncMemoryBroker()
+    backends = asgi.cache, asgi.publisher
+    asgi.cache, asgi.publisher = cache, broker
+    try:
+        results = [call_asgi(asgi.app, 'POST', '/v1/products', payload, headers=headers)
+                   for payload, headers in requests]
+    finally:
+        asgi.cache, asgi.publisher = backends
+    return results, list(cache.entries), broker.messages
+
+
+def published(message):
+    '''
+    Published task without the store key of its reference (unique to each accepted request)
+    '''
+    kwargs = message['kwargs']
+    if kwargs and 'reference' in kwargs:
+        reference = {name: value for name, value in kwargs['reference'].items() if name != 'key'}
+        kwargs = dict(kwargs, reference=reference)
+    return dict(message, kwargs=kwargs)
+
+
+def compare(requests):
+    '''
+    Return a list with the differences between both implementations,
+    given (body, headers) requests
+    '''
+    flask_results, flask_fingerprints, flask_messages = run_flask(requests)
+    asgi_results, asgi_fingerprints, asgi_messages = run_asgi(requests)
+    differences = []
+    for index, (expected, result) in enumerate(zip(flask_results, asgi_results)):
+        if expected != result:
+            differences.append(f'Request {index}: flask {expected} != asgi {result}')
+
+    # Both implementations share the dedup cache, so a body must get the same fingerprint
+    if flask_fingerprints != asgi_fingerprints:
+        differences.append(f'Fingerprints: flask {flask_fingerprints} != asgi {asgi_fingerprints}')
+    flask_messages = [published(message) for message in flask_messages]
+    asgi_messages = [published(message) for message in asgi_messages]
+    if flask_messages != asgi_messages:
+        differences.append(f'Published tasks: flask {flask_messages} != asgi {asgi_messages}')
+    return differences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the flask and asyncio api implementations')
+    parser.add_argument('payloads', nargs='*', help='files with request bodies')
+    args = parser.parse_args(argv)
+
+    requests = DEFAULT_REQUESTS
+    if args.payloads:
+        requests = []
+        for path in args.payloads:
+            with open(path, 'rb') as payload_file:
+                requests.append((payload_file.read(), JSON_HEADERS))
+
+    differences = compare(requests)
+    for difference in differences:
+        print(difference)
+    print(f'{len(requests)} requests compared, {len(differences)} differences')
+    return 1 if differences else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # zstd bodies are refused when the library is not installed
+    zstandard = None
+
+# Size of the chunks read from the request stream and of the decoded chunks
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+# Accept gzip headers and multiple members
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# zstd frame magic numbers (skippable frames use 16 of them) and largest block
+ZSTD_MAGIC = 0xFD2FB528
+ZSTD_SKIPPABLE_MAGIC = 0x184D2A50
+ZSTD_MAX_BLOCK_SIZE = 128 * 1024
+
+
+class UnsupportedEncoding(Exception):
+    '''
+    Raised when the request body uses a content encoding that cannot be decoded
+    '''
+    pass
+
+
+class DecodedSizeExceeded(Exception):
+    '''
+    Raised when the decoded content of a request body is larger than allowed
+    '''
+    pass
+
+
+class IdentityDecoder:
+    def decode(self, data, chunk_size):
+        yield data
+
+    def finish(self):
+        pass
+
+
+class GzipDecoder:
+    '''
+    Incremental gzip decoder that never produces more than chunk_size bytes at once
+    '''
+    def __init__(self):
+        self._decompressor = zlib.decompressobj(GZIP_WBITS)
+
+    def decode(self, data, chunk_size):
+        while data:
+            if self._decompressor.eof:
+                # Next member of a multi-member body
+                self._decompressor = zlib.decompressobj(GZIP_WBITS)
+            chunk = self._decompressor.decompress(data, chunk_size)
+            if self._decompressor.eof:
+                data = self._decompressor.unused_data
+            else:
+                data = self._decompressor.unconsumed_tail
+            if chunk:
+                yield chunk
+
+    def finish(self):
+        if not self._decompressor.eof:
+            raise ValueError('Truncated gzip body')
+
+
+class ZstdDecoder:
+    '''
+    Incremental zstd decoder that never produces more than one block (128 KiB) at once.
+    Frames are split into blocks by their headers and each block is only given to the
+    decompressor once it is complete, so a small body cannot expand all at once.
+    '''
+    def __init__(self):
+        self._buffer = b''
+        self._decompressor = None
+        self._state = 'frame'
+        self._checksum = False
+        self._skip = 0
+
+    def decode(self, data, chunk_size):
+        self._buffer += data
+        while True:
+            if self._skip:
+                # Contents of a skippable frame
+                skipped = min(self._skip, len(self._buffer))
+                self._buffer = self._buffer[skipped:]
+                self._skip -= skipped
+                if self._skip:
+                    return
+            size = self._unit_size()
+            if size is None or size > len(self._buffer):
+                return
+            unit, self._buffer = self._buffer[:size], self._buffer[size:]
+            output = self._consume(unit)
+            for index in range(0, len(output), chunk_size):
+                yield output[index:index + chunk_size]
+
+    def _unit_size(self):
+        '''
+        Size of the next frame header, block or checksum, None when its own header is incomplete
+        '''
+        buffer = self._buffer
+        if self._state == 'frame':
+            if len(buffer) < 4:
+                return None
+            magic = int.from_bytes(buffer[:4], 'little')
+            if magic & 0xFFFFFFF0 == ZSTD_SKIPPABLE_MAGIC:
+                return 8
+            if magic != ZSTD_MAGIC:
+                raise ValueError('Invalid zstd body')
+            if len(buffer) < 5:
+                return None
+            descriptor = buffer[4]
+            single_segment = descriptor >> 5 & 1
+            dictionary_size = (0, 1, 2, 4)[descriptor & 3]
+            content_size = (single_segment, 2, 4, 8)[descriptor >> 6]
+            return 5 + (not single_segment) + dictionary_size + content_size
+        if self._state == 'block':
+            if len(buffer) < 3:
+                return None
+            header = int.from_bytes(buffer[:3], 'little')
+            block_type, block_size = header >> 1 & 3, header >> 3
+            if block_type == 3 or block_size > ZSTD_MAX_BLOCK_SIZE:
+                raise ValueError('Invalid zstd block')
+            # RLE blocks repeat a single byte block_size times
+            return 3 + (1 if block_type == 1 else block_size)
+        return 4
+
+    def _consume(self, unit):
+        if self._state == 'frame':
+            if int.from_bytes(unit[:4], 'little') != ZSTD_MAGIC:
+                self._skip = int.from_bytes(unit[4:8], 'little')
+                return b''
+            self._decompressor = zstandard.ZstdDecompressor().decompressobj()
+            self._checksum = bool(unit[4] & 4)
+            self._state = 'block'
+        elif self._state == 'block' and unit[0] & 1:
+            # Last block of the frame
+            self._state = 'checksum' if self._checksum else 'frame'
+        elif self._state == 'checksum':
+            self._state = 'frame'
+        return self._decompressor.decompress(unit)
+
+    def finish(self):
+        if self._state != 'frame' or self._buffer or self._skip:
+            raise ValueError('Truncated zstd body')
+
+
+# Available decoders, indexed by Content-Encoding
+decoders = {
+    'identity': IdentityDecoder,
+    'gzip': GzipDecoder,
+    'x-gzip': GzipDecoder,
+}
+if zstandard is not None:
+    decoders['zstd'] = ZstdDecoder
+
+
+def get_decoder(encoding):
+    encoding = (encoding or 'identity').strip().lower()
+    try:
+        return decoders[encoding]()
+    except KeyError:
+        raise UnsupportedEncoding(f'Unsupported content encoding: {encoding}')
+
+
+class DecodingReader:
+    '''
+    File-like view of the decoded content of a stream, raising DecodedSizeExceeded
+    once more than max_size bytes were decoded (None for no limit)
+    '''
+    def __init__(self, stream, decoder, chunk_size=DEFAULT_CHUNK_SIZE, max_size=None):
+        self.stream = stream
+        self.decoder = decoder
+        self.chunk_size = chunk_size
+        self.max_size = max_size
+        self.decoded = 0
+        self._buffer = b''
+        self._pending = iter(())
+        self._done = False
+
+    def read(self, size=-1):
+        while (size is None or size < 0 or len(self._buffer) < size) and not self._done:
+            chunk = next(self._pending, None)
+            if chunk is not None:
+                self._append(chunk)
+                continue
+            data = self.stream.read(self.chunk_size)
+            if data:
+                self._pending = self.decoder.decode(data, self.chunk_size)
+            else:
+                self.decoder.finish()
+                self._done = True
+        return self._take(size)
+
+    def _append(self, chunk):
+        self.decoded += len(chunk)
+        if self.max_size is not None and self.decoded > self.max_size:
+            raise DecodedSizeExceeded(f'Decoded body larger than {self.max_size} bytes')
+        self._buffer += chunk
+
+    def _take(self, size):
+        if size is None or size < 0:
+            chunk, self._buffer = self._buffer, b''
+        else:
+            chunk, self._buffer = self._buffer[:size], self._buffer[size:]
+        return chunk
+
+
+class AsyncDecodingReader(DecodingReader):
+    '''
+    DecodingReader for streams with a coroutine read method, copying the decoded content into a sink
+    '''
+    def __init__(self, stream, decoder, chunk_size=DEFAULT_CHUNK_SIZE, sink=None, max_size=None):
+        DecodingReader.__init__(self, stream, decoder, chunk_size, max_size)
+        self.sink = sink
+        self.bytes_read = 0
+
+    async def read(self, size=-1):
+        while (size is None or size < 0 or len(self._buffer) < size) and not self._done:
+            chunk = next(self._pending, None)
+            if chunk is not None:
+                self._append(chunk)
+                continue
+            data = await self.stream.read(self.chunk_size)
+            if data:
+                self._pending = self.decoder.decode(data, self.chunk_size)
+            else:
+                self.decoder.finish()
+                self._done = True
+        chunk = self._take(size)
+        self.bytes_read += len(chunk)
+        if self.sink is not None and chunk:
+            self.sink.write(chunk)
+        return chunk
@@ -0,0 +1,116 @@
+import hashlib
+import decimal
+import ijson
+
+# Size of the chunks read from the request stream
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class TeeReader:
+    '''
+    File-like wrapper that copies every chunk read from a stream into a sink
+    and keeps track of how many bytes went through it
+    '''
+    def __init__(self, stream, sink=None):
+        self.stream = stream
+        self.sink = sink
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.bytes_read += len(chunk)
+        if self.sink is not None and chunk:
+            self.sink.write(chunk)
+        return chunk
+
+
+class CanonicalHasher:
+    '''
+    Incremental SHA-256 fingerprint of a JSON document fed as ijson events.
+
+    The digest is computed bottom-up: scalars are hashed with a type tag,
+    arrays hash the ordered digests of their items and objects hash the sorted
+    digests of their (key, value) pairs. Whitespace, escaping and key order
+    therefore do not change the fingerprint. Memory usage grows with the nesting
+    depth and the number of keys of the objects being read, not with the
+    size of the document (items of an array are hashed as they come).
+    '''
+    def __init__(self):
+        self._stack = []
+        self._digest = None
+
+    def feed(self, event, value):
+        if event == 'start_array':
+            self._stack.append(['array', hashlib.sha256(b'['), None])
+        elif event == 'start_map':
+            self._stack.append(['map', [], None])
+        elif event == 'map_key':
+            self._stack[-1][2] = _hash(b'k', value.encode('utf-8'))
+        elif event == 'end_array':
+            frame = self._stack.pop()
+            frame[1].update(b']')
+            self._add(frame[1].digest())
+        elif event == 'end_map':
+            frame = self._stack.pop()
+            # Sorted digests of fixed size, so key order is irrelevant and no two
+            # different sets of members are hashed from the same bytes
+            members = hashlib.sha256(b'{')
+            for pair in sorted(frame[1]):
+                members.update(pair)
+            members.update(b'}')
+            self._add(members.digest())
+        elif event == 'null':
+            self._add(_hash(b'z', b''))
+        elif event == 'boolean':
+            self._add(_hash(b't' if value else b'f', b''))
+        elif event in ('integer', 'double', 'number'):
+            self._add(_hash(b'n', _number(value)))
+        elif event == 'string':
+            self._add(_hash(b's', value.encode('utf-8')))
+        else:
+            raise ValueError(f'Unexpected json event: {event}')
+
+    def hexdigest(self):
+        if self._digest is None or self._stack:
+            raise ValueError('Incomplete json document')
+        return self._digest.hex()
+
+    def _add(self, digest):
+        if not self._stack:
+            self._digest = digest
+            return
+        frame = self._stack[-1]
+        if frame[0] == 'array':
+            frame[1].update(digest)
+        else:
+            frame[1].append(hashlib.sha256(frame[2] + digest).digest())
+            frame[2] = None
+
+
+def canonical_fingerprint(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Read a JSON document from a file-like stream and return its canonical fingerprint
+    '''
+    hasher = CanonicalHasher()
+    for event, value in ijson.basic_parse(stream, buf_size=chunk_size):
+        hasher.feed(event, value)
+    return hasher.hexdigest()
+
+
+async def canonical_fingerprint_async(stream, chunk_size=DEFAULT_CHUNK_SIZE):
+    '''
+    Same as canonical_fingerprint, for streams with a coroutine read method
+    '''
+    hasher = CanonicalHasher()
+    async for event, value in ijson.basic_parse_async(stream, buf_size=chunk_size):
+        hasher.feed(event, value)
+    return hasher.hexdigest()
+
+
+def _hash(tag, data):
+    return hashlib.sha256(tag + data).digest()
+
+
+def _number(value):
+    # 1, 1.0 and 1e0 must share the same representation
+    return str(decimal.Decimal(str(value)).normalize()).encode('ascii')
@@ -0,0 +1,142 @@
+import os
+import time
+
+# Hot-path instrumentation, exported in Prometheus format on /metrics.
+# When disabled, every helper returns right away and prometheus_client is not even imported.
+enabled = False
+registry = None
+
+
+def enable():
+    '''
+    Create the metrics in a registry of their own and turn the instrumentation on
+    '''
+    global enabled, registry, prometheus_client, STAGE_SECONDS, PAYLOAD_BYTES, CACHE_REQUESTS, RESPONSES
+    import prometheus_client
+
+    registry = prometheus_client.CollectorRegistry()
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'products_api_stage_seconds',
+        'Time spent in each stage of receive_product',
+        ['stage'],
+        buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120),
+        registry=registry
+    )
+    PAYLOAD_BYTES = prometheus_client.Histogram(
+        'products_api_payload_bytes',
+        'Size of the decoded request bodies',
+        buckets=tuple(10 ** exponent for exponent in range(2, 11)),
+        registry=registry
+    )
+    CACHE_REQUESTS = prometheus_client.Counter(
+        'products_api_cache_requests_total',
+        'Fingerprint lookups by cache tier and result',
+        ['tier', 'result'],
+        registry=registry
+    )
+    RESPONSES = prometheus_client.Counter(
+        'products_api_responses_total',
+        'Responses of receive_product by status code',
+        ['status'],
+        registry=registry
+    )
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+if os.environ.get('METRICS_ENABLED') == 'True':
+    enable()
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+def stage(name):
+    '''
+    Context manager timing one stage of the request
+    '''
+    if not enabled:
+        return _null_timer
+    return STAGE_SECONDS.labels(name).time()
+
+
+def observe_stage(name, seconds):
+    if enabled:
+        STAGE_SECONDS.labels(name).observe(seconds)
+
+
+def observe_payload(size):
+    if enabled:
+        PAYLOAD_BYTES.observe(size)
+
+
+def count_cache(tier, result):
+    if enabled:
+        CACHE_REQUESTS.labels(tier, result).inc()
+
+
+def count_response(status):
+    if enabled:
+        RESPONSES.labels(str(status)).inc()
+
+
+def exposition():
+    '''
+    Return the metrics of this process and their content type
+    '''
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
+
+
+def now():
+    return time.monotonic() if enabled else 0.0
+
+
+class TimedReader:
+    '''
+    File-like wrapper adding up the time spent waiting on the reads of a stream
+    '''
+    def __init__(self, stream):
+        self.stream = stream
+        self.seconds = 0.0
+
+    def read(self, size=-1):
+        start = time.monotonic()
+        chunk = self.stream.read(size)
+        self.seconds += time.monotonic() - start
+        return chunk
+
+
+class AsyncTimedReader(TimedReader):
+    async def read(self, size=-1):
+        start = time.monotonic()
+        chunk = await self.stream.read(size)
+        self.seconds += time.monotonic() - start
+        return chunk
+
+
+def timed_reader(stream, reader_class=TimedReader):
+    '''
+    Wrap a stream in a timed reader, or return it untouched when metrics are disabled
+    '''
+    return reader_class(stream) if enabled else stream
+
+
+def observe_read(reader, started, name='parse_hash'):
+    '''
+    Split the time since started between reading the body and the work done on it
+    '''
+    if enabled:
+        elapsed = time.monotonic() - started
+        observe_stage('body', reader.seconds)
+        observe_stage(name, elapsed - reader.seconds)
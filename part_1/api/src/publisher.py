@@ -0,0 +1,114 @@
+import os
+import json
+import zlib
+import uuid
+import socket
+import asyncio
+import reprlib
+import aio_pika
+
+
+class AsyncCeleryPublisher:
+    '''
+    Publishes Celery task messages (protocol 2) through an asyncio AMQP connection.
+    Exchanges and queues are declared the same way Celery declares them.
+    '''
+    def __init__(self, url, compression=None):
+        self.url = url
+        self.compression = compression
+        self._connection = None
+        self._channel = None
+        self._exchanges = {}
+        self._lock = None
+
+    async def _get_exchange(self, queue):
+        # Created lazily so it belongs to the server's event loop
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._channel is None or self._channel.is_closed:
+                self._connection = await aio_pika.connect_robust(self.url)
+                self._channel = await self._connection.channel()
+                self._exchanges = {}
+            if queue not in self._exchanges:
+                exchange = await self._channel.declare_exchange(
+                    queue, aio_pika.ExchangeType.DIRECT, durable=True
+                )
+                amqp_queue = await self._channel.declare_queue(queue, durable=True)
+                await amqp_queue.bind(exchange, routing_key=queue)
+                self._exchanges[queue] = exchange
+            return self._exchanges[queue]
+
+    async def send_task(self, name, args=None, kwargs=None, queue=None):
+        message = build_message(name, args, kwargs, self.compression)
+        exchange = await self._get_exchange(queue)
+        await exchange.publish(message, routing_key=queue)
+        return message.correlation_id
+
+    async def queue_stats(self, queue):
+        '''
+        Return (message count, consumer count) of a queue through a passive declare
+        '''
+        await self._get_exchange(queue)
+        # A failed passive declare closes the channel, so it gets its own
+        channel = await self._connection.channel()
+        try:
+            amqp_queue = await channel.declare_queue(queue, passive=True)
+            result = amqp_queue.declaration_result
+            return result.message_count, result.consumer_count
+        finally:
+            if not channel.is_closed:
+                await channel.close()
+
+    async def close(self):
+        if self._connection is not None:
+            await self._connection.close()
+            self._connection = None
+            self._channel = None
+
+
+# Compressions understood by kombu, indexed by their Celery name
+compressions = {
+    'gzip': (zlib.compress, 'application/x-gzip'),
+    'zlib': (zlib.compress, 'application/x-gzip'),
+}
+
+
+def build_message(name, args=None, kwargs=None, compression=None):
+    '''
+    Build the AMQP message Celery would publish for send_task(name, args, kwargs)
+    '''
+    args = args or []
+    kwargs = kwargs or {}
+    task_id = str(uuid.uuid4())
+    headers = {
+        'lang': 'py',
+        'task': name,
+        'id': task_id,
+        'root_id': task_id,
+        'parent_id': None,
+        'group': None,
+        'shadow': None,
+        'eta': None,
+        'expires': None,
+        'retries': 0,
+        'timelimit': [None, None],
+        'argsrepr': reprlib.repr(args),
+        'kwargsrepr': reprlib.repr(kwargs),
+        'origin': f'{os.getpid()}@{socket.gethostname()}',
+    }
+    embed = {'callbacks': None, 'errbacks': None, 'chain': None, 'chord': None}
+    body = json.dumps([args, kwargs, embed]).encode('utf-8')
+    if compression is not None:
+        compress, content_type = compressions[compression]
+        body = compress(body)
+        headers['compression'] = content_type
+    return aio_pika.Message(
+        body,
+        headers=headers,
+        content_type='application/json',
+        content_encoding='utf-8',
+        correlation_id=task_id,
+        delivery_mode=aio_pika.DeliveryMode.PERSISTENT,
+        priority=0
+    )
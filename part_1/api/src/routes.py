@@ -1,45 +1,216 @@
 import os
-import redis
 import json
 import hashlib
+import tempfile
+import src.cache as dedup
+import src.admission as admission
+import src.encoding as encodings
+import src.fingerprint as fingerprints
+import src.metrics as metrics
+import src.storage as storage
 from src.app import app
+from collections import Counter
 from celery import Celery
-from flask import request, jsonify, abort
+from flask import request, jsonify, abort, Response
 
 # Load parameters
 queue = os.environ.get('BROKER_QUEUE')
 task = os.environ.get('CELERY_TASK')
 cache_time = int(os.environ.get('CACHE_TIME', 600))
+stream_ingest = os.environ.get('STREAM_INGEST') == 'True'
+stream_chunk_size = int(os.environ.get('STREAM_CHUNK_SIZE', fingerprints.DEFAULT_CHUNK_SIZE))
+spool_max_size = int(os.environ.get('SPOOL_MAX_SIZE', 4 * 1024 * 1024))
+# Largest decoded content of a compressed body (0 for no limit), larger ones get a 413
+max_decoded_size = int(os.environ.get('MAX_DECODED_SIZE', 64 * 1024 * 1024)) or None
+near_cache_size = int(os.environ.get('NEAR_CACHE_SIZE', 0))
+cache_endpoints = os.environ.get('CACHE_ENDPOINTS') or os.environ.get('CACHE_ENDPOINT')
+cache_vnodes = int(os.environ.get('CACHE_VNODES', 160))
+cache_max_connections = int(os.environ.get('CACHE_MAX_CONNECTIONS', 50))
+broker_compression = os.environ.get('BROKER_COMPRESSION') or None
+queue_max_depth = int(os.environ.get('QUEUE_MAX_DEPTH', 0))
+queue_min_consumers = int(os.environ.get('QUEUE_MIN_CONSUMERS', 0))
+queue_sample_interval = float(os.environ.get('QUEUE_SAMPLE_INTERVAL', 1.0))
+retry_after = int(os.environ.get('RETRY_AFTER', 30))
 
-# Load Cache and Celery
-cache = redis.Redis.from_url(os.environ.get('CACHE_ENDPOINT'))
+# Load Cache (one shard per endpoint) and Celery
+cache = dedup.ShardedDedupCache(
+    [endpoint.strip() for endpoint in cache_endpoints.split(',') if endpoint.strip()],
+    vnodes=cache_vnodes,
+    max_connections=cache_max_connections
+)
 celery = Celery('challenge_part_1', broker=os.environ.get('BROKER_ENDPOINT'))
+celery.conf.task_compression = broker_compression
+
+# Payload store for claim-check publishing (only used in stream mode)
+store = storage.from_url(os.environ['PAYLOAD_STORE']) if os.environ.get('PAYLOAD_STORE') else None
+
+# Optional load shedding based on the depth and consumers of the worker queue
+admission_controller = None
+if queue_max_depth > 0 or queue_min_consumers > 0:
+    admission_controller = admission.AdmissionController(
+        admission.celery_queue_sampler(celery, queue),
+        max_depth=queue_max_depth,
+        min_consumers=queue_min_consumers,
+        sample_interval=queue_sample_interval,
+        retry_after=retry_after
+    )
+
+# Optional per-process cache of recently seen fingerprints
+near_cache = dedup.NearCache(near_cache_size) if near_cache_size > 0 else None
+
+# Hit/miss counters of both cache tiers
+stats = Counter()
 
 @app.route('/v1/products', methods=['POST'])
 def receive_product():
+    # Check if the worker queue can take another product
+    # Nothing was read or claimed yet, so the client can simply retry later
+    if admission_controller is not None:
+        with metrics.stage('admission'):
+            status = admission_controller.check()
+        if status is not None:
+            app.logger.info(f'Product rejected by admission control: {status}')
+            abort(status)
+
+    # Check if the body is compressed with a supported encoding
+    try:
+        decoder = encodings.get_decoder(request.headers.get('Content-Encoding'))
+    except encodings.UnsupportedEncoding as exc:
+        app.logger.error(f'Payload error: {exc}')
+        abort(415)
+    identity = isinstance(decoder, encodings.IdentityDecoder)
+
     # Check if payload is in a correct json format
-    # And if a fingerprint can be computed from it
+    # And if a fingerprint can be computed from it (over the decoded content)
+    spool = open_spool() if stream_ingest else None
     try:
-        payload = request.get_json()
-        fingerprint = hashlib.sha256(json.dumps(payload).encode('utf-8')).hexdigest()
+        if stream_ingest:
+            # Hash the body while it is read, spooling it to disk when it gets large
+            # (time blocked on the request stream is reported apart from parsing and hashing)
+            started = metrics.now()
+            timed = stream = metrics.timed_reader(request.stream)
+            if not identity:
+                stream = encodings.DecodingReader(stream, decoder, stream_chunk_size, max_decoded_size)
+            body = fingerprints.TeeReader(stream, spool)
+            fingerprint = fingerprints.canonical_fingerprint(body, stream_chunk_size)
+            metrics.observe_read(timed, started)
+            metrics.observe_payload(body.bytes_read)
+        else:
+            if identity:
+                if metrics.enabled:
+                    with metrics.stage('body'):
+                        metrics.observe_payload(len(request.get_data()))
+                with metrics.stage('parse'):
+                    payload = request.get_json()
+            else:
+                started = metrics.now()
+                stream = metrics.timed_reader(request.stream)
+                decoded = encodings.DecodingReader(stream, decoder, stream_chunk_size, max_decoded_size)
+                payload = json.load(decoded)
+                metrics.observe_read(stream, started, 'parse')
+            with metrics.stage('hash'):
+                fingerprint = hashlib.sha256(json.dumps(payload).encode('utf-8')).hexdigest()
     except Exception as exc:
         app.logger.error(f'Payload error: {exc}')
-        abort(400)
-    
-    # Check if the fingerprint is already stored in cache
-    cached_value = cache.get(fingerprint)
-    if cached_value is not None:
-        # Fingerprint found in cache, return 403
-        app.logger.info(f'Cache hit for fingerprint: {fingerprint}')
-        abort(403)
+        if spool is not None:
+            discard_spool(spool)
+        abort(413 if isinstance(exc, encodings.DecodedSizeExceeded) else 400)
     
+    # The spool is closed (and its file removed) whatever happens from here on,
+    # also when the cache or the broker fail
+    try:
+        # Check if the fingerprint was recently seen by this process
+        if near_cache is not None:
+            if fingerprint in near_cache:
+                stats['near_cache_hits'] += 1
+                metrics.count_cache('near', 'hit')
+                app.logger.info(f'Near cache hit for fingerprint: {fingerprint}')
+                abort(403)
+            stats['near_cache_misses'] += 1
+            metrics.count_cache('near', 'miss')
+
+        # Store the fingerprint unless it is already stored (single atomic operation)
+        # Fingerprint is cached as key with just 1 bit as value
+        with metrics.stage('cache'):
+            remaining_ttl = cache.claim(fingerprint, cache_time)
+        if remaining_ttl is not None:
+            # Fingerprint found in cache, return 403
+            stats['cache_hits'] += 1
+            metrics.count_cache('shared', 'hit')
+            app.logger.info(f'Cache hit for fingerprint: {fingerprint}')
+            if near_cache is not None:
+                near_cache.add(fingerprint, remaining_ttl / 1000)
+            abort(403)
+
+        else:
+            # Fingerprint not found, receive payload (product)
+            stats['cache_misses'] += 1
+            metrics.count_cache('shared', 'miss')
+            app.logger.info(f'Cache miss for fingerprint: {fingerprint}')
+            if near_cache is not None:
+                near_cache.add(fingerprint, cache_time)
+            if spool is not None and store is not None:
+                # Claim-check: the body stays in the store, only a reference is published
+                with metrics.stage('store'):
+                    reference = store.commit(spool, fingerprint)
+                with metrics.stage('publish'):
+                    try:
+                        celery.send_task(task, kwargs={'reference': reference}, queue=queue)
+                    except Exception:
+                        # No task will ever read the stored body
+                        store.delete(reference['key'])
+                        raise
+                return jsonify(msg=f'Product successfully received'), 200
+            if spool is not None:
+                # Only accepted bodies are loaded back from the spool
+                spool.seek(0)
+                payload = json.load(spool)
+            with metrics.stage('publish'):
+                celery.send_task(task, args=[payload], queue=queue)
+            return jsonify(msg=f'Product successfully received'), 200
+    finally:
+        if spool is not None:
+            discard_spool(spool)
+
+
+@app.route('/v1/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(
+        near_cache_hits=stats['near_cache_hits'],
+        near_cache_misses=stats['near_cache_misses'],
+        near_cache_size=len(near_cache) if near_cache is not None else 0,
+        cache_hits=stats['cache_hits'],
+        cache_misses=stats['cache_misses']
+    ), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+    if not metrics.enabled:
+        abort(404)
+    content, content_type = metrics.exposition()
+    return Response(content, content_type=content_type)
+
+
+@app.after_request
+def count_response(response):
+    if request.endpoint == 'receive_product':
+        metrics.count_response(response.status_code)
+    return response
+
+
+def open_spool():
+    # Write straight into the payload store when there is one
+    if store is not None:
+        return store.open_writer()
+    return tempfile.SpooledTemporaryFile(max_size=spool_max_size)
+
+def discard_spool(spool):
+    # Also called once the spool was committed to the store (nothing left to remove)
+    if store is not None:
+        store.discard(spool)
     else:
-        # Fingerprint not found, receive payload (product)
-        # Cache fingerprint as key with just 1 bit as value
-        app.logger.info(f'Cache miss for fingerprint: {fingerprint}')
-        cache.set(fingerprint, bin(1), cache_time)
-        celery.send_task(task, args=[payload], queue=queue)
-        return jsonify(msg=f'Product successfully received'), 200
+        spool.close()
 
 
 # Error message in case of HTTP 400
@@ -48,6 +219,30 @@ def bad_request_response(error):
     msg = f'Invalid json format'
     return jsonify(msg=msg), 400
 
+# Error message in case of HTTP 413
+@app.errorhandler(413)
+def payload_too_large_response(error):
+    msg = f'Decoded payload larger than {max_decoded_size} bytes'
+    return jsonify(msg=msg), 413
+
+# Error message in case of HTTP 415
+@app.errorhandler(415)
+def unsupported_media_type_response(error):
+    msg = f'Unsupported content encoding'
+    return jsonify(msg=msg), 415
+
+# Error message in case of HTTP 429
+@app.errorhandler(429)
+def too_many_requests_response(error):
+    msg = f'Too many products waiting to be processed, try again later'
+    return jsonify(msg=msg), 429, {'Retry-After': str(retry_after)}
+
+# Error message in case of HTTP 503
+@app.errorhandler(503)
+def service_unavailable_response(error):
+    msg = f'Products cannot be processed right now, try again later'
+    return jsonify(msg=msg), 503, {'Retry-After': str(retry_after)}
+
 # Error message in case of HTTP 403 
 @app.errorhandler(403)
 def forbidden_response(error):
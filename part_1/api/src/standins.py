@@ -0,0 +1,62 @@
+import time
+import threading
+from collections import Counter
+
+# In-memory stand-ins for the cache and the broker, used to run the api
+# implementations side by side without external services
+
+
+class MemoryDedupCache:
+    '''
+    Single-process replacement for the sharded fingerprint cache
+    '''
+    def __init__(self):
+        self.entries = {}
+        self.operations = Counter()
+        self._lock = threading.Lock()
+
+    def claim(self, fingerprint, ttl):
+        # Atomic like the lua script, also when the flask app runs with threads
+        with self._lock:
+            self.operations['claim'] += 1
+            now = time.monotonic()
+            deadline = self.entries.get(fingerprint)
+            if deadline is not None and deadline > now:
+                return int((deadline - now) * 1000)
+            self.entries[fingerprint] = now + ttl
+            return None
+
+
+class AsyncMemoryDedupCache(MemoryDedupCache):
+    '''
+    MemoryDedupCache with the interface of the asyncio cache
+    '''
+    async def claim(self, fingerprint, ttl):
+        return MemoryDedupCache.claim(self, fingerprint, ttl)
+
+
+class MemoryBroker:
+    '''
+    Replacement for the Celery app (and the async publisher) that keeps sent tasks in a list.
+    With keep_messages=False the tasks are only counted, so large payloads are not retained.
+    '''
+    def __init__(self, keep_messages=True):
+        self.messages = []
+        self.sent = 0
+        self.keep_messages = keep_messages
+
+    def send_task(self, name, args=None, kwargs=None, queue=None, **options):
+        self.sent += 1
+        if self.keep_messages:
+            self.messages.append({'task': name, 'args': args, 'kwargs': kwargs, 'queue': queue})
+
+
+class AsyncMemoryBroker(MemoryBroker):
+    '''
+    MemoryBroker with the interface of the asyncio publisher
+    '''
+    async def send_task(self, name, args=None, kwargs=None, queue=None, **options):
+        MemoryBroker.send_task(self, name, args, kwargs, queue, **options)
+
+    async def close(self):
+        pass
@@ -0,0 +1,67 @@
+import os
+import uuid
+import tempfile
+from urllib.parse import urlparse
+
+
+class FileSystemStore:
+    '''
+    Payload store backed by a local (or shared) directory. Each accepted body is its own
+    blob, keyed by its fingerprint and a unique suffix (the same body accepted twice is
+    consumed by two tasks), spread over 256 subdirectories.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.tmp_dir = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], key)
+
+    def open_writer(self):
+        # Temporary files live in the store, so committing is an atomic rename
+        return tempfile.NamedTemporaryFile(dir=self.tmp_dir, prefix='upload-', delete=False)
+
+    def commit(self, writer, fingerprint):
+        writer.flush()
+        os.fsync(writer.fileno())
+        writer.close()
+        key = f'{fingerprint}-{uuid.uuid4().hex}'
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(writer.name, path)
+        return {'fingerprint': fingerprint, 'key': key, 'size': os.path.getsize(path)}
+
+    def discard(self, writer):
+        writer.close()
+        try:
+            os.unlink(writer.name)
+        except FileNotFoundError:
+            pass
+
+    def open(self, key):
+        return open(self.path(key), 'rb')
+
+    def delete(self, key):
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+
+# Available backends, indexed by url scheme
+backends = {
+    'file': lambda url: FileSystemStore(url.path),
+}
+
+
+def from_url(url):
+    '''
+    Build a payload store from an url such as file:///data/payloads
+    '''
+    parsed = urlparse(url)
+    try:
+        backend = backends[parsed.scheme]
+    except KeyError:
+        raise ValueError(f'Unsupported payload store: {parsed.scheme}')
+    return backend(parsed)
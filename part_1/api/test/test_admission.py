@@ -0,0 +1,76 @@
+import mock
+import asyncio
+from src.admission import AdmissionController, AsyncAdmissionController, celery_queue_sampler
+
+def test_product_accepted_below_high_water_mark():
+    '''
+    Case where the queue is below its limits
+    '''
+    controller = AdmissionController(lambda: (10, 2), max_depth=100, min_consumers=1)
+    assert controller.check() is None
+
+def test_deep_queue_returns_429():
+    '''
+    Case where the queue reached its maximum depth
+    '''
+    controller = AdmissionController(lambda: (100, 2), max_depth=100, min_consumers=1)
+    assert controller.check() == 429
+
+def test_queue_without_consumers_returns_503():
+    '''
+    Case where the queue has fewer consumers than required
+    '''
+    controller = AdmissionController(lambda: (0, 0), max_depth=100, min_consumers=1)
+    assert controller.check() == 503
+
+@mock.patch('src.admission.time.monotonic')
+def test_queue_is_sampled_once_per_interval(mock_time):
+    '''
+    Case where several requests arrive within the same sample interval
+    '''
+    sampler = mock.Mock(return_value=(0, 1))
+    controller = AdmissionController(sampler, max_depth=100, sample_interval=1.0)
+    mock_time.return_value = 10.0
+    controller.check()
+    mock_time.return_value = 10.5
+    controller.check()
+    assert sampler.call_count == 1
+
+    mock_time.return_value = 11.0
+    controller.check()
+    assert sampler.call_count == 2
+
+@mock.patch('src.admission.logger')
+def test_sampling_error_fails_open(mock_logger):
+    '''
+    Case where the broker cannot be sampled
+    '''
+    controller = AdmissionController(mock.Mock(side_effect=Exception('Broker down')), max_depth=1)
+    assert controller.check() is None
+    mock_logger.error.assert_called_once_with('Queue sampling error: Broker down')
+
+def test_async_controller():
+    '''
+    Case where the queue is sampled through a coroutine
+    '''
+    async def sampler():
+        return 500, 1
+
+    controller = AsyncAdmissionController(sampler, max_depth=100)
+    loop = asyncio.new_event_loop()
+    try:
+        assert loop.run_until_complete(controller.check()) == 429
+    finally:
+        loop.close()
+
+def test_celery_queue_sampler():
+    '''
+    Case where the queue is sampled with a passive declare
+    '''
+    celery = mock.MagicMock()
+    connection = celery.connection_or_acquire.return_value.__enter__.return_value
+    channel = connection.channel.return_value.__enter__.return_value
+    channel.queue_declare.return_value = mock.Mock(message_count=7, consumer_count=2)
+
+    assert celery_queue_sampler(celery, 'test_queue')() == (7, 2)
+    channel.queue_declare.assert_called_once_with(queue='test_queue', passive=True)
@@ -1,3 +1,4 @@
+import gzip
 import pytest
 import mock
 import json
@@ -41,6 +42,7 @@ def test_invalid_payload(mock_logger, mock_request, client):
     Case where an invalid payload is sent
     '''
     exc = Exception('Invalid payload')
+    mock_request.headers = {}
     mock_request.get_json.side_effect = exc
     payload = None
     expected_result = {'msg': 'Invalid json format'}
@@ -73,7 +75,7 @@ def test_payload_found_in_cache(mock_logger, mock_cache, client):
     Case where the payload sent is found in cache (rejected)
     '''
     settings.cache_time = 300
-    mock_cache.get.return_value = bin(1)
+    mock_cache.claim.return_value = settings.cache_time * 1000
     payload = [{'id': '123', 'name': 'mesa'}]
     fingerprint = '28b291f06e32b9e0eb2dc9595e5b13b4317a4278a29486e4553150f98c0055bf'
     expected_result = {'msg': f'Product already sent in the last {settings.cache_time/60} minutes'}
@@ -93,7 +95,7 @@ def test_payload_not_found_in_cache(mock_logger, mock_cache, mock_celery, client
     settings.queue = 'test_queue'
     settings.task = 'test_task'
     settings.cache_time = 300
-    mock_cache.get.return_value = None
+    mock_cache.claim.return_value = None
     payload = [{'id': '123', 'name': 'mesa'}]
     fingerprint = '28b291f06e32b9e0eb2dc9595e5b13b4317a4278a29486e4553150f98c0055bf'
     expected_result = {'msg': f'Product successfully received'}
@@ -101,6 +103,275 @@ def test_payload_not_found_in_cache(mock_logger, mock_cache, mock_celery, client
     
     assert result.status_code == 200
     assert expected_result == result.get_json()
-    mock_cache.set.assert_called_once_with(fingerprint, bin(1), settings.cache_time)
+    mock_cache.claim.assert_called_once_with(fingerprint, settings.cache_time)
     mock_celery.send_task(settings.task, args=[payload], queue=settings.queue)
     mock_logger.assert_called_once_with(f'Cache miss for fingerprint: {fingerprint}')
+
+@mock.patch('src.routes.celery')
+@mock.patch('src.routes.cache')
+@mock.patch('src.routes.app.logger.info')
+def test_payload_received_in_stream_mode(mock_logger, mock_cache, mock_celery, client):
+    '''
+    Case where the payload is hashed while it is streamed (accepted)
+    '''
+    settings.stream_ingest = True
+    settings.queue = 'test_queue'
+    settings.task = 'test_task'
+    settings.cache_time = 300
+    mock_cache.claim.return_value = None
+    payload = [{'id': '123', 'name': 'mesa'}]
+    fingerprint = '2c5aedab572ea58e7dcdb18afa991210695034fb309256c281492decf8d8b5db'
+    expected_result = {'msg': f'Product successfully received'}
+    try:
+        result = client.post('/v1/products', data=' [ {"name": "mesa", "id": "123"} ] ')
+    finally:
+        settings.stream_ingest = False
+
+    assert result.status_code == 200
+    assert expected_result == result.get_json()
+    mock_cache.claim.assert_called_once_with(fingerprint, settings.cache_time)
+    mock_celery.send_task.assert_called_once_with(settings.task, args=[payload], queue=settings.queue)
+    mock_logger.assert_called_once_with(f'Cache miss for fingerprint: {fingerprint}')
+
+@mock.patch('src.routes.app.logger.error')
+def test_invalid_payload_in_stream_mode(mock_logger, client):
+    '''
+    Case where a truncated payload is sent in stream mode
+    '''
+    settings.stream_ingest = True
+    expected_result = {'msg': 'Invalid json format'}
+    try:
+        result = client.post('/v1/products', data='[{"id": "123", "name": "mesa"')
+    finally:
+        settings.stream_ingest = False
+
+    assert result.status_code == 400
+    assert expected_result == result.get_json()
+    mock_logger.assert_called_once()
+
+@mock.patch('src.routes.celery')
+@mock.patch('src.routes.cache')
+def test_payload_published_by_reference(mock_cache, mock_celery, client, tmp_path):
+    '''
+    Case where the body is kept in the payload store and only a reference is published
+    '''
+    settings.stream_ingest = True
+    settings.store = settings.storage.FileSystemStore(str(tmp_path))
+    settings.queue = 'test_queue'
+    settings.task = 'test_task'
+    mock_cache.claim.return_value = None
+    body = b'[{"id": "123", "name": "mesa"}]'
+    fingerprint = '2c5aedab572ea58e7dcdb18afa991210695034fb309256c281492decf8d8b5db'
+    try:
+        result = client.post('/v1/products', data=body)
+    finally:
+        settings.stream_ingest = False
+        store, settings.store = settings.store, None
+
+    assert result.status_code == 200
+    reference = mock_celery.send_task.call_args[1]['kwargs']['reference']
+    mock_celery.send_task.assert_called_once_with(
+        settings.task, kwargs={'reference': {'fingerprint': fingerprint, 'key': reference['key'], 'size': len(body)}},
+        queue=settings.queue
+    )
+    assert reference['key'].startswith(f'{fingerprint}-')
+    with store.open(reference['key']) as stored:
+        assert stored.read() == body
+    assert list(tmp_path.joinpath('tmp').iterdir()) == []
+
+@mock.patch('src.routes.cache')
+def test_rejected_payload_is_not_stored(mock_cache, client, tmp_path):
+    '''
+    Case where a rejected body is removed from the payload store
+    '''
+    settings.stream_ingest = True
+    settings.store = settings.storage.FileSystemStore(str(tmp_path))
+    mock_cache.claim.return_value = settings.cache_time * 1000
+    try:
+        result = client.post('/v1/products', data=b'[{"id": "123", "name": "mesa"}]')
+    finally:
+        settings.stream_ingest = False
+        settings.store = None
+
+    assert result.status_code == 403
+    assert [path.name for path in tmp_path.iterdir()] == ['tmp']
+
+@pytest.mark.parametrize('failure', ['claim', 'publish'])
+@mock.patch('src.routes.celery')
+@mock.patch('src.routes.cache')
+def test_failed_request_leaves_nothing_stored(mock_cache, mock_celery, failure, client, tmp_path):
+    '''
+    Case where the cache or the broker fail: neither the spooled nor the committed body is left behind
+    '''
+    mock_cache.claim.return_value = None
+    if failure == 'claim':
+        mock_cache.claim.side_effect = ConnectionError('cache down')
+    else:
+        mock_celery.send_task.side_effect = ConnectionError('broker down')
+    with mock.patch('src.routes.stream_ingest', True), \
+            mock.patch('src.routes.store', settings.storage.FileSystemStore(str(tmp_path))):
+        with pytest.raises(ConnectionError):
+            client.post('/v1/products', data=b'[{"id": "123", "name": "mesa"}]')
+
+    assert [path for path in tmp_path.rglob('*') if path.is_file()] == []
+
+@mock.patch('src.routes.cache')
+def test_failed_request_closes_the_spool(mock_cache, client):
+    '''
+    Case where the cache fails without a payload store: the spooled body is closed
+    '''
+    mock_cache.claim.side_effect = ConnectionError('cache down')
+    spool = settings.tempfile.SpooledTemporaryFile()
+    with mock.patch('src.routes.stream_ingest', True), mock.patch('src.routes.open_spool', return_value=spool):
+        with pytest.raises(ConnectionError):
+            client.post('/v1/products', data=b'[{"id": "123", "name": "mesa"}]')
+
+    assert spool.closed
+
+def test_same_body_accepted_twice_is_stored_twice(tmp_path):
+    '''
+    Case where the same body is accepted again (after the cache time): each task gets its own blob
+    '''
+    store = settings.storage.FileSystemStore(str(tmp_path))
+    references = []
+    for _ in range(2):
+        writer = store.open_writer()
+        writer.write(b'[{"id": "123"}]')
+        references.append(store.commit(writer, 'abc123'))
+
+    assert references[0]['key'] != references[1]['key']
+    store.delete(references[0]['key'])
+    with store.open(references[1]['key']) as stored:
+        assert stored.read() == b'[{"id": "123"}]'
+    assert list(tmp_path.joinpath('tmp').iterdir()) == []
+
+@mock.patch('src.routes.celery')
+@mock.patch('src.routes.cache')
+@mock.patch('src.routes.app.logger.info')
+def test_payload_found_in_near_cache(mock_logger, mock_cache, mock_celery, client):
+    '''
+    Case where a repeated payload is rejected by the near cache without touching the cache server
+    '''
+    settings.cache_time = 300
+    settings.near_cache = settings.dedup.NearCache(10)
+    settings.stats.clear()
+    mock_cache.claim.return_value = None
+    payload = [{'id': '123', 'name': 'mesa'}]
+    fingerprint = '28b291f06e32b9e0eb2dc9595e5b13b4317a4278a29486e4553150f98c0055bf'
+    try:
+        first = client.post('/v1/products', json=payload)
+        second = client.post('/v1/products', json=payload)
+        stats = client.get('/v1/cache/stats').get_json()
+    finally:
+        settings.near_cache = None
+
+    assert first.status_code == 200
+    assert second.status_code == 403
+    mock_cache.claim.assert_called_once_with(fingerprint, settings.cache_time)
+    mock_logger.assert_called_with(f'Near cache hit for fingerprint: {fingerprint}')
+    assert stats == {
+        'near_cache_hits': 1,
+        'near_cache_misses': 1,
+        'near_cache_size': 1,
+        'cache_hits': 0,
+        'cache_misses': 1
+    }
+
+@mock.patch('src.routes.celery')
+@mock.patch('src.routes.cache')
+def test_compressed_payload_in_stream_mode(mock_cache, mock_celery, client):
+    '''
+    Case where a gzip body gets the same fingerprint as its plain json content
+    '''
+    settings.stream_ingest = True
+    settings.task = 'test_task'
+    settings.queue = 'test_queue'
+    mock_cache.claim.return_value = None
+    fingerprint = '2c5aedab572ea58e7dcdb18afa991210695034fb309256c281492decf8d8b5db'
+    body = gzip.compress(b'[{"id": "123", "name": "mesa"}]')
+    try:
+        result = client.post('/v1/products', data=body, headers={'Content-Encoding': 'gzip'})
+    finally:
+        settings.stream_ingest = False
+
+    assert result.status_code == 200
+    mock_cache.claim.assert_called_once_with(fingerprint, settings.cache_time)
+    mock_celery.send_task.assert_called_once_with(
+        settings.task, args=[[{'id': '123', 'name': 'mesa'}]], queue=settings.queue
+    )
+
+@mock.patch('src.routes.celery')
+@mock.patch('src.routes.cache')
+def test_compressed_payload(mock_cache, mock_celery, client):
+    '''
+    Case where a gzip body is sent outside stream mode
+    '''
+    mock_cache.claim.return_value = None
+    fingerprint = '28b291f06e32b9e0eb2dc9595e5b13b4317a4278a29486e4553150f98c0055bf'
+    body = gzip.compress(b'[{"id": "123", "name": "mesa"}]')
+    result = client.post('/v1/products', data=body, headers={'Content-Encoding': 'gzip'})
+
+    assert result.status_code == 200
+    mock_cache.claim.assert_called_once_with(fingerprint, settings.cache_time)
+
+@pytest.mark.parametrize('stream_ingest', [False, True])
+@mock.patch('src.routes.max_decoded_size', 64 * 1024)
+@mock.patch('src.routes.app.logger.error')
+@mock.patch('src.routes.cache')
+def test_compressed_payload_too_large(mock_cache, mock_logger, stream_ingest, client):
+    '''
+    Case where a small gzip body decodes to more than the allowed size (decompression bomb)
+    '''
+    body = gzip.compress(b'[' + b'0,' * 1024 * 1024 + b'0]')
+    assert len(body) < 8 * 1024
+    with mock.patch('src.routes.stream_ingest', stream_ingest):
+        result = client.post('/v1/products', data=body, headers={'Content-Encoding': 'gzip'})
+
+    assert result.status_code == 413
+    assert result.get_json() == {'msg': f'Decoded payload larger than {64 * 1024} bytes'}
+    mock_logger.assert_called_once_with(f'Payload error: Decoded body larger than {64 * 1024} bytes')
+    mock_cache.claim.assert_not_called()
+
+@mock.patch('src.routes.app.logger.error')
+def test_unsupported_content_encoding(mock_logger, client):
+    '''
+    Case where the body uses an unsupported encoding
+    '''
+    result = client.post('/v1/products', data=b'...', headers={'Content-Encoding': 'br'})
+
+    assert result.status_code == 415
+    assert result.get_json() == {'msg': 'Unsupported content encoding'}
+    mock_logger.assert_called_once_with('Payload error: Unsupported content encoding: br')
+
+@mock.patch('src.routes.cache')
+def test_payload_rejected_by_admission_control(mock_cache, client):
+    '''
+    Case where the worker queue is too deep: no fingerprint is claimed
+    '''
+    settings.retry_after = 15
+    settings.admission_controller = settings.admission.AdmissionController(lambda: (1000, 1), max_depth=500)
+    try:
+        result = client.post('/v1/products', json=[{'id': '123', 'name': 'mesa'}])
+    finally:
+        settings.admission_controller = None
+
+    assert result.status_code == 429
+    assert result.headers['Retry-After'] == '15'
+    assert result.get_json() == {'msg': 'Too many products waiting to be processed, try again later'}
+    mock_cache.claim.assert_not_called()
+
+@mock.patch('src.routes.cache')
+def test_payload_rejected_without_consumers(mock_cache, client):
+    '''
+    Case where nobody consumes the worker queue
+    '''
+    settings.retry_after = 15
+    settings.admission_controller = settings.admission.AdmissionController(lambda: (0, 0), min_consumers=1)
+    try:
+        result = client.post('/v1/products', json=[{'id': '123', 'name': 'mesa'}])
+    finally:
+        settings.admission_controller = None
+
+    assert result.status_code == 503
+    assert result.headers['Retry-After'] == '15'
+    mock_cache.claim.assert_not_called()
@@ -0,0 +1,202 @@
+import gzip
+import json
+import zlib
+import pytest
+import mock
+import src.asgi as settings
+import src.standins as standins
+from src.compare import call_asgi, compare, DEFAULT_REQUESTS
+
+@pytest.fixture
+def backends():
+    '''
+    In-memory cache and broker for the asyncio app
+    '''
+    cache, publisher = standins.AsyncMemoryDedupCache(), standins.AsyncMemoryBroker()
+    with mock.patch('src.asgi.cache', cache), mock.patch('src.asgi.publisher', publisher):
+        yield cache, publisher
+
+def test_access_route_with_get_method(backends):
+    '''
+    Case where the route is called with HTTP GET method
+    '''
+    status, _ = call_asgi(settings.app, 'GET', '/v1/products')
+    assert status == 405
+
+def test_routing_matches_flask(backends):
+    '''
+    Case where trailing slashes, unknown paths and other methods are answered as the
+    flask routes do (Werkzeug 0.14 only relaxes slashes of rules ending with one)
+    '''
+    for method, path, expected in [('POST', '/v1/products/', 404), ('GET', '/v1/cache/stats/', 404),
+                                   ('POST', '/v1/cache/stats', 405), ('PUT', '/v1/products', 405),
+                                   ('GET', '/v1/other', 404)]:
+        status, _ = call_asgi(settings.app, method, path)
+        assert status == expected, (method, path)
+
+@mock.patch('src.asgi.logger')
+def test_invalid_payload(mock_logger, backends):
+    '''
+    Case where an invalid payload is sent
+    '''
+    status, body = call_asgi(settings.app, 'POST', '/v1/products', b'[{"id": "123"',
+                             headers={'Content-Type': 'application/json'})
+
+    assert status == 400
+    assert body == {'msg': 'Invalid json format'}
+    mock_logger.error.assert_called_once()
+
+@mock.patch('src.asgi.stream_ingest', True)
+@mock.patch('src.asgi.logger')
+def test_payload_accepted_then_rejected(mock_logger, backends):
+    '''
+    Case where the same payload is sent twice, in chunks
+    '''
+    _, publisher = backends
+    settings.queue = 'test_queue'
+    settings.task = 'test_task'
+    settings.cache_time = 300
+    payload = b'[{"id": "123", "name": "mesa"}]'
+    fingerprint = '2c5aedab572ea58e7dcdb18afa991210695034fb309256c281492decf8d8b5db'
+
+    first = call_asgi(settings.app, 'POST', '/v1/products', payload, chunk_size=5)
+    second = call_asgi(settings.app, 'POST', '/v1/products', payload, chunk_size=7)
+
+    assert first == (200, {'msg': 'Product successfully received'})
+    assert second == (403, {'msg': f'Product already sent in the last {settings.cache_time/60} minutes'})
+    assert publisher.messages == [{
+        'task': 'test_task',
+        'args': [[{'id': '123', 'name': 'mesa'}]],
+        'kwargs': None,
+        'queue': 'test_queue'
+    }]
+    mock_logger.info.assert_has_calls([
+        mock.call(f'Cache miss for fingerprint: {fingerprint}'),
+        mock.call(f'Cache hit for fingerprint: {fingerprint}')
+    ])
+
+@mock.patch('src.asgi.stream_ingest', True)
+def test_payload_published_by_reference(backends, tmp_path):
+    '''
+    Case where the body is kept in the payload store and only a reference is published
+    '''
+    _, publisher = backends
+    settings.task = 'test_task'
+    payload = b'[{"id": "123", "name": "mesa"}]'
+    with mock.patch('src.asgi.store', settings.storage.FileSystemStore(str(tmp_path))):
+        status, _ = call_asgi(settings.app, 'POST', '/v1/products', payload)
+
+    assert status == 200
+    reference = publisher.messages[0]['kwargs']['reference']
+    assert reference['size'] == len(payload)
+    assert reference['key'].startswith(reference['fingerprint'])
+    assert tmp_path.joinpath(reference['key'][:2], reference['key']).read_bytes() == payload
+
+@pytest.mark.parametrize('failure', ['claim', 'publish'])
+@mock.patch('src.asgi.stream_ingest', True)
+def test_failed_request_leaves_nothing_stored(failure, backends, tmp_path):
+    '''
+    Case where the cache or the broker fail: neither the spooled nor the committed body is left behind
+    '''
+    cache, publisher = backends
+    async def fail(*args, **kwargs):
+        raise ConnectionError('down')
+    target = cache if failure == 'claim' else publisher
+    method = 'claim' if failure == 'claim' else 'send_task'
+    with mock.patch('src.asgi.store', settings.storage.FileSystemStore(str(tmp_path))), \
+            mock.patch.object(target, method, fail):
+        with pytest.raises(ConnectionError):
+            call_asgi(settings.app, 'POST', '/v1/products', b'[{"id": "123", "name": "mesa"}]')
+
+    assert [path for path in tmp_path.rglob('*') if path.is_file()] == []
+
+@pytest.mark.parametrize('stream_ingest', [False, True])
+def test_implementations_answer_the_same(stream_ingest):
+    '''
+    Case where the comparison mode runs the same requests against flask and asgi,
+    in both ingest modes (same fingerprints, same published tasks)
+    '''
+    # Both read the same environment, other tests change the module settings
+    with mock.patch('src.routes.cache_time', settings.cache_time), mock.patch('src.routes.task', settings.task), \
+            mock.patch('src.routes.stream_ingest', stream_ingest), mock.patch('src.asgi.stream_ingest', stream_ingest):
+        assert compare(DEFAULT_REQUESTS) == []
+
+def test_comparison_reports_other_fingerprints():
+    '''
+    Case where the implementations run in different ingest modes: the same body gets two dedup keys
+    '''
+    with mock.patch('src.routes.stream_ingest', False), mock.patch('src.asgi.stream_ingest', True):
+        differences = compare([(b'[{"id": "1"}]', {'Content-Type': 'application/json'})])
+    assert len(differences) == 1 and differences[0].startswith('Fingerprints')
+
+def test_plain_text_body_is_not_json(backends):
+    '''
+    Case where the body is sent with a non-json content type: as flask's get_json, it is read as null
+    '''
+    _, publisher = backends
+    status, _ = call_asgi(settings.app, 'POST', '/v1/products', b'[{"id": "1"}]',
+                          headers={'Content-Type': 'text/plain'})
+
+    assert status == 200
+    assert publisher.messages[0]['args'] == [None]
+
+@pytest.mark.parametrize('stream_ingest', [False, True])
+def test_compressed_payload(backends, stream_ingest):
+    '''
+    Case where a gzip body is decoded before it is hashed and published
+    '''
+    _, publisher = backends
+    body = gzip.compress(b'[{"id": "321", "name": "mesa"}]')
+    with mock.patch('src.asgi.stream_ingest', stream_ingest):
+        status, _ = call_asgi(settings.app, 'POST', '/v1/products', body, chunk_size=10,
+                              headers={'Content-Encoding': 'gzip'})
+
+    assert status == 200
+    assert publisher.messages[0]['args'] == [[{'id': '321', 'name': 'mesa'}]]
+
+@pytest.mark.parametrize('stream_ingest', [False, True])
+@mock.patch('src.asgi.max_decoded_size', 64 * 1024)
+@mock.patch('src.asgi.logger')
+def test_compressed_payload_too_large(mock_logger, stream_ingest, backends):
+    '''
+    Case where a small gzip body decodes to more than the allowed size (decompression bomb)
+    '''
+    cache, _ = backends
+    body = gzip.compress(b'[' + b'0,' * 1024 * 1024 + b'0]')
+    with mock.patch('src.asgi.stream_ingest', stream_ingest):
+        status, response = call_asgi(settings.app, 'POST', '/v1/products', body, chunk_size=1024,
+                                     headers={'Content-Encoding': 'gzip'})
+
+    assert (status, response) == (413, {'msg': f'Decoded payload larger than {64 * 1024} bytes'})
+    assert cache.operations['claim'] == 0
+
+def test_unsupported_content_encoding(backends):
+    '''
+    Case where the body uses an unsupported encoding
+    '''
+    status, body = call_asgi(settings.app, 'POST', '/v1/products', b'...',
+                             headers={'Content-Encoding': 'br'})
+    assert (status, body) == (415, {'msg': 'Unsupported content encoding'})
+
+def test_compressed_task_message():
+    '''
+    Case where the published task message is compressed the way kombu expects
+    '''
+    message = settings.publishers.build_message('test_task', args=[[{'id': '1'}]], compression='gzip')
+
+    assert message.headers['compression'] == 'application/x-gzip'
+    assert json.loads(zlib.decompress(message.body))[0] == [[{'id': '1'}]]
+
+def test_payload_rejected_by_admission_control(backends):
+    '''
+    Case where the worker queue is too deep: no fingerprint is claimed
+    '''
+    cache, _ = backends
+    async def sampler():
+        return 1000, 1
+    controller = settings.admission.AsyncAdmissionController(sampler, max_depth=500)
+    with mock.patch('src.asgi.admission_controller', controller):
+        status, body = call_asgi(settings.app, 'POST', '/v1/products', b'[{"id": "1"}]')
+
+    assert (status, body) == (429, {'msg': 'Too many products waiting to be processed, try again later'})
+    assert cache.operations['claim'] == 0
@@ -0,0 +1,83 @@
+import json
+import random
+import pytest
+from src.benchmark import payload_chunks, PayloadStream, request_seeds, build_matrix
+from src.benchmark import run_case, compare_to_baseline, parse_size
+
+def test_payload_has_exact_size():
+    '''
+    Case where generated payloads are valid json of exactly the requested size
+    '''
+    for size in (64, 1000, 65536, 1024 * 1024 + 7):
+        body = b''.join(payload_chunks(size, seed=42, chunk_size=1000))
+        assert len(body) == size
+        assert json.loads(body)[0]['id'] == '42-0'
+
+def test_payload_stream_is_repeatable():
+    '''
+    Case where the same seed produces the same body, read in any chunk size
+    '''
+    first = PayloadStream(5000, seed=7).read()
+    stream = PayloadStream(5000, seed=7)
+    second = b''.join(iter(lambda: stream.read(333), b''))
+    assert first == second
+    assert first != PayloadStream(5000, seed=8).read()
+
+def test_payload_too_small():
+    '''
+    Case where the requested size cannot hold a product
+    '''
+    with pytest.raises(ValueError):
+        list(payload_chunks(10, seed=1))
+
+def test_duplicate_ratio():
+    '''
+    Case where a fraction of the requests repeats earlier payloads
+    '''
+    seeds = request_seeds(1000, 0.3, random.Random(1))
+    duplicates = len(seeds) - len(set(seeds))
+    assert 250 < duplicates < 350
+    assert request_seeds(10, 0, random.Random(1)) == list(range(10))
+
+def test_parse_size():
+    '''
+    Case where sizes are given with unit suffixes
+    '''
+    assert parse_size('512') == 512
+    assert parse_size('64K') == 64 * 1024
+    assert parse_size('1.5M') == 3 * 512 * 1024
+    assert parse_size('1GB') == 1024 ** 3
+
+def test_matrix_respects_byte_budget():
+    '''
+    Case where large bodies get fewer requests
+    '''
+    cases = build_matrix(['asgi'], [1024, 16 * 1024 * 1024], [1, 64], 200, 64 * 1024 * 1024, 0.2, 1)
+    assert [case['requests'] for case in cases] == [200, 200, 4, 4]
+
+@pytest.mark.parametrize('mode', ['flask', 'flask-stream', 'asgi'])
+def test_run_case(mode):
+    '''
+    Case where a small case runs against the in-memory stand-ins
+    '''
+    case = {'mode': mode, 'size': 2048, 'concurrency': 4, 'requests': 40, 'duplicates': 0.25, 'seed': 3}
+    result = run_case(case)
+
+    unique = len(set(request_seeds(40, 0.25, random.Random(3))))
+    assert result['statuses'] == {'200': unique, '403': 40 - unique}
+    assert result['published'] == unique
+    assert result['redis_ops_per_request'] == 1.0
+    assert result['p99_ms'] >= result['p50_ms'] > 0
+    assert result['peak_rss_mb'] > 0
+
+def test_compare_to_baseline():
+    '''
+    Case where a slower or heavier case is reported as a regression
+    '''
+    baseline = {'cases': [{'mode': 'asgi', 'size': 1024, 'concurrency': 1, 'p50_ms': 1.0, 'p99_ms': 2.0,
+                           'requests_per_second': 1000, 'peak_rss_mb': 40, 'redis_ops_per_request': 1.0}]}
+    same = dict(baseline['cases'][0], p50_ms=1.1)
+    slower = dict(baseline['cases'][0], p99_ms=3.0, requests_per_second=500)
+
+    assert compare_to_baseline([same], baseline, 0.25) == []
+    assert len(compare_to_baseline([slower], baseline, 0.25)) == 2
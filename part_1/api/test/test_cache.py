@@ -0,0 +1,105 @@
+import mock
+from src.cache import DedupCache, NearCache, HashRing, ShardedDedupCache, CLAIM_SCRIPT
+
+def test_claim_runs_single_script():
+    '''
+    Case where a fingerprint is claimed with one script call
+    '''
+    client = mock.Mock()
+    script = client.register_script.return_value
+    script.return_value = None
+    cache = DedupCache(client)
+
+    assert cache.claim('abc', 600) is None
+    client.register_script.assert_called_once_with(CLAIM_SCRIPT)
+    script.assert_called_once_with(keys=['abc'], args=[bin(1), 600])
+
+def test_claim_returns_remaining_ttl():
+    '''
+    Case where the fingerprint is already stored
+    '''
+    client = mock.Mock()
+    client.register_script.return_value.return_value = 1500
+    assert DedupCache(client).claim('abc', 600) == 1500
+
+@mock.patch('src.cache.time.monotonic')
+def test_near_cache_expires_entries(mock_time):
+    '''
+    Case where an entry is only kept until its deadline
+    '''
+    mock_time.return_value = 100
+    near_cache = NearCache(10)
+    near_cache.add('abc', 5)
+    assert 'abc' in near_cache
+
+    mock_time.return_value = 105
+    assert 'abc' not in near_cache
+    assert len(near_cache) == 0
+
+def test_near_cache_evicts_least_recently_seen():
+    '''
+    Case where the near cache is full
+    '''
+    near_cache = NearCache(2)
+    near_cache.add('a', 60)
+    near_cache.add('b', 60)
+    assert 'a' in near_cache
+    near_cache.add('c', 60)
+
+    assert 'a' in near_cache
+    assert 'b' not in near_cache
+    assert 'c' in near_cache
+
+def test_near_cache_ignores_entries_without_ttl():
+    '''
+    Case where the stored fingerprint has no remaining ttl
+    '''
+    near_cache = NearCache(2)
+    near_cache.add('a', -0.001)
+    assert 'a' not in near_cache
+
+def test_ring_spreads_keys_over_nodes():
+    '''
+    Case where keys are distributed over several nodes
+    '''
+    nodes = ['redis://a:6379', 'redis://b:6379', 'redis://c:6379']
+    ring = HashRing(nodes)
+    owners = [ring.get_node(f'key-{index}') for index in range(3000)]
+
+    for node in nodes:
+        assert 700 < owners.count(node) < 1300
+
+def test_ring_does_not_depend_on_node_order():
+    '''
+    Case where api instances list the same endpoints in different order
+    '''
+    first = HashRing(['redis://a:6379', 'redis://b:6379'])
+    second = HashRing(['redis://b:6379', 'redis://a:6379'])
+    assert all(first.get_node(f'key-{index}') == second.get_node(f'key-{index}')
+               for index in range(500))
+
+def test_ring_moves_only_keys_of_new_node():
+    '''
+    Case where a node is added to the ring
+    '''
+    before = HashRing(['redis://a:6379', 'redis://b:6379', 'redis://c:6379'])
+    after = HashRing(['redis://a:6379', 'redis://b:6379', 'redis://c:6379', 'redis://d:6379'])
+    keys = [f'key-{index}' for index in range(4000)]
+    moved = [key for key in keys if before.get_node(key) != after.get_node(key)]
+
+    assert all(after.get_node(key) == 'redis://d:6379' for key in moved)
+    assert len(moved) < len(keys) * 0.35
+
+@mock.patch('src.cache.redis.Redis')
+def test_sharded_cache_claims_in_owner_shard(mock_redis):
+    '''
+    Case where a fingerprint is claimed in the shard that owns it
+    '''
+    cache = ShardedDedupCache(['redis://a:6379', 'redis://b:6379'], max_connections=10)
+    owner = cache.ring.get_node('abc')
+    for endpoint, shard in cache.shards.items():
+        shard._claim = mock.Mock(return_value=None)
+
+    assert cache.claim('abc', 600) is None
+    cache.shards[owner]._claim.assert_called_once_with(keys=['abc'], args=[bin(1), 600])
+    assert all(not shard._claim.called for endpoint, shard in cache.shards.items() if endpoint != owner)
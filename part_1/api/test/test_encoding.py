@@ -0,0 +1,150 @@
+import io
+import gzip
+import zlib
+import pytest
+import asyncio
+import tracemalloc
+import zstandard
+from src.encoding import get_decoder, DecodingReader, AsyncDecodingReader, UnsupportedEncoding
+from src.encoding import DecodedSizeExceeded
+
+BODY = b'[' + b','.join(b'{"id": "%d", "name": "mesa"}' % index for index in range(2000)) + b']'
+
+def read_all(reader, size=1000):
+    chunks = []
+    chunk = reader.read(size)
+    while chunk:
+        assert len(chunk) <= size
+        chunks.append(chunk)
+        chunk = reader.read(size)
+    return b''.join(chunks)
+
+def test_gzip_body_is_decoded_in_bounded_chunks():
+    '''
+    Case where a gzip body is read in small chunks
+    '''
+    reader = DecodingReader(io.BytesIO(gzip.compress(BODY)), get_decoder('gzip'), chunk_size=256)
+    assert read_all(reader) == BODY
+
+def test_gzip_body_with_several_members():
+    '''
+    Case where the gzip body was built by concatenating members
+    '''
+    compressed = gzip.compress(BODY[:5000]) + gzip.compress(BODY[5000:])
+    reader = DecodingReader(io.BytesIO(compressed), get_decoder('GZIP'), chunk_size=512)
+    assert read_all(reader) == BODY
+
+def test_truncated_gzip_body():
+    '''
+    Case where the gzip body ends before its trailer
+    '''
+    reader = DecodingReader(io.BytesIO(gzip.compress(BODY)[:-20]), get_decoder('gzip'))
+    with pytest.raises(ValueError):
+        reader.read()
+
+def test_invalid_gzip_body():
+    '''
+    Case where the body is not gzip at all
+    '''
+    reader = DecodingReader(io.BytesIO(BODY), get_decoder('gzip'))
+    with pytest.raises(zlib.error):
+        reader.read()
+
+def test_zstd_body():
+    '''
+    Case where a zstd body is read in small chunks
+    '''
+    compressed = zstandard.ZstdCompressor().compress(BODY)
+    reader = DecodingReader(io.BytesIO(compressed), get_decoder('zstd'), chunk_size=256)
+    assert read_all(reader) == BODY
+
+def test_zstd_body_with_several_frames():
+    '''
+    Case where the zstd body was built by concatenating frames, one of them skippable
+    '''
+    compressor = zstandard.ZstdCompressor(write_checksum=True)
+    compressed = (compressor.compress(BODY[:5000]) + b'\x50\x2a\x4d\x18\x03\x00\x00\x00abc'
+                  + compressor.compress(BODY[5000:]))
+    reader = DecodingReader(io.BytesIO(compressed), get_decoder('zstd'), chunk_size=7)
+    assert read_all(reader) == BODY
+
+def test_zstd_bomb_is_decoded_in_bounded_chunks():
+    '''
+    Case where a few KB of zstd expand to 200 MB: memory stays bounded while it is read
+    '''
+    compressor = zstandard.ZstdCompressor(level=19).compressobj()
+    compressed = b''.join(compressor.compress(b'\0' * 1024 * 1024) for _ in range(200)) + compressor.flush()
+    assert len(compressed) < 16 * 1024
+
+    tracemalloc.start()
+    try:
+        reader = DecodingReader(io.BytesIO(compressed), get_decoder('zstd'), chunk_size=65536)
+        while reader.read(65536):
+            pass
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    assert peak < 4 * 1024 * 1024
+
+def test_truncated_zstd_body():
+    '''
+    Case where the zstd body ends before its last block
+    '''
+    compressed = zstandard.ZstdCompressor().compress(BODY)
+    reader = DecodingReader(io.BytesIO(compressed[:-10]), get_decoder('zstd'))
+    with pytest.raises(ValueError):
+        reader.read()
+
+def test_invalid_zstd_body():
+    '''
+    Case where the body is not zstd at all
+    '''
+    reader = DecodingReader(io.BytesIO(BODY), get_decoder('zstd'))
+    with pytest.raises(ValueError):
+        reader.read()
+
+def test_decoded_size_is_limited():
+    '''
+    Case where the decoded content goes past the limit, reading in small or large chunks
+    '''
+    body = gzip.compress(b'0' * 1024 * 1024)
+    reader = DecodingReader(io.BytesIO(body), get_decoder('gzip'), chunk_size=4096, max_size=100 * 1024)
+    with pytest.raises(DecodedSizeExceeded):
+        while reader.read(1000):
+            pass
+    assert reader.decoded <= 100 * 1024 + 4096
+
+    reader = DecodingReader(io.BytesIO(body), get_decoder('gzip'), max_size=1024 * 1024)
+    assert len(reader.read()) == 1024 * 1024
+
+def test_unsupported_encoding():
+    '''
+    Case where the body uses an unknown encoding
+    '''
+    with pytest.raises(UnsupportedEncoding):
+        get_decoder('br')
+
+def test_async_reader_copies_decoded_content():
+    '''
+    Case where a gzip body is decoded from an async stream into a sink
+    '''
+    class AsyncStream:
+        def __init__(self, data):
+            self.data = io.BytesIO(data)
+        async def read(self, size=-1):
+            return self.data.read(size)
+
+    sink = io.BytesIO()
+    reader = AsyncDecodingReader(AsyncStream(gzip.compress(BODY)), get_decoder('gzip'), 128, sink)
+
+    async def consume():
+        while await reader.read(700):
+            pass
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(consume())
+    finally:
+        loop.close()
+    assert sink.getvalue() == BODY
+    assert reader.bytes_read == len(BODY)
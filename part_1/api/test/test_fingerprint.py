@@ -0,0 +1,73 @@
+import io
+import pytest
+from src.fingerprint import canonical_fingerprint, CanonicalHasher, TeeReader
+
+def fingerprint(body):
+    return canonical_fingerprint(io.BytesIO(body), chunk_size=4)
+
+def test_whitespace_does_not_change_fingerprint():
+    '''
+    Case where the same document is sent with different formatting
+    '''
+    compact = b'[{"id":"123","name":"mesa"}]'
+    spaced = b'\n[ { "id" : "123" ,\n  "name" : "mesa" } ]\n'
+    assert fingerprint(compact) == fingerprint(spaced)
+
+def test_key_order_does_not_change_fingerprint():
+    '''
+    Case where the same object is sent with its keys in another order
+    '''
+    first = b'[{"id": "123", "name": "mesa", "tags": {"a": 1, "b": [1, 2]}}]'
+    second = b'[{"tags": {"b": [1, 2], "a": 1}, "name": "mesa", "id": "123"}]'
+    assert fingerprint(first) == fingerprint(second)
+
+def test_escapes_and_numbers_are_canonical():
+    '''
+    Case where strings are escaped and numbers are written in different notations
+    '''
+    first = b'{"name": "mesa", "price": 10}'
+    second = b'{"name": "\\u006desa", "price": 1.0e1}'
+    assert fingerprint(first) == fingerprint(second)
+
+def test_different_content_changes_fingerprint():
+    '''
+    Case where array order, values or types differ
+    '''
+    bodies = [b'[1, 2]', b'[2, 1]', b'["1", 2]', b'{"a": [1, 2]}', b'{"b": [1, 2]}',
+              b'null', b'true', b'false', b'{}', b'[]', b'""']
+    assert len({fingerprint(body) for body in bodies}) == len(bodies)
+
+def test_members_are_not_mixed_between_objects():
+    '''
+    Case where objects hold the same (key, value) pairs split or paired differently
+    '''
+    bodies = [b'{"a": 1, "b": 2}', b'{"a": 2, "b": 1}', b'{"a": {"b": 1}, "c": 2}',
+              b'{"a": {"b": 1, "c": 2}}', b'[{"a": 1}, {"b": 2}]', b'[{"a": 1, "b": 2}, {}]',
+              b'{"a": 1, "a": 1}', b'{"a": 1}']
+    assert len({fingerprint(body) for body in bodies}) == len(bodies)
+
+def test_incomplete_document():
+    '''
+    Case where the stream ends before the document is complete
+    '''
+    with pytest.raises(Exception):
+        fingerprint(b'[{"id": "123"')
+
+def test_hasher_without_events():
+    '''
+    Case where no event was fed to the hasher
+    '''
+    with pytest.raises(ValueError):
+        CanonicalHasher().hexdigest()
+
+def test_tee_reader_copies_stream():
+    '''
+    Case where the stream is copied into a sink while it is read
+    '''
+    body = b'[{"id": "123", "name": "mesa"}]'
+    sink = io.BytesIO()
+    reader = TeeReader(io.BytesIO(body), sink)
+    canonical_fingerprint(reader, chunk_size=4)
+
+    assert sink.getvalue() == body
+    assert reader.bytes_read == len(body)
@@ -0,0 +1,91 @@
+import io
+import pytest
+import mock
+import src.metrics as metrics
+import src.asgi as asgi
+import src.standins as standins
+from src.app import app
+from src.compare import call_asgi
+
+@pytest.fixture
+def client():
+    '''
+    Flask app fixture
+    '''
+    app.testing = True
+    client = app.test_client()
+    yield client
+
+@pytest.fixture
+def enabled():
+    '''
+    Fresh metrics registry, disabled again after the test
+    '''
+    metrics.enable()
+    yield metrics.registry
+    metrics.disable()
+
+def test_metrics_route_disabled(client):
+    '''
+    Case where the metrics endpoint is requested with the instrumentation disabled
+    '''
+    result = client.get('/metrics')
+    assert result.status_code == 404
+
+def test_helpers_disabled():
+    '''
+    Case where the helpers are called with the instrumentation disabled
+    '''
+    stream = io.BytesIO(b'abc')
+    assert metrics.timed_reader(stream) is stream
+    with metrics.stage('cache'):
+        pass
+    metrics.count_cache('shared', 'hit')
+    assert metrics.now() == 0.0
+
+@mock.patch('src.routes.cache')
+def test_receive_product_instrumented(mock_cache, enabled, client):
+    '''
+    Case where a product is received with the instrumentation enabled
+    '''
+    mock_cache.claim.return_value = None
+    with mock.patch('src.routes.celery'), mock.patch('src.routes.near_cache', None):
+        result = client.post('/v1/products', json=[{'id': '123', 'name': 'mesa'}])
+    assert result.status_code == 200
+
+    for stage in ('body', 'parse', 'hash', 'cache', 'publish'):
+        assert enabled.get_sample_value('products_api_stage_seconds_count', {'stage': stage}) == 1
+    assert enabled.get_sample_value('products_api_payload_bytes_count') == 1
+    assert enabled.get_sample_value('products_api_cache_requests_total', {'tier': 'shared', 'result': 'miss'}) == 1
+    assert enabled.get_sample_value('products_api_responses_total', {'status': '200'}) == 1
+
+    result = client.get('/metrics')
+    assert result.status_code == 200
+    assert b'products_api_responses_total{status="200"} 1.0' in result.data
+
+def test_timed_reader(enabled):
+    '''
+    Case where the body read time is split from the parse/hash time
+    '''
+    reader = metrics.timed_reader(io.BytesIO(b'abc'))
+    started = metrics.now()
+    assert reader.read() == b'abc'
+    metrics.observe_read(reader, started)
+
+    assert enabled.get_sample_value('products_api_stage_seconds_count', {'stage': 'body'}) == 1
+    assert enabled.get_sample_value('products_api_stage_seconds_count', {'stage': 'parse_hash'}) == 1
+
+def test_asgi_instrumented(enabled):
+    '''
+    Case where the asyncio app receives a repeated product with the instrumentation enabled
+    '''
+    cache, publisher = standins.AsyncMemoryDedupCache(), standins.AsyncMemoryBroker()
+    with mock.patch('src.asgi.cache', cache), mock.patch('src.asgi.publisher', publisher), \
+            mock.patch('src.asgi.stream_ingest', True):
+        call_asgi(asgi.app, 'POST', '/v1/products', b'[{"id": "123"}]')
+        call_asgi(asgi.app, 'POST', '/v1/products', b'[{"id": "123"}]')
+
+    assert enabled.get_sample_value('products_api_stage_seconds_count', {'stage': 'body'}) == 2
+    assert enabled.get_sample_value('products_api_stage_seconds_count', {'stage': 'parse_hash'}) == 2
+    assert enabled.get_sample_value('products_api_cache_requests_total', {'tier': 'shared', 'result': 'hit'}) == 1
+    assert enabled.get_sample_value('products_api_responses_total', {'status': '403'}) == 1
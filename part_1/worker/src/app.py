@@ -1,9 +1,18 @@
 import os
+import json
+import ijson
+import hashlib
 import datetime
+import gridfs
 import src.settings as settings
+import src.storage as storage
+import src.metrics as metrics
 from celery import Celery
+from celery.signals import worker_init, worker_process_shutdown, task_prerun, task_postrun
 from celery.utils.log import get_task_logger
-from pymongo import MongoClient
+from celery_batches import Batches
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 
 # Celery worker defined in settings file
 app = Celery('challenge_part_1')
@@ -20,10 +29,46 @@ connection = MongoClient(
     password=settings.database_password
 )
 
+# Payload store written by the api (claim-check)
+store = storage.from_url(settings.payload_store) if settings.payload_store else None
+
+# Metrics exporter and task timing (no-ops when metrics are disabled)
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    metrics.start_exporter(settings.metrics_port)
+
+@worker_process_shutdown.connect
+def stop_metrics_process(pid=None, **kwargs):
+    metrics.process_dead(pid or os.getpid())
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    metrics.task_started(task_id)
+
+@task_postrun.connect
+def stop_task_timer(task_id=None, task=None, **kwargs):
+    metrics.task_finished(task_id, task.name)
+
+
 # Task definition
 @app.task(name='insert_into_database', bind=True, ignore_result=True)
-def insert_into_database(self, payload):
+def insert_into_database(self, payload=None, reference=None):
     try:
+        if settings.write_mode == 'products':
+            # Split the body into products and write only the changed ones
+            if reference is not None:
+                counts = upsert_from_store(reference)
+            else:
+                counts = upsert_products(payload if isinstance(payload, list) else [payload])
+            logger.info(f'Products successfully upserted: {counts[0]} changed, {counts[1]} unchanged')
+            return
+
+        if reference is not None:
+            # Body was left in the payload store, stream it into the database
+            inserted_id = insert_from_store(reference, self.request.id)
+            logger.info(f'Product successfully inserted with ID: {inserted_id}')
+            return
+
         # Add insertion datetime
         product = {
             'content': payload,
@@ -31,9 +76,255 @@ def insert_into_database(self, payload):
         }
         db = connection[settings.database_name]
         col = db[settings.database_collection]
-        result = col.insert_one(product)
+        with metrics.stage('insert_into_database', 'mongo'):
+            result = col.insert_one(product)
+        metrics.count_products('inserted')
         logger.info(f'Product successfully inserted with ID: {result.inserted_id}')
     except Exception as e:
-        # In case of error, retry after 5 minutes (maximum of 20 retries)  
+        # In case of error, retry after 5 minutes (maximum of 20 retries, failed batches included)
+        # Past the last retry the product is dropped
+        logger.error(f'Error message: {e}')
+        if self.request.retries >= settings.max_retries:
+            logger.error(f'Product dropped after {settings.max_retries} retries')
+            metrics.count_products('dropped')
+        else:
+            metrics.count_retry('insert_into_database')
+        raise self.retry(countdown=300, max_retries=settings.max_retries)
+
+
+# Batch mode: same messages as insert_into_database, written with a single insert_many.
+# Messages are only acknowledged after the batch was written (acks_late).
+@app.task(name='insert_many_into_database', base=Batches, flush_every=settings.batch_size,
+          flush_interval=settings.batch_interval, acks_late=True, ignore_result=True)
+def insert_many_into_database(requests):
+    insertion_datetime = datetime.datetime.now().strftime(settings.datetime_format)
+    batch = []
+    for request in requests:
+        payload = request.args[0] if request.args else request.kwargs.get('payload')
+        if request.kwargs.get('reference') is not None:
+            # Bodies left in the payload store are too large to be batched
+            send_to_retry_path(request, countdown=0, failed=False)
+            continue
+        batch.append((request, {'content': payload, 'insertion_datetime': insertion_datetime}))
+    if not batch:
+        return
+
+    failed = []
+    try:
+        if settings.write_mode == 'products':
+            # Upserts can be repeated safely, so the whole batch is retried on failure
+            failed = list(range(len(batch)))
+            products = []
+            for _, product in batch:
+                content = product['content']
+                products.extend(content if isinstance(content, list) else [content])
+            upsert_products(products)
+            failed = []
+        else:
+            db = connection[settings.database_name]
+            col = db[settings.database_collection]
+            with metrics.stage('insert_many_into_database', 'mongo'):
+                col.insert_many([product for _, product in batch], ordered=False)
+    except BulkWriteError as e:
+        if settings.write_mode == 'products':
+            # writeErrors index upsert operations, not requests: the whole batch is retried
+            failed = list(range(len(batch)))
+            logger.error(f'Error message: {len(e.details["writeErrors"])} products not upserted in batch')
+        else:
+            # Unordered insert: only the documents listed in writeErrors were not written
+            failed = sorted({error['index'] for error in e.details['writeErrors']})
+            logger.error(f'Error message: {len(failed)} products not inserted in batch')
+    except Exception as e:
+        failed = list(range(len(batch)))
         logger.error(f'Error message: {e}')
-        raise self.retry(countdown=300, max_retries=20)
+
+    # Failed documents go back, one by one, to the retry path of insert_into_database
+    for index in failed:
+        send_to_retry_path(batch[index][0])
+    metrics.count_retry('insert_many_into_database', len(failed))
+    if settings.write_mode != 'products':
+        metrics.count_products('inserted', len(batch) - len(failed))
+    logger.info(f'{len(batch) - len(failed)} products successfully inserted in batch')
+
+
+def upsert_products(products):
+    '''
+    Upsert products keyed by id, skipping the ones whose content hash did not change.
+    Products without an id cannot be upserted, they are rejected (and counted).
+    Return the number of changed and unchanged products.
+    '''
+    col = products_collection()
+    update_datetime = datetime.datetime.now().strftime(settings.datetime_format)
+    changed = unchanged = rejected = 0
+    for chunk in chunks(products, settings.upsert_chunk_size):
+        # Last occurrence of an id wins
+        latest = {}
+        for product in chunk:
+            if not isinstance(product, dict) or 'id' not in product:
+                rejected += 1
+                continue
+            latest[product['id']] = (product, product_hash(product))
+        if not latest:
+            continue
+
+        # Covered by the (id, hash) index
+        with metrics.stage('upsert_products', 'mongo_find'):
+            stored = {
+                doc['id']: doc['hash']
+                for doc in col.find({'id': {'$in': list(latest)}}, {'_id': 0, 'id': 1, 'hash': 1})
+            }
+        operations = [
+            UpdateOne(
+                {'id': product_id},
+                {'$set': {'content': product, 'hash': digest, 'update_datetime': update_datetime}},
+                upsert=True
+            )
+            for product_id, (product, digest) in latest.items()
+            if stored.get(product_id) != digest
+        ]
+        if operations:
+            with metrics.stage('upsert_products', 'mongo_write'):
+                col.bulk_write(operations, ordered=False)
+        changed += len(operations)
+        unchanged += len(latest) - len(operations)
+    if rejected:
+        logger.warning(f'{rejected} products without id rejected')
+    metrics.count_products('changed', changed)
+    metrics.count_products('unchanged', unchanged)
+    metrics.count_products('rejected', rejected)
+    return changed, unchanged
+
+
+def upsert_from_store(reference):
+    '''
+    Stream the products of a stored body into upsert_products and delete it from the store
+    '''
+    key = blob_key(reference)
+    source = open_blob(key)
+    with source:
+        counts = upsert_products(stored_products(source))
+    store.delete(key)
+    return counts
+
+
+def stored_products(source):
+    '''
+    Products of a stored body: the items of a top-level array, streamed,
+    or the body itself, as the inline path does for a body that is not a list
+    '''
+    first = b''
+    while not first:
+        chunk = source.read(1024)
+        if not chunk:
+            break
+        first = chunk.lstrip()[:1]
+    source.seek(0)
+    if first == b'[':
+        return ijson.items(source, 'item', use_float=True)
+    return [json.load(source)]
+
+
+# Index used to find the stored hash of each product, and unique index keeping
+# concurrent upserts of a new id from inserting it twice (documents of the
+# 'document' write mode have no id). Both are created by the first task of each
+# process that needs them: while mongo is unreachable (or the unique index cannot be
+# built) that task fails and is retried like any other write.
+# A collection that already holds several documents with the same id (written before
+# the unique index existed) must be deduplicated first, keeping one document per id.
+products_index_created = False
+
+def products_collection():
+    global products_index_created
+    col = connection[settings.database_name][settings.database_collection]
+    if not products_index_created:
+        col.create_index([('id', 1), ('hash', 1)])
+        col.create_index([('id', 1)], unique=True, partialFilterExpression={'id': {'$exists': True}})
+        products_index_created = True
+    return col
+
+
+def product_hash(product):
+    content = json.dumps(product, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def chunks(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class PayloadNotFound(Exception):
+    '''
+    Raised when the body of a reference is not in the payload store (yet), so the task is retried
+    '''
+
+
+def blob_key(reference):
+    # References published before each accepted body got its own blob only have the fingerprint
+    return reference.get('key', reference['fingerprint'])
+
+
+def open_blob(key):
+    try:
+        return store.open(key)
+    except FileNotFoundError:
+        raise PayloadNotFound(f'Payload not found in store: {key}')
+
+
+def send_to_retry_path(request, countdown=300, failed=True):
+    '''
+    Publish the message of a batch request to insert_into_database. A failed batch counts
+    as the first retry, carried in the retries of the new message, so insert_into_database
+    goes on counting from there and stops at max_retries.
+    '''
+    # Messages sent to the batch task are always first attempts (the api sends them with no retries)
+    insert_into_database.apply_async(args=request.args, kwargs=request.kwargs, countdown=countdown,
+                                     retries=1 if failed else 0)
+
+
+def insert_from_store(reference, file_id):
+    '''
+    Stream a stored body into GridFS, reference it from the product collection
+    and delete it from the store. Every step can be repeated safely on retries.
+    '''
+    fingerprint = reference['fingerprint']
+    key = blob_key(reference)
+    db = connection[settings.database_name]
+    col = db[settings.database_collection]
+    try:
+        source = open_blob(key)
+    except PayloadNotFound:
+        # A previous attempt may have stored the product and deleted the body before failing
+        if col.find_one({'_id': file_id}, {'_id': 1}) is not None:
+            return file_id
+        raise
+
+    bucket = gridfs.GridFSBucket(db, bucket_name=settings.payload_bucket)
+    with source, metrics.stage('insert_into_database', 'gridfs'):
+        # Drop what a previous attempt may have left behind
+        try:
+            bucket.delete(file_id)
+        except gridfs.errors.NoFile:
+            pass
+        bucket.upload_from_stream_with_id(file_id, fingerprint, source,
+                                          metadata={'fingerprint': fingerprint})
+
+    product = {
+        'content_file_id': file_id,
+        'fingerprint': fingerprint,
+        'size': reference.get('size'),
+        'insertion_datetime': datetime.datetime.now().strftime(settings.datetime_format)
+    }
+    with metrics.stage('insert_into_database', 'mongo'):
+        col.replace_one({'_id': file_id}, product, upsert=True)
+    metrics.count_products('inserted')
+
+    # Only now the body is durable in the database
+    store.delete(key)
+    return file_id
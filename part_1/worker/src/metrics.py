@@ -0,0 +1,117 @@
+import os
+import time
+import src.settings as settings
+
+# Task instrumentation, exported in Prometheus format by an http server started with the worker.
+# With a prefork pool, set PROMETHEUS_MULTIPROC_DIR so the values of every child process are merged.
+# When disabled, every helper returns right away and prometheus_client is not even imported.
+enabled = False
+registry = None
+
+# Start time of the running tasks, by task id
+_started = {}
+
+
+def enable():
+    '''
+    Create the metrics in a registry of their own and turn the instrumentation on
+    '''
+    global enabled, registry, prometheus_client, TASK_SECONDS, STAGE_SECONDS, PRODUCTS, RETRIES
+    import prometheus_client
+
+    registry = prometheus_client.CollectorRegistry()
+    TASK_SECONDS = prometheus_client.Histogram(
+        'products_worker_task_seconds',
+        'Total run time of each task',
+        ['task'],
+        registry=registry
+    )
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'products_worker_stage_seconds',
+        'Time spent in each stage of a task',
+        ['task', 'stage'],
+        registry=registry
+    )
+    PRODUCTS = prometheus_client.Counter(
+        'products_worker_products_total',
+        'Products written by the worker, by result',
+        ['result'],
+        registry=registry
+    )
+    RETRIES = prometheus_client.Counter(
+        'products_worker_retries_total',
+        'Products sent back to the retry path',
+        ['task'],
+        registry=registry
+    )
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+if settings.metrics_enabled:
+    enable()
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+def stage(task, name):
+    '''
+    Context manager timing one stage of a task
+    '''
+    if not enabled:
+        return _null_timer
+    return STAGE_SECONDS.labels(task, name).time()
+
+
+def count_products(result, amount=1):
+    if enabled and amount:
+        PRODUCTS.labels(result).inc(amount)
+
+
+def count_retry(task, amount=1):
+    if enabled and amount:
+        RETRIES.labels(task).inc(amount)
+
+
+def task_started(task_id):
+    if enabled:
+        _started[task_id] = time.monotonic()
+
+
+def task_finished(task_id, task):
+    if enabled:
+        started = _started.pop(task_id, None)
+        if started is not None:
+            TASK_SECONDS.labels(task).observe(time.monotonic() - started)
+
+
+def start_exporter(port):
+    '''
+    Serve the metrics of the worker (of all its child processes in multiprocess mode)
+    '''
+    if not enabled:
+        return
+    exported = registry
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        exported = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(exported)
+    prometheus_client.start_http_server(port, registry=exported)
+
+
+def process_dead(pid):
+    if enabled and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
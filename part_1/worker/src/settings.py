@@ -1,4 +1,5 @@
 import os
+import math
 
 # Broker config
 broker_url = os.environ.get('BROKER_ENDPOINT')
@@ -7,15 +8,39 @@ broker_url = os.environ.get('BROKER_ENDPOINT')
 timezone = 'America/Sao_Paulo'
 enable_utc = True
 task_serializer = 'json'
+task_compression = os.environ.get('BROKER_COMPRESSION') or None
 
 # Assign queue to task
 task_routes = {
     'insert_into_database':
+        {
+            'queue': os.environ.get('QUEUE')
+        },
+    'insert_many_into_database':
         {
             'queue': os.environ.get('QUEUE')
         }
 }
 
+# Retries of a product (5 minutes apart) before it is dropped, also counting failed batches
+max_retries = int(os.environ.get('MAX_RETRIES', 20))
+
+# Batch mode config (flush after batch_size messages or batch_interval seconds)
+batch_size = int(os.environ.get('BATCH_SIZE', 500))
+batch_interval = float(os.environ.get('BATCH_INTERVAL', 0.2))
+
+# Worker processes (celery's default is one per cpu)
+worker_concurrency = int(os.environ.get('WORKER_CONCURRENCY') or 0) or os.cpu_count() or 1
+
+# Batch mode: the messages of a batch stay unacknowledged until it is written (acks_late) and
+# a worker holds at most prefetch_multiplier * concurrency of them, so unless it is set, the
+# prefetch window holds a whole batch (a smaller one only lets batches flush on the timer)
+prefetch_multiplier = os.environ.get('PREFETCH_MULTIPLIER')
+if prefetch_multiplier:
+    worker_prefetch_multiplier = int(prefetch_multiplier)
+else:
+    worker_prefetch_multiplier = max(4, math.ceil(batch_size / worker_concurrency))
+
 # Database config
 database_url =  os.environ.get('DATABASE_ENDPOINT')
 database_user = os.environ.get('DATABASE_USER')
@@ -23,5 +48,18 @@ database_password = os.environ.get('DATABASE_PASSWORD')
 database_name = os.environ.get('DATABASE')
 database_collection = os.environ.get('COLLECTION')
 
+# Write mode: 'document' stores each body as one document,
+# 'products' upserts every product of the body, keyed by its id, when it changed
+write_mode = os.environ.get('WRITE_MODE', 'document')
+upsert_chunk_size = int(os.environ.get('UPSERT_CHUNK_SIZE', 1000))
+
+# Payload store shared with the api (claim-check) and GridFS bucket for its bodies
+payload_store = os.environ.get('PAYLOAD_STORE')
+payload_bucket = os.environ.get('PAYLOAD_BUCKET', 'payloads')
+
+# Metrics exporter (started with the worker when enabled)
+metrics_enabled = os.environ.get('METRICS_ENABLED') == 'True'
+metrics_port = int(os.environ.get('METRICS_PORT', 9100))
+
 # Datetime format
 datetime_format = '%Y-%m-%d %H:%M:%S'
\ No newline at end of file
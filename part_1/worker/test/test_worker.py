@@ -1,8 +1,13 @@
+import importlib
+import io
 import pytest
 import mock
 import src.settings as settings
+import src.metrics as metrics
 from celery.exceptions import Retry
-from src.app import insert_into_database
+from pymongo.errors import BulkWriteError
+from src.app import insert_into_database, insert_from_store, insert_many_into_database
+from src.app import upsert_products, upsert_from_store, product_hash, products_collection
 
 class TestInsertIntoDatabase:
 
@@ -42,6 +47,23 @@ class TestInsertIntoDatabase:
         mock_logger.error.assert_called_once_with(f'Error message: {exc}')
         mock_retry.assert_called_once_with(countdown=300, max_retries=20)
 
+    @mock.patch('src.app.metrics')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_product_dropped_after_last_retry(self, mock_logger, mock_db, mock_metrics):
+        '''
+        Case where the last retry of a product fails (a failed batch counts as its first retry)
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.insert_one.side_effect = Exception('Document failed validation')
+
+        result = insert_into_database.apply(args=([{'id': '123'}],), retries=20)
+
+        assert result.failed()
+        mock_metrics.count_products.assert_called_once_with('dropped')
+        mock_metrics.count_retry.assert_not_called()
+        mock_logger.error.assert_called_with('Product dropped after 20 retries')
+
     @mock.patch('src.app.datetime.datetime')
     @mock.patch('src.app.connection')
     @mock.patch('src.app.logger')
@@ -74,3 +96,410 @@ class TestInsertIntoDatabase:
         mock_logger.info.assert_called_once_with(
             f'Product successfully inserted with ID: {id_database}'
         )
+
+
+class TestInsertFromStore:
+
+    @mock.patch('src.app.datetime.datetime')
+    @mock.patch('src.app.gridfs.GridFSBucket')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.store')
+    def test_success_case(self, mock_store, mock_db, mock_bucket, mock_datetime):
+        '''
+        Case where the stored body is streamed into GridFS and then deleted from the store
+        '''
+        settings.database_name = 'test_database'
+        settings.database_collection = 'test_collection'
+        mock_db.__getitem__.return_value = mock_db
+        source = mock_store.open.return_value
+        reference = {'fingerprint': 'abc123', 'key': 'abc123-1', 'size': 42}
+        frozen_time = '2019-02-20 18:30:15'
+        class CustomizedDateTime:
+            def strftime(self, format):
+                return frozen_time
+        mock_datetime.now.return_value = CustomizedDateTime()
+
+        result = insert_from_store(reference, 'task-id')
+
+        assert result == 'task-id'
+        mock_store.open.assert_called_once_with('abc123-1')
+        mock_bucket.return_value.upload_from_stream_with_id.assert_called_once_with(
+            'task-id', 'abc123', source, metadata={'fingerprint': 'abc123'}
+        )
+        mock_db.replace_one.assert_called_once_with({'_id': 'task-id'}, {
+            'content_file_id': 'task-id',
+            'fingerprint': 'abc123',
+            'size': 42,
+            'insertion_datetime': frozen_time
+        }, upsert=True)
+        mock_store.delete.assert_called_once_with('abc123-1')
+
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.store')
+    def test_failure_in_database_keeps_payload(self, mock_store, mock_db):
+        '''
+        Case where the database fails and the body must stay in the store for the retry
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.replace_one.side_effect = Exception('Failure in db connection')
+
+        with mock.patch('src.app.gridfs.GridFSBucket'):
+            with pytest.raises(Exception):
+                insert_from_store({'fingerprint': 'abc123', 'size': 42}, 'task-id')
+        mock_store.delete.assert_not_called()
+
+    @mock.patch('src.app.insert_into_database.retry')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.store')
+    @mock.patch('src.app.logger')
+    def test_payload_not_in_store(self, mock_logger, mock_store, mock_db, mock_retry):
+        '''
+        Case where the referenced body is missing and the product was not stored: the task is retried
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.find_one.return_value = None
+        mock_store.open.side_effect = FileNotFoundError()
+        mock_retry.side_effect = Retry()
+
+        with pytest.raises(Retry):
+            insert_into_database(reference={'fingerprint': 'abc123', 'key': 'abc123-1', 'size': 42})
+        mock_logger.error.assert_called_once_with('Error message: Payload not found in store: abc123-1')
+        mock_retry.assert_called_once_with(countdown=300, max_retries=20)
+
+    @mock.patch('src.app.gridfs.GridFSBucket')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.store')
+    def test_payload_consumed_by_previous_attempt(self, mock_store, mock_db, mock_bucket):
+        '''
+        Case where a previous attempt stored the product and deleted the body before failing
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.find_one.return_value = {'_id': 'task-id'}
+        mock_store.open.side_effect = FileNotFoundError()
+
+        assert insert_from_store({'fingerprint': 'abc123', 'key': 'abc123-1', 'size': 42}, 'task-id') == 'task-id'
+        mock_db.find_one.assert_called_once_with({'_id': 'task-id'}, {'_id': 1})
+        mock_bucket.return_value.upload_from_stream_with_id.assert_not_called()
+
+    @mock.patch('src.app.insert_into_database.retry')
+    @mock.patch('src.app.store')
+    def test_products_payload_not_in_store(self, mock_store, mock_retry):
+        '''
+        Case where the body of a products upsert is missing: the task is retried
+        '''
+        mock_store.open.side_effect = FileNotFoundError()
+        mock_retry.side_effect = Retry()
+
+        with mock.patch.object(settings, 'write_mode', 'products'):
+            with pytest.raises(Retry):
+                insert_into_database(reference={'fingerprint': 'abc123', 'key': 'abc123-1', 'size': 42})
+        mock_store.delete.assert_not_called()
+
+
+def batch_request(*args, **kwargs):
+    return mock.Mock(args=args, kwargs=kwargs)
+
+
+class TestInsertManyIntoDatabase:
+
+    @mock.patch('src.app.insert_into_database.apply_async')
+    @mock.patch('src.app.datetime.datetime')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_success_case(self, mock_logger, mock_db, mock_datetime, mock_apply):
+        '''
+        Case where a whole batch is written with a single insert_many
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        frozen_time = '2019-02-20 18:30:15'
+        class CustomizedDateTime:
+            def strftime(self, format):
+                return frozen_time
+        mock_datetime.now.return_value = CustomizedDateTime()
+        requests = [batch_request([{'id': '1'}]), batch_request(payload=[{'id': '2'}])]
+
+        insert_many_into_database(requests)
+
+        mock_db.insert_many.assert_called_once_with([
+            {'content': [{'id': '1'}], 'insertion_datetime': frozen_time},
+            {'content': [{'id': '2'}], 'insertion_datetime': frozen_time}
+        ], ordered=False)
+        mock_apply.assert_not_called()
+        mock_logger.info.assert_called_once_with('2 products successfully inserted in batch')
+
+    @mock.patch('src.app.insert_into_database.apply_async')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_failed_document_goes_to_retry_path(self, mock_logger, mock_db, mock_apply):
+        '''
+        Case where one document of the batch is rejected by the database
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.insert_many.side_effect = BulkWriteError({'writeErrors': [{'index': 1}]})
+        requests = [batch_request([{'id': '1'}]), batch_request([{'id': '2'}]), batch_request([{'id': '3'}])]
+
+        insert_many_into_database(requests)
+
+        mock_apply.assert_called_once_with(args=([{'id': '2'}],), kwargs={}, countdown=300, retries=1)
+        mock_logger.info.assert_called_once_with('2 products successfully inserted in batch')
+
+    @mock.patch('src.app.products_index_created', True)
+    @mock.patch('src.app.insert_into_database.apply_async')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_failed_upsert_retries_the_batch(self, mock_logger, mock_db, mock_apply):
+        '''
+        Case where an upsert operation fails: its index is not the index of a request,
+        so every request of the batch goes to the retry path
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.find.return_value = []
+        mock_db.bulk_write.side_effect = BulkWriteError({'writeErrors': [{'index': 7}]})
+        products = [{'id': str(number)} for number in range(8)]
+        requests = [batch_request(products[:4]), batch_request(products[4:])]
+
+        with mock.patch.object(settings, 'write_mode', 'products'):
+            insert_many_into_database(requests)
+
+        mock_apply.assert_has_calls([
+            mock.call(args=(products[:4],), kwargs={}, countdown=300, retries=1),
+            mock.call(args=(products[4:],), kwargs={}, countdown=300, retries=1)
+        ])
+        assert mock_apply.call_count == 2
+        mock_logger.error.assert_called_once_with('Error message: 1 products not upserted in batch')
+
+    @mock.patch('src.app.insert_into_database.apply_async')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_failure_in_database_connection(self, mock_logger, mock_db, mock_apply):
+        '''
+        Case where the whole batch fails and every document goes to the retry path
+        '''
+        exc = Exception('Failure in db connection')
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.insert_many.side_effect = exc
+        requests = [batch_request([{'id': '1'}]), batch_request([{'id': '2'}])]
+
+        insert_many_into_database(requests)
+
+        assert mock_apply.call_count == 2
+        mock_logger.error.assert_called_once_with(f'Error message: {exc}')
+
+    @mock.patch('src.app.insert_into_database.apply_async')
+    @mock.patch('src.app.connection')
+    def test_reference_is_not_batched(self, mock_db, mock_apply):
+        '''
+        Case where a message only carries a reference to the payload store
+        '''
+        reference = {'fingerprint': 'abc123', 'size': 42}
+
+        insert_many_into_database([batch_request(reference=reference)])
+
+        mock_apply.assert_called_once_with(args=(), kwargs={'reference': reference}, countdown=0, retries=0)
+        mock_db.insert_many.assert_not_called()
+
+
+class TestUpsertProducts:
+
+    @mock.patch('src.app.products_index_created', True)
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_only_changed_products_are_written(self, mock_logger, mock_db):
+        '''
+        Case where a body is resent with one changed and one new product
+        '''
+        settings.write_mode = 'products'
+        mock_db.__getitem__.return_value = mock_db
+        products = [{'id': '1', 'name': 'mesa'}, {'id': '2', 'name': 'cadeira'}, {'id': '3', 'name': 'sofa'}]
+        mock_db.find.return_value = [
+            {'id': '1', 'hash': product_hash(products[0])},
+            {'id': '2', 'hash': product_hash({'id': '2', 'name': 'banco'})}
+        ]
+        try:
+            insert_into_database(products)
+        finally:
+            settings.write_mode = 'document'
+
+        mock_db.find.assert_called_once_with(
+            {'id': {'$in': ['1', '2', '3']}}, {'_id': 0, 'id': 1, 'hash': 1}
+        )
+        operations = mock_db.bulk_write.call_args[0][0]
+        assert [operation._filter for operation in operations] == [{'id': '2'}, {'id': '3'}]
+        assert operations[0]._doc['$set']['hash'] == product_hash(products[1])
+        mock_db.insert_one.assert_not_called()
+        mock_logger.info.assert_called_once_with(
+            'Products successfully upserted: 2 changed, 1 unchanged'
+        )
+
+    @mock.patch('src.app.products_index_created', True)
+    @mock.patch('src.app.connection')
+    def test_unchanged_body_is_not_written(self, mock_db):
+        '''
+        Case where every product of the body is already stored with the same content
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        products = [{'id': '1', 'name': 'mesa'}, {'name': 'sem id'}]
+        mock_db.find.return_value = [{'id': '1', 'hash': product_hash(products[0])}]
+
+        assert upsert_products(products) == (0, 1)
+        mock_db.bulk_write.assert_not_called()
+
+    @mock.patch('src.app.products_index_created', True)
+    @mock.patch('src.app.metrics')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_products_without_id_are_rejected(self, mock_logger, mock_db, mock_metrics):
+        '''
+        Case where products without an id cannot be upserted: they are rejected and counted
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.find.return_value = []
+        products = [{'name': 'sem id'}, {'id': '1', 'name': 'mesa'}, 'mesa']
+
+        with mock.patch.object(settings, 'upsert_chunk_size', 1):
+            assert upsert_products(products) == (1, 0)
+
+        mock_db.find.assert_called_once()
+        mock_metrics.count_products.assert_any_call('rejected', 2)
+        mock_logger.warning.assert_called_once_with('2 products without id rejected')
+
+    @mock.patch('src.app.products_index_created', True)
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.store')
+    def test_products_streamed_from_store(self, mock_store, mock_db):
+        '''
+        Case where the products are read one by one from the payload store
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.find.return_value = []
+        mock_store.open.return_value = io.BytesIO(b'[{"id": "1", "price": 1.5}, {"id": "2"}]')
+
+        assert upsert_from_store({'fingerprint': 'abc123', 'size': 40}) == (2, 0)
+        operations = mock_db.bulk_write.call_args[0][0]
+        assert operations[0]._doc['$set']['content'] == {'id': '1', 'price': 1.5}
+        mock_store.delete.assert_called_once_with('abc123')
+
+    @mock.patch('src.app.products_index_created', True)
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.store')
+    def test_single_product_streamed_from_store(self, mock_store, mock_db):
+        '''
+        Case where the stored body is a single product, as accepted by the inline path
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.find.return_value = []
+        mock_store.open.return_value = io.BytesIO(b'  \n{"id": "1", "price": 1.5}')
+
+        assert upsert_from_store({'fingerprint': 'abc123', 'size': 30}) == (1, 0)
+        operations = mock_db.bulk_write.call_args[0][0]
+        assert operations[0]._doc['$set']['content'] == {'id': '1', 'price': 1.5}
+
+    @mock.patch('src.app.products_index_created', False)
+    @mock.patch('src.app.connection')
+    def test_unique_index_on_id(self, mock_db):
+        '''
+        Case where the first products task of a process creates the unique index on id, once
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        products_collection()
+        products_collection()
+
+        mock_db.create_index.assert_any_call([('id', 1)], unique=True,
+                                             partialFilterExpression={'id': {'$exists': True}})
+        assert mock_db.create_index.call_count == 2
+
+    @mock.patch('src.app.products_index_created', False)
+    @mock.patch('src.app.insert_into_database.retry')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_unreachable_database_when_creating_indexes(self, mock_logger, mock_db, mock_retry):
+        '''
+        Case where mongo is unreachable when the indexes are created: the task is retried
+        and the indexes are created again by the next task
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.create_index.side_effect = [Exception('No servers found'), None, None]
+        mock_db.find.return_value = []
+        mock_retry.side_effect = Retry()
+
+        with mock.patch.object(settings, 'write_mode', 'products'):
+            with pytest.raises(Retry):
+                insert_into_database([{'id': '1'}])
+            insert_into_database([{'id': '1'}])
+
+        assert mock_db.create_index.call_count == 3
+        mock_db.bulk_write.assert_called_once()
+
+    def test_product_hash_ignores_key_order(self):
+        '''
+        Case where the same product is sent with its keys in another order
+        '''
+        assert product_hash({'id': '1', 'name': 'mesa'}) == product_hash({'name': 'mesa', 'id': '1'})
+
+
+class TestMetrics:
+
+    def setup_method(self):
+        metrics.enable()
+
+    def teardown_method(self):
+        metrics.disable()
+
+    @mock.patch('src.app.insert_into_database.retry')
+    @mock.patch('src.app.connection')
+    @mock.patch('src.app.logger')
+    def test_retry_is_counted(self, mock_logger, mock_db, mock_retry):
+        '''
+        Case where a failed insertion is counted as a retry and its mongo time is observed
+        '''
+        mock_db.__getitem__.return_value = mock_db
+        mock_db.insert_one.side_effect = Exception('Failure in db connection')
+        mock_retry.side_effect = Retry()
+
+        with pytest.raises(Retry):
+            insert_into_database([{'id': '1'}])
+
+        labels = {'task': 'insert_into_database', 'stage': 'mongo'}
+        assert metrics.registry.get_sample_value('products_worker_stage_seconds_count', labels) == 1
+        assert metrics.registry.get_sample_value('products_worker_retries_total',
+                                                 {'task': 'insert_into_database'}) == 1
+
+    @mock.patch('src.app.products_collection')
+    def test_upserted_products_are_counted(self, mock_col):
+        '''
+        Case where changed and unchanged products are counted
+        '''
+        mock_col.return_value.find.return_value = [{'id': '1', 'hash': product_hash({'id': '1'})}]
+
+        upsert_products([{'id': '1'}, {'id': '2'}])
+
+        assert metrics.registry.get_sample_value('products_worker_products_total', {'result': 'changed'}) == 1
+        assert metrics.registry.get_sample_value('products_worker_products_total', {'result': 'unchanged'}) == 1
+
+    def test_task_time_is_observed(self):
+        '''
+        Case where the run time of a task is observed between the prerun and postrun signals
+        '''
+        metrics.task_started('task-1')
+        metrics.task_finished('task-1', 'insert_into_database')
+
+        assert metrics.registry.get_sample_value('products_worker_task_seconds_count',
+                                                 {'task': 'insert_into_database'}) == 1
+
+
+class TestSettings:
+
+    def test_prefetch_window_holds_a_batch(self):
+        '''
+        Case where the prefetch multiplier is derived from the batch size and the concurrency
+        '''
+        environ = {'BATCH_SIZE': '500', 'WORKER_CONCURRENCY': '4'}
+        try:
+            with mock.patch.dict('os.environ', environ):
+                importlib.reload(settings)
+                assert settings.worker_prefetch_multiplier * settings.worker_concurrency >= 500
+            with mock.patch.dict('os.environ', dict(environ, PREFETCH_MULTIPLIER='1')):
+                importlib.reload(settings)
+                assert settings.worker_prefetch_multiplier == 1
+        finally:
+            importlib.reload(settings)
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import shutil
+import asyncio
+import logging
+import datetime
+import aiohttp
+import parsing
+import verdicts
+
+# Single-process alternative to startup.py + workers + consolidate.py:
+# reads the dumps, checks the images of each product with a bounded number of
+# concurrent requests and writes the output dump directly (no broker or shared memory).
+# Only the requests needed to find 3 valid images per product are made.
+
+# Load parameters
+input_path = os.environ.get('INPUT_PATH')
+output_path = os.environ.get('OUTPUT_PATH')
+processed_path = os.environ.get('PROCESSED_PATH')
+image_server = os.environ.get('IMAGE_SERVER')
+concurrency = int(os.environ.get('AGGREGATE_CONCURRENCY', 100))
+max_attempts = int(os.environ.get('AGGREGATE_MAX_ATTEMPTS', 5))
+request_timeout = float(os.environ.get('AGGREGATE_TIMEOUT', 30))
+product_inflight = int(os.environ.get('AGGREGATE_PRODUCT_INFLIGHT', 3))
+verdict_store_url = os.environ.get('VERDICT_STORE')
+verdict_positive_ttl = int(os.environ.get('VERDICT_POSITIVE_TTL', 24 * 60 * 60))
+verdict_negative_ttl = int(os.environ.get('VERDICT_NEGATIVE_TTL', 60 * 60))
+verdict_store_batch = int(os.environ.get('VERDICT_STORE_BATCH', 500))
+
+# Maximum of 3 images per product
+max_images = 3
+
+
+def read_dump(path, products):
+    '''
+    Group the images of a dump by product, in dump order and without repetitions
+    '''
+    with parsing.open_dump(path) as input_file:
+        for line in input_file:
+            pair = parsing.parse_line(line)
+            if pair is None:
+                # Same lines startup.py counts as malformed
+                if line.strip():
+                    logging.error(f'Ignored line: {line[:200]!r}')
+                continue
+            product_id, image = pair
+            products.setdefault(product_id, {})[image] = None
+
+
+async def check_image(session, image):
+    '''
+    Return True when the image server has the image, False when it does not
+    and None when it kept failing
+    '''
+    url = image_server + image.split('/')[-1]
+    for attempt in range(max_attempts):
+        try:
+            async with session.get(url) as res:
+                if res.status == 200:
+                    return True
+                if res.status == 404:
+                    return False
+                msg = f'Unexpected response: {res.status}'
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            msg = f'{e!r}'
+        logging.error(f'{msg} - Image: {image}, attempt {attempt + 1} of {max_attempts}')
+        await asyncio.sleep(min(2 ** attempt, 30))
+    return None
+
+
+class ImageChecker:
+    '''
+    Checks images with at most `concurrency` requests in flight,
+    making a single request per image even when products share it
+    and none for images found in the verdict store.
+    The store is only used from the default executor, so its (blocking) calls
+    do not stall the event loop, and new verdicts are stored in batches.
+    '''
+    def __init__(self, session, store=None):
+        self.session = session
+        self.store = store
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.verdicts = {}
+        self.requests = 0
+        self.cached = 0
+        self.unstored = []
+
+    async def check(self, image):
+        verdict = self.verdicts.get(image)
+        if isinstance(verdict, asyncio.Future):
+            # Shielded, so a product giving up does not cancel the check for the others
+            return await asyncio.shield(verdict)
+        if image in self.verdicts:
+            return verdict
+        if self.store is not None:
+            verdict = await asyncio.get_event_loop().run_in_executor(None, self.store.get, image)
+            if image in self.verdicts:
+                # Checked for another product while the store was read
+                return await self.check(image)
+            if verdict is not None:
+                self.verdicts[image] = verdict
+                self.cached += 1
+                return verdict
+
+        future = asyncio.ensure_future(self._request(image))
+        self.verdicts[image] = future
+        verdict = await asyncio.shield(future)
+        self.verdicts[image] = verdict
+        return verdict
+
+    async def _request(self, image):
+        async with self.semaphore:
+            self.requests += 1
+            verdict = await check_image(self.session, image)
+        if verdict is not None and self.store is not None:
+            self.unstored.append((image, 200 if verdict else 404))
+            if len(self.unstored) >= verdict_store_batch:
+                await self.store_verdicts()
+        return verdict
+
+    async def store_verdicts(self):
+        '''
+        Store the new verdicts not stored yet
+        '''
+        items, self.unstored = self.unstored, []
+        if items:
+            await asyncio.get_event_loop().run_in_executor(None, self.store.put_many, items)
+
+
+async def verify_product(checker, images):
+    '''
+    Check the images of a product in dump order until max_images are valid.
+    Only as many checks as valid images are still missing are in flight,
+    so no check is started once the product is complete, and each invalid
+    image is replaced by the next candidate.
+    '''
+    candidates = iter(images)
+    valid = set()
+    inflight = {}
+    while True:
+        while len(inflight) < min(product_inflight, max_images - len(valid)):
+            image = next(candidates, None)
+            if image is None:
+                break
+            inflight[asyncio.ensure_future(checker.check(image))] = image
+        if not inflight:
+            break
+        done, _ = await asyncio.wait(list(inflight), return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.result():
+                valid.add(inflight[task])
+            del inflight[task]
+    return [image for image in images if image in valid][:max_images]
+
+
+async def verify_products(products, store=None):
+    '''
+    Verify every product, with at most `concurrency` products being verified at once
+    '''
+    results = {}
+    pending = iter(products.items())
+    timeout = aiohttp.ClientTimeout(total=request_timeout)
+    connector = aiohttp.TCPConnector(limit=concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        checker = ImageChecker(session, store)
+
+        async def worker():
+            # Workers share the iterator, so each product is taken exactly once
+            for product_id, images in pending:
+                results[product_id] = await verify_product(checker, list(images))
+
+        await asyncio.gather(*[worker() for _ in range(concurrency)])
+        if store is not None:
+            await checker.store_verdicts()
+    failed = {image for image, verdict in checker.verdicts.items() if verdict is None}
+    return results, checker.requests, checker.cached, failed
+
+
+def affected_products(products, results, failed):
+    '''
+    Products that may miss valid images because the check of one of their images kept failing
+    '''
+    return [
+        product_id for product_id, images in products.items()
+        if len(results[product_id]) < max_images and any(image in failed for image in images)
+    ]
+
+
+def write_output(products, results):
+    '''
+    Write the output dump in the same format as consolidate.py
+    '''
+    # Output is written to a hidden temporary file, renamed once complete
+    consolidation_datetime = datetime.datetime.now().strftime('%Y_%m_%d-%H_%M_%S')
+    filename = consolidation_datetime + '-output-dump'
+    temporary_path = os.path.join(output_path, f'.{filename}.tmp')
+    try:
+        with open(temporary_path, 'w') as output_file:
+            for product_id in products:
+                output_file.write(json.dumps(dict(productId=product_id, images=results[product_id])))
+                output_file.write('\n')
+        os.replace(temporary_path, os.path.join(output_path, filename))
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    return filename
+
+
+def main():
+    filenames = sorted(os.listdir(input_path))
+    products = {}
+    for filename in filenames:
+        read_dump(os.path.join(input_path, filename), products)
+
+    # Verdicts of previous runs (new ones are committed in batches when stored in sqlite)
+    store = None
+    if verdict_store_url:
+        store = verdicts.from_url(verdict_store_url, verdict_positive_ttl, verdict_negative_ttl,
+                                  commit_every=1000)
+
+    loop = asyncio.get_event_loop()
+    results, requests, cached, failed = loop.run_until_complete(verify_products(products, store))
+    if store is not None:
+        store.flush()
+
+    # The output would miss images of these products: no output is written and the dumps stay
+    # in the input folder, to be aggregated again (stored verdicts are not requested again)
+    affected = affected_products(products, results, failed)
+    if affected:
+        logging.error(f'{len(failed)} images kept failing, {len(affected)} products affected '
+                      f'(first ones: {", ".join(affected[:10])}), dumps left in {input_path}')
+        sys.exit(1)
+
+    filename = write_output(products, results)
+    candidates = sum(len(images) for images in products.values())
+    print(f'{filename}: {len(products)} products, {requests} images checked and {cached} cached '
+          f'out of {candidates} candidates, {len(failed)} failed')
+
+    # Move files to the processed folder
+    for filename in filenames:
+        shutil.move(os.path.join(input_path, filename), os.path.join(processed_path, filename))
+
+
+if __name__ == '__main__':
+    main()
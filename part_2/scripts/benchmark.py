@@ -0,0 +1,218 @@
+import os
+import sys
+import json
+import io
+import gzip
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+import generate_dumps
+from mock_server import MockServer, image_status
+
+# End to end benchmark of an engine turning input dumps into an output dump:
+# generates dumps, serves the images with mock_server.py and reports wall time,
+# lines per second, image requests per output product and wasted requests
+# (requests beyond the ones needed to find 3 valid images per product in dump order).
+#
+# Engines:
+#   aggregate  aggregate.py (single process, needs nothing else)
+#   pipeline   startup.py -> workers (verify_image) -> consolidate.py, needs the broker,
+#              shared memory and workers of docker-compose, with the workers' IMAGE_SERVER
+#              pointing at this mock (e.g. http://scripts:4567/images/, see --mock-url)
+#   --command  any other engine, run by the shell with the same environment
+#
+# Usage: python benchmark.py [--engine aggregate | --command "..."] [--products 10000 | --size 100M]
+#                            [--latency-ms 20] [--error-rate 0.01] [--json results.json]
+
+ENGINES = ('aggregate', 'pipeline')
+
+# Maximum of 3 images per product
+max_images = 3
+
+SCRIPTS = os.path.dirname(os.path.abspath(__file__))
+
+
+def image_name(image):
+    return image.split('/')[-1]
+
+
+def expected_results(paths):
+    '''
+    Return the valid images of each product and the image names that must be requested
+    to find max_images valid ones per product, checking images in dump order
+    '''
+    products = {}
+    for path in sorted(paths):
+        with open(path, 'r') as dump_file:
+            for line in dump_file:
+                payload = json.loads(line)
+                products.setdefault(payload['productId'], {})[payload['image']] = None
+
+    valid, needed = {}, set()
+    for product_id, images in products.items():
+        valid[product_id] = {image for image in images if image_status(image_name(image)) == 200}
+        found = 0
+        for image in images:
+            if found >= max_images:
+                break
+            needed.add(image_name(image))
+            found += image in valid[product_id]
+    return valid, needed
+
+
+def read_output(output_path):
+    '''
+    Return {productId: images} from the newest output dump (plain, gzip or zstd)
+    '''
+    filenames = [filename for filename in os.listdir(output_path) if not filename.startswith('.')]
+    if not filenames:
+        raise RuntimeError(f'No output dump in {output_path}')
+    path = os.path.join(output_path, max(filenames))
+    if path.endswith('.gz'):
+        output_file = gzip.open(path, 'rt')
+    elif path.endswith('.zst'):
+        import zstandard
+        output_file = io.TextIOWrapper(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    else:
+        output_file = open(path, 'r')
+    with output_file:
+        return {product['productId']: product['images'] for product in map(json.loads, output_file)}
+
+
+def check_output(output, valid):
+    '''
+    Return the number of products missing from the output or with a wrong image list
+    '''
+    incorrect = 0
+    for product_id, images in valid.items():
+        found = output.get(product_id)
+        if (found is None or len(found) != min(max_images, len(images))
+                or len(set(found)) != len(found) or not set(found) <= images):
+            incorrect += 1
+    return incorrect
+
+
+def wait_drained(timeout, interval=5):
+    # Needs the broker of the pipeline, only imported for that engine
+    import startup
+    import watch
+    celery = startup.make_celery()
+    started = time.time()
+    while time.time() - started < timeout:
+        if watch.drained(celery):
+            return True
+        time.sleep(interval)
+    return False
+
+
+def run_engine(args, environ):
+    if args.command:
+        subprocess.run(args.command, shell=True, check=True, env=environ)
+    elif args.engine == 'aggregate':
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, 'aggregate.py')], check=True, env=environ)
+    elif args.engine == 'pipeline':
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, 'startup.py')], check=True, env=environ)
+        # Environment of this process is used for the broker connection
+        os.environ.update(environ)
+        if not wait_drained(args.drain_timeout):
+            print(f'Workers not drained after {args.drain_timeout}s, consolidating anyway')
+        subprocess.run([sys.executable, os.path.join(SCRIPTS, 'consolidate.py')], check=True, env=environ)
+
+
+def flush_shared_memory():
+    import redis
+    redis.StrictRedis(host=os.environ.get('SHARED_MEMORY_HOST'),
+                      port=int(os.environ.get('SHARED_MEMORY_PORT')), db=0).flushdb()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End to end benchmark of the url aggregator')
+    parser.add_argument('--engine', choices=ENGINES, default='aggregate')
+    parser.add_argument('--command', help='shell command of another engine (instead of --engine)')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--size', help='approximate size of the dumps, e.g. 100M (instead of --products)')
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--images', type=int, default=6)
+    parser.add_argument('--duplicates', type=float, default=0.2)
+    parser.add_argument('--shared', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--mock-port', type=int, default=4567)
+    parser.add_argument('--mock-url', help='image server url given to the engine '
+                                           '(default http://localhost:<mock port>/images/)')
+    parser.add_argument('--latency-ms', type=float, default=0)
+    parser.add_argument('--jitter-ms', type=float, default=0)
+    parser.add_argument('--error-rate', type=float, default=0)
+    parser.add_argument('--no-head', action='store_true', help='answer 405 to HEAD requests')
+    parser.add_argument('--drain-timeout', type=float, default=3600)
+    parser.add_argument('--flush-shared-memory', action='store_true',
+                        help='empty the shared memory (db 0) before running the pipeline')
+    parser.add_argument('--work-dir', help='folder of the dumps (a temporary one by default)')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='aggregator-benchmark-')
+    paths = {name: os.path.join(work_dir, name) for name in ('input', 'output', 'processed')}
+    for path in paths.values():
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+
+    # Dumps and the results expected from them
+    products = args.products
+    if args.size:
+        products = max(1, int(generate_dumps.parse_size(args.size) * (1 - args.duplicates)
+                              / (generate_dumps.LINE_SIZE * args.images)))
+    mock_url = args.mock_url or f'http://localhost:{args.mock_port}/images/'
+    dumps, lines = generate_dumps.generate(paths['input'], products, args.files, args.images,
+                                           args.duplicates, args.shared, mock_url, args.seed)
+    input_bytes = sum(os.path.getsize(path) for path in dumps)
+    valid, needed = expected_results(dumps)
+
+    server = MockServer(('0.0.0.0', args.mock_port), args.latency_ms, args.jitter_ms,
+                        args.error_rate, not args.no_head)
+    server.start()
+    if args.flush_shared_memory:
+        flush_shared_memory()
+
+    environ = dict(os.environ, INPUT_PATH=paths['input'], OUTPUT_PATH=paths['output'],
+                   PROCESSED_PATH=paths['processed'], IMAGE_SERVER=mock_url)
+    started = time.time()
+    try:
+        run_engine(args, environ)
+    finally:
+        elapsed = time.time() - started
+        server.shutdown()
+    stats = server.stats.snapshot()
+
+    output = read_output(paths['output'])
+    requests = stats['requests']
+    results = dict(
+        engine=args.command or args.engine,
+        lines=lines,
+        input_bytes=input_bytes,
+        products=len(valid),
+        output_products=len(output),
+        incorrect_products=check_output(output, valid),
+        wall_seconds=round(elapsed, 3),
+        lines_per_second=round(lines / elapsed, 1),
+        http_requests=requests,
+        http_methods=stats['methods'],
+        http_statuses=stats['statuses'],
+        requests_per_output_product=round(requests / len(output), 3) if output else None,
+        needed_requests=len(needed),
+        wasted_requests=requests - len(needed),
+        repeated_requests=stats['repeated'],
+        latency_ms=args.latency_ms,
+        error_rate=args.error_rate,
+    )
+    print(json.dumps(results, indent=2))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+    if not args.work_dir:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+import os
+import json
+
+# Progress of startup.py in each dump: byte offset and number of lines already sent.
+# A checkpoint is written to a temporary file, synced and renamed over the previous
+# one, so after a crash it is either the previous or the new checkpoint.
+
+
+def checkpoint_path(directory, filename):
+    return os.path.join(directory, filename + '.checkpoint')
+
+
+def load(directory, filename, size):
+    '''
+    Return the checkpoint of a dump, or None when there is none or the dump
+    is now smaller than the checkpoint offset (it is not the same file).
+    The size is None when it cannot be compared (compressed dumps)
+    '''
+    try:
+        with open(checkpoint_path(directory, filename), 'r') as checkpoint_file:
+            state = json.load(checkpoint_file)
+    except (OSError, ValueError):
+        return None
+    if size is not None and state.get('offset', 0) > size:
+        return None
+    return state
+
+
+def save(directory, filename, offset, lines, done=False):
+    path = checkpoint_path(directory, filename)
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as checkpoint_file:
+        json.dump(dict(offset=offset, lines=lines, done=done), checkpoint_file)
+        checkpoint_file.flush()
+        os.fsync(checkpoint_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def remove(directory, filename):
+    try:
+        os.remove(checkpoint_path(directory, filename))
+    except FileNotFoundError:
+        pass
@@ -1,38 +1,294 @@
 import os
 import json
+import gzip
 import redis
+import dedup
+import layout
 import datetime
+import collections
+import multiprocessing
 
 # Load parameters
 output_path = os.environ.get('OUTPUT_PATH')
+shared_memory_host = os.environ.get('SHARED_MEMORY_HOST')
+shared_memory_port = int(os.environ.get('SHARED_MEMORY_PORT'))
+# Keys asked per SCAN call and hashes fetched per pipeline
+batch_size = int(os.environ.get('CONSOLIDATE_BATCH', 1000))
+# Above 1, batches of keys are fetched and formatted by a pool of processes
+processes = int(os.environ.get('CONSOLIDATE_PROCESSES', 1))
+# Batches handed to the pool and not written yet (scanning waits beyond that)
+inflight_batches = int(os.environ.get('CONSOLIDATE_INFLIGHT', 0)) or 2 * processes
+# Output compression: 'none', 'gzip' or 'zstd'
+compression = os.environ.get('OUTPUT_COMPRESSION', 'none')
+compression_level = int(os.environ.get('OUTPUT_COMPRESSION_LEVEL', 3))
+# 'full' writes every product, 'delta' only products whose images changed since the previous
+# run, and products that are gone with an empty list of images
+output_mode = os.environ.get('OUTPUT_MODE', 'full')
+# Products written by the previous run (required by the delta mode, see OutputIndex)
+output_index = os.environ.get('OUTPUT_INDEX')
 
-# Shared Memory server
-pool = redis.ConnectionPool(host=os.environ.get('SHARED_MEMORY_HOST'),
-                            port=int(os.environ.get('SHARED_MEMORY_PORT')),
-                            decode_responses=True,
-                            db=0)
-shared_memory = redis.StrictRedis(connection_pool=pool)
-
-# Create output file
-consolidation_datetime = datetime.datetime.now().strftime('%Y_%m_%d-%H_%M_%S')
-filename = consolidation_datetime + '-output-dump'
-output_file = open(os.path.join(output_path, filename), 'w')
-
-# Search for stored data in shared memory
-for key in shared_memory.scan_iter():
-    stored_obj = shared_memory.hgetall(key)
-    product = dict(productId=key)
+# Layout written by the workers: 'hash' or 'compact' (bucket hashes, see layout.py)
+storage_layout = os.environ.get('STORAGE_LAYOUT', 'hash')
+
+# Maximum of 3 images per product
+max_images = 3
+
+# Extension of the output file for each compression
+extensions = {'none': '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# Shared Memory connection of this process (recreated in each pool process)
+shared_memory = None
+
+
+def connect():
+    global shared_memory
+    pool = redis.ConnectionPool(host=shared_memory_host,
+                                port=shared_memory_port,
+                                decode_responses=True,
+                                db=0)
+    shared_memory = redis.StrictRedis(connection_pool=pool)
+
+
+def scan_batches():
+    '''
+    Yield the keys of the shared memory in batches of about batch_size
+    '''
+    # Compact buckets are the only keys read in the compact layout
+    match = layout.CompactLayout(1).key_prefix + '*' if storage_layout == 'compact' else None
+    cursor = 0
+    batch = []
+    while True:
+        cursor, keys = shared_memory.scan(cursor, match=match, count=batch_size)
+        batch.extend(keys)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+        if cursor == 0:
+            break
+    if batch:
+        yield batch
+
+
+def valid_images(stored_obj):
     images = []
-    
-    # Maximum of 3 images per product
-    for image in list(stored_obj):
-        if stored_obj[image] == '1' and len(images) < 3:
+    for image in stored_obj:
+        if stored_obj[image] == '1' and len(images) < max_images:
             images.append(image)
-    product['images'] = images
+    return images
+
+
+def render_product(key, stored_obj):
+    return json.dumps(dict(productId=key, images=valid_images(stored_obj))) + '\n'
+
+
+def render_entry(product_id, stored_obj):
+    '''
+    Output line of a product, with the hash of its valid images when there is an index
+    '''
+    images = valid_images(stored_obj)
+    line = (json.dumps(dict(productId=product_id, images=images)) + '\n').encode('utf-8')
+    return product_id, dedup.product_key(product_id, images) if output_index else None, line
+
+
+def render_batch(keys):
+    '''
+    Fetch the hashes of a batch of keys in a single round trip and
+    return (productId, key, line) for each of their products
+    '''
+    pipe = shared_memory.pipeline(transaction=False)
+    for key in keys:
+        pipe.hgetall(key)
+    replies = pipe.execute()
+    if storage_layout == 'compact':
+        # Keys are buckets holding many products
+        return [render_entry(product_id, stored_obj)
+                for bucket in replies
+                for product_id, stored_obj in layout.decode_bucket(bucket).items()]
+    return [render_entry(key, stored_obj) for key, stored_obj in zip(keys, replies)]
+
+
+def open_writer(raw_file):
+    '''
+    Wrap the output file with the configured compression
+    '''
+    if compression == 'none':
+        return raw_file
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw_file, mode='wb', compresslevel=compression_level)
+    if compression == 'zstd':
+        # Only imported for zstd output (closefd needs zstandard 0.15)
+        import zstandard
+        return zstandard.ZstdCompressor(level=compression_level).stream_writer(raw_file, closefd=False)
+    raise ValueError(f'Unsupported output compression: {compression}')
+
+
+class OutputIndex:
+    '''
+    Products written by a run, for the delta of the next one: the hash of each product
+    with its valid images (a HashSet64 saved at path) and the product ids (one json
+    string per line in path.ids), from which the products that are gone are found
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.ids_path = f'{path}.ids'
+        self.keys = dedup.HashSet64()
+        self.ids = dedup.HashSet64()
+        # Own temporary file, renamed by save
+        self.temporary_path = f'{self.ids_path}.{os.getpid()}.tmp'
+        self.ids_file = open(self.temporary_path, 'w')
+
+    def add(self, product_id, key):
+        self.keys.add(key)
+        self.ids.add(dedup.product_key(product_id))
+        self.ids_file.write(json.dumps(product_id) + '\n')
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def save(self):
+        '''
+        Replace the saved index (the ids last: a crash in between only repeats some products)
+        '''
+        self.ids_file.close()
+        self.keys.save(self.path)
+        os.replace(self.temporary_path, self.ids_path)
+
+    def discard(self):
+        self.ids_file.close()
+        if os.path.exists(self.temporary_path):
+            os.remove(self.temporary_path)
+
+
+class PreviousIndex:
+    '''
+    Index saved by the previous run, only read
+    '''
+    def __init__(self, path):
+        self.keys = dedup.HashSet64.load(path)
+        self.ids_path = f'{path}.ids'
+
+    def __contains__(self, key):
+        return key in self.keys
+
+    def missing_ids(self, current):
+        '''
+        Yield the product ids of the previous run that were not added to the current index
+        '''
+        if not os.path.exists(self.ids_path):
+            return
+        with open(self.ids_path) as ids_file:
+            for line in ids_file:
+                product_id = json.loads(line)
+                if dedup.product_key(product_id) not in current.ids:
+                    yield product_id
+
+
+def select_lines(entries, previous, current):
+    '''
+    Record the products in the current index and keep the lines of those
+    whose valid images are not the ones of the previous run
+    '''
+    selected = []
+    for product_id, key, line in entries:
+        current.add(product_id, key)
+        if previous is None or key not in previous:
+            selected.append(line)
+    return selected
+
+
+def pooled_batches(pool):
+    '''
+    Yield the entries of each scanned batch rendered by the pool, in scan order.
+    At most inflight_batches are submitted ahead of the one being written, so a slow
+    output does not let the rendered lines of the whole keyspace pile up in memory.
+    '''
+    pending = collections.deque()
+    for keys in scan_batches():
+        pending.append(pool.apply_async(render_batch, (keys,)))
+        if len(pending) >= inflight_batches:
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+def consolidate(output_file, previous=None, current=None):
+    '''
+    Write one line per product in shared memory (with a previous index, only the changed
+    ones and an empty one for each product that is gone) and return the number of
+    products and of written lines
+    '''
+    if processes > 1:
+        # Keys are scanned here and fetched by the pool, batches are written in order
+        pool = multiprocessing.Pool(processes, initializer=connect)
+        batches = pooled_batches(pool)
+    else:
+        pool = None
+        batches = (render_batch(keys) for keys in scan_batches())
+
+    products = written = 0
+    try:
+        for entries in batches:
+            products += len(entries)
+            if current is not None:
+                lines = select_lines(entries, previous, current)
+            else:
+                lines = [line for _, _, line in entries]
+            output_file.write(b''.join(lines))
+            written += len(lines)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    if previous is not None:
+        # Products of the previous run that are not in shared memory anymore
+        for product_id in previous.missing_ids(current):
+            output_file.write(render_product(product_id, {}).encode('utf-8'))
+            written += 1
+    return products, written
+
+
+def main():
+    if storage_layout not in ('hash', 'compact'):
+        raise ValueError(f'Unsupported storage layout: {storage_layout}')
+    if output_mode not in ('full', 'delta'):
+        raise ValueError(f'Unsupported output mode: {output_mode}')
+    if output_mode == 'delta' and not output_index:
+        raise ValueError('The delta output mode needs OUTPUT_INDEX')
+    connect()
+
+    # With an index, the products of this run replace the previous ones at the end
+    previous = current = None
+    if output_index:
+        current = OutputIndex(output_index)
+        if output_mode == 'delta':
+            previous = PreviousIndex(output_index)
+
+    # Output is written to a hidden temporary file, renamed once complete
+    consolidation_datetime = datetime.datetime.now().strftime('%Y_%m_%d-%H_%M_%S')
+    kind = '-output-delta' if output_mode == 'delta' else '-output-dump'
+    filename = consolidation_datetime + kind + extensions.get(compression, '')
+    temporary_path = os.path.join(output_path, f'.{filename}.tmp')
+    try:
+        with open(temporary_path, 'wb') as raw_file:
+            output_file = open_writer(raw_file)
+            products, written = consolidate(output_file, previous, current)
+            if output_file is not raw_file:
+                output_file.close()
+            # Contents are on disk before the rename makes them visible
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        os.replace(temporary_path, os.path.join(output_path, filename))
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        if current is not None:
+            current.discard()
+        raise
+
+    if current is not None:
+        current.save()
+    print(f'{filename}: {written} of {products} products written')
 
-    # Save in output file
-    output_file.write(json.dumps(product))
-    output_file.write('\n')
 
-# Close file
-output_file.close()
\ No newline at end of file
+if __name__ == '__main__':
+    main()
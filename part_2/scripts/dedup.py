@@ -0,0 +1,180 @@
+import os
+import math
+import fcntl
+import hashlib
+from array import array
+
+# Compact structures to drop repeated (productId, image) pairs before they are sent.
+# Pairs are reduced to a 128-bit hash: the hash set keeps 64 bits of it (8 bytes per
+# slot, so about 12 bytes per pair), the Bloom filter uses it for its bit positions.
+
+# The hash set doubles before it gets more than this fraction full
+MAX_LOAD = 0.7
+
+_MASK_64 = (1 << 64) - 1
+
+
+def pair_key(product_id, image):
+    digest = hashlib.blake2b(f'{product_id}\0{image}'.encode('utf-8'), digest_size=16).digest()
+    return int.from_bytes(digest, 'little')
+
+
+def product_key(product_id, images=()):
+    '''
+    64-bit hash of a product and its images, whatever their order
+    '''
+    content = '\0'.join([product_id] + sorted(images))
+    return int.from_bytes(hashlib.blake2b(content.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class HashSet64:
+    '''
+    Open addressing set of 64-bit hashes stored in a flat array.
+    Two different pairs are only mistaken for each other on a 64-bit hash collision.
+    '''
+    def __init__(self, capacity=1024):
+        size = 1 << max(10, int(capacity / MAX_LOAD).bit_length())
+        self._slots = array('Q', bytes(8 * size))
+        self._count = 0
+
+    def add(self, key):
+        '''
+        Add a key and return True when it was not in the set
+        '''
+        # 0 marks an empty slot
+        key = (key & _MASK_64) or 1
+        slots = self._slots
+        mask = len(slots) - 1
+        index = key & mask
+        while True:
+            current = slots[index]
+            if current == 0:
+                slots[index] = key
+                self._count += 1
+                if self._count > MAX_LOAD * len(slots):
+                    self._grow()
+                return True
+            if current == key:
+                return False
+            index = (index + 1) & mask
+
+    def __contains__(self, key):
+        key = (key & _MASK_64) or 1
+        slots = self._slots
+        mask = len(slots) - 1
+        index = key & mask
+        while True:
+            current = slots[index]
+            if current == 0:
+                return False
+            if current == key:
+                return True
+            index = (index + 1) & mask
+
+    def _grow(self):
+        old = self._slots
+        self._slots = array('Q', bytes(16 * len(old)))
+        self._count = 0
+        for key in old:
+            if key:
+                self.add(key)
+
+    def __len__(self):
+        return self._count
+
+    def update(self, other):
+        '''
+        Add the keys of another set
+        '''
+        for key in other._slots:
+            if key:
+                self.add(key)
+
+    @property
+    def nbytes(self):
+        return len(self._slots) * self._slots.itemsize
+
+    def save(self, path):
+        '''
+        Write the slots to path (through a temporary file, so a crash keeps the previous one)
+        '''
+        # Own temporary file for each process saving to the same path
+        temporary_path = f'{path}.{os.getpid()}.tmp'
+        with open(temporary_path, 'wb') as index_file:
+            self._slots.tofile(index_file)
+        os.replace(temporary_path, path)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Read a set written by save, or return an empty set when there is none
+        '''
+        hash_set = cls()
+        if os.path.exists(path):
+            slots = array('Q')
+            with open(path, 'rb') as index_file:
+                slots.frombytes(index_file.read())
+            hash_set._slots = slots
+            hash_set._count = len(slots) - slots.count(0)
+        return hash_set
+
+    def merge(self, path):
+        '''
+        Add the keys of the set saved at path and save the union there. Processes merging
+        into the same path at once take turns (through a lock file), so none of them is lost
+        '''
+        with open(path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            self.update(self.load(path))
+            self.save(path)
+
+
+class BloomFilter:
+    '''
+    Fixed size Bloom filter: memory never grows, but a new pair is dropped
+    as a duplicate with probability error_rate once capacity pairs were added
+    '''
+    def __init__(self, capacity, error_rate=0.001):
+        capacity = max(1, capacity)
+        self._size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._hashes = max(1, int(round(self._size / capacity * math.log(2))))
+        self._bits = bytearray((self._size + 7) // 8)
+        self._count = 0
+
+    def add(self, key):
+        '''
+        Add a key and return True when it was (probably) not in the filter
+        '''
+        # Double hashing over both halves of the key
+        first, second = key & _MASK_64, (key >> 64) | 1
+        bits = self._bits
+        new = False
+        for index in range(self._hashes):
+            position = (first + index * second) % self._size
+            byte, bit = position >> 3, 1 << (position & 7)
+            if not bits[byte] & bit:
+                bits[byte] |= bit
+                new = True
+        if new:
+            self._count += 1
+        return new
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def nbytes(self):
+        return len(self._bits)
+
+
+def make_filter(mode, capacity, error_rate=0.001):
+    '''
+    Build the structure for a dedup mode: 'set', 'bloom' or 'off' (None)
+    '''
+    if mode == 'set':
+        return HashSet64(capacity)
+    if mode == 'bloom':
+        return BloomFilter(capacity, error_rate)
+    if mode == 'off':
+        return None
+    raise ValueError(f'Unsupported dedup mode: {mode}')
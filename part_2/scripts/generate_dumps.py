@@ -0,0 +1,126 @@
+import os
+import json
+import random
+import argparse
+
+# Generates dumps like the ones startup.py reads: one {"productId", "image"} json per line.
+# Products get a random number of images around --images, --shared of the images are
+# reused from other products, --duplicates of the lines repeat an earlier line and lines
+# are shuffled within a window, so a product's images are spread over the dump.
+# Image ids that are multiples of 5 are missing in the mock image server.
+#
+# Usage: python generate_dumps.py OUTPUT_FOLDER [--size 100M | --products 10000]
+#                                 [--files 1] [--images 6] [--duplicates 0.2] [--shared 0.1]
+
+# Size suffixes accepted in --size
+UNITS = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+
+# Approximate size of a line, used to turn --size into a number of products
+LINE_SIZE = 70
+
+# Lines are shuffled in windows of this many lines
+SHUFFLE_WINDOW = 10000
+
+# Duplicated lines are drawn from the last lines written
+RECENT_LINES = 100000
+
+
+def parse_size(text):
+    text = text.strip().upper().rstrip('B')
+    unit = text[-1:] if text[-1:] in UNITS else ''
+    return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+
+
+def product_lines(products, images, shared, image_prefix, rng):
+    '''
+    Yield the (productId, image) pairs of every product
+    '''
+    next_image = 1
+    used = []
+    for product in range(products):
+        product_id = f'pid{product}'
+        for _ in range(rng.randint(1, 2 * images - 1)):
+            if used and rng.random() < shared:
+                number = rng.choice(used)
+            else:
+                number = next_image
+                next_image += 1
+                if len(used) < RECENT_LINES:
+                    used.append(number)
+                else:
+                    used[rng.randrange(RECENT_LINES)] = number
+            yield json.dumps({'productId': product_id, 'image': f'{image_prefix}{number}.png'}) + '\n'
+
+
+def with_duplicates(lines, duplicates, rng):
+    recent = []
+    for line in lines:
+        yield line
+        if len(recent) < RECENT_LINES:
+            recent.append(line)
+        else:
+            recent[rng.randrange(RECENT_LINES)] = line
+        # Each line is followed by a geometric number of repeated lines (mean
+        # duplicates / (1 - duplicates)), so duplicates is their fraction of the dump
+        while rng.random() < duplicates:
+            yield rng.choice(recent)
+
+
+def shuffled(lines, rng):
+    window = []
+    for line in lines:
+        window.append(line)
+        if len(window) >= SHUFFLE_WINDOW:
+            rng.shuffle(window)
+            yield from window
+            window = []
+    rng.shuffle(window)
+    yield from window
+
+
+def generate(output, products, files=1, images=6, duplicates=0.2, shared=0.1,
+             image_prefix='http://localhost:4567/images/', seed=1):
+    '''
+    Write the dumps and return their paths and number of lines
+    '''
+    rng = random.Random(seed)
+    os.makedirs(output, exist_ok=True)
+    lines = shuffled(with_duplicates(product_lines(products, images, shared, image_prefix, rng),
+                                     duplicates, rng), rng)
+    paths = [os.path.join(output, f'{index:04d}-input-dump') for index in range(files)]
+    dump_files = [open(path, 'w') for path in paths]
+    count = 0
+    try:
+        for line in lines:
+            dump_files[count % files].write(line)
+            count += 1
+    finally:
+        for dump_file in dump_files:
+            dump_file.close()
+    return paths, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate input dumps')
+    parser.add_argument('output')
+    parser.add_argument('--size', help='approximate total size, e.g. 100M (instead of --products)')
+    parser.add_argument('--products', type=int, default=10000)
+    parser.add_argument('--files', type=int, default=1)
+    parser.add_argument('--images', type=int, default=6, help='mean number of images per product')
+    parser.add_argument('--duplicates', type=float, default=0.2, help='fraction of repeated lines')
+    parser.add_argument('--shared', type=float, default=0.1, help='fraction of images shared between products')
+    parser.add_argument('--image-prefix', default='http://localhost:4567/images/')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    products = args.products
+    if args.size:
+        products = max(1, int(parse_size(args.size) * (1 - args.duplicates) / (LINE_SIZE * args.images)))
+    paths, count = generate(args.output, products, args.files, args.images, args.duplicates,
+                            args.shared, args.image_prefix, args.seed)
+    size = sum(os.path.getsize(path) for path in paths)
+    print(f'{len(paths)} dumps, {count} lines, {products} products, {size} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+import redis
+import layout
+
+# Compares the redis memory used by the verdicts of synthetic products in the
+# 'hash' layout (one hash per product) and in the 'compact' layout (bucket hashes).
+# Both are written to a scratch database, which is flushed before and after each layout.
+
+# Load parameters
+shared_memory_host = os.environ.get('SHARED_MEMORY_HOST')
+shared_memory_port = int(os.environ.get('SHARED_MEMORY_PORT'))
+report_db = int(os.environ.get('REPORT_DB', 15))
+products = int(os.environ.get('REPORT_PRODUCTS', 100000))
+images_per_product = int(os.environ.get('REPORT_IMAGES', 6))
+image_prefix = os.environ.get('REPORT_IMAGE_PREFIX', 'http://image-server/images/')
+# By default about 100 images per bucket, so buckets stay listpack encoded
+buckets = int(os.environ.get('COMPACT_BUCKETS') or 0) or layout.bucket_count(products * images_per_product)
+
+
+def fill(client, storage):
+    pipe = client.pipeline(transaction=False)
+    for product in range(products):
+        product_id = f'pid{product}'
+        for image in range(images_per_product):
+            number = product * images_per_product + image
+            storage.write(pipe, product_id, f'{image_prefix}{number}.png', 0 if number % 5 == 0 else 1)
+        if product % 1000 == 999:
+            pipe.execute()
+    pipe.execute()
+
+
+def measure(client):
+    '''
+    Return the number of keys, the sum of MEMORY USAGE of the keys and their encodings
+    '''
+    keys = list(client.scan_iter(count=1000))
+    usage = 0
+    encodings = {}
+    for index in range(0, len(keys), 1000):
+        pipe = client.pipeline(transaction=False)
+        for key in keys[index:index + 1000]:
+            pipe.execute_command('MEMORY', 'USAGE', key, 'SAMPLES', '0')
+            pipe.execute_command('OBJECT', 'ENCODING', key)
+        replies = pipe.execute()
+        usage += sum(replies[0::2])
+        for encoding in replies[1::2]:
+            encodings[encoding] = encodings.get(encoding, 0) + 1
+    return len(keys), usage, encodings
+
+
+def main():
+    if report_db == 0:
+        raise ValueError('REPORT_DB must not be the shared memory database (0)')
+    client = redis.StrictRedis(host=shared_memory_host, port=shared_memory_port,
+                               db=report_db, decode_responses=True)
+    images = products * images_per_product
+    print(f'{products} products, {images} images, {buckets} buckets in the compact layout')
+
+    rows = []
+    for name, storage in (('hash', layout.HashLayout()), ('compact', layout.CompactLayout(buckets))):
+        client.flushdb()
+        before = client.info('memory')['used_memory']
+        fill(client, storage)
+        used = client.info('memory')['used_memory'] - before
+        keys, usage, encodings = measure(client)
+        rows.append((name, keys, usage, used, encodings))
+    client.flushdb()
+
+    print(f'{"layout":<8} {"keys":>10} {"key bytes":>14} {"used_memory":>14} {"per image":>10}  encodings')
+    for name, keys, usage, used, encodings in rows:
+        print(f'{name:<8} {keys:>10} {usage:>14} {used:>14} {used / images:>10.1f}  {encodings}')
+    print(f'compact layout uses {rows[1][3] / rows[0][3]:.1%} of the memory of the hash layout')
+
+
+if __name__ == '__main__':
+    main()
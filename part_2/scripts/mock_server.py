@@ -0,0 +1,151 @@
+import os
+import sys
+import json
+import time
+import random
+import threading
+import collections
+from socketserver import ThreadingMixIn
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+# Python stand-in for mock/url-aggregator-api.rb: GET /images/<id>.png answers 404 when
+# the id is a multiple of 5 and 200 otherwise. On top of that it counts requests,
+# can add latency and random 500s, can refuse HEAD requests, and serves its counters
+# at GET /__stats (POST /__reset clears them).
+#
+# Usage: python mock_server.py (MOCK_PORT, MOCK_LATENCY_MS, MOCK_JITTER_MS,
+#                               MOCK_ERROR_RATE, MOCK_HEAD)
+
+# Load parameters
+port = int(os.environ.get('MOCK_PORT', 4567))
+latency_ms = float(os.environ.get('MOCK_LATENCY_MS', 0))
+jitter_ms = float(os.environ.get('MOCK_JITTER_MS', 0))
+error_rate = float(os.environ.get('MOCK_ERROR_RATE', 0))
+head_supported = os.environ.get('MOCK_HEAD', 'True') == 'True'
+
+
+def image_status(name):
+    '''
+    Status of the real mock for an image file name
+    '''
+    try:
+        number = int(name.rsplit('.', 1)[0])
+    except ValueError:
+        return 404
+    return 404 if number % 5 == 0 else 200
+
+
+class Stats:
+    '''
+    Request counters, shared by the handler threads
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.requests = collections.Counter()
+            self.statuses = collections.Counter()
+            self.images = collections.Counter()
+
+    def count(self, method, status, name=None):
+        with self._lock:
+            self.requests[method] += 1
+            self.statuses[str(status)] += 1
+            if name is not None:
+                self.images[name] += 1
+
+    def snapshot(self):
+        with self._lock:
+            total = sum(self.requests.values())
+            return dict(requests=total, methods=dict(self.requests), statuses=dict(self.statuses),
+                        distinct_images=len(self.images),
+                        repeated=total - len(self.images))
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, like the real server
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body, content_type='text/plain'):
+        content = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def image(self):
+        server = self.server
+        name = self.path.split('?', 1)[0][len('/images/'):]
+        if self.command == 'HEAD' and not server.head_supported:
+            server.stats.count('HEAD', 405)
+            return self.respond(405, 'Method not allowed')
+        delay = server.latency_ms + random.uniform(0, server.jitter_ms)
+        if delay:
+            time.sleep(delay / 1000)
+        if server.error_rate and random.random() < server.error_rate:
+            status = 500
+        else:
+            status = image_status(name)
+        server.stats.count(self.command, status, name)
+        self.respond(status, "You got a 200!" if status == 200 else "There's no such image!")
+
+    def do_GET(self):
+        if self.path == '/__stats':
+            return self.respond(200, json.dumps(self.server.stats.snapshot()), 'application/json')
+        if self.path.startswith('/images/'):
+            return self.image()
+        self.respond(404, 'Not found')
+
+    def do_HEAD(self):
+        if self.path.startswith('/images/'):
+            return self.image()
+        self.respond(404, 'Not found')
+
+    def do_POST(self):
+        if self.path == '/__reset':
+            self.server.stats.reset()
+            return self.respond(200, '{}', 'application/json')
+        self.respond(404, 'Not found')
+
+
+class MockServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency_ms=0, jitter_ms=0, error_rate=0, head_supported=True):
+        super().__init__(address, Handler)
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.head_supported = head_supported
+        self.stats = Stats()
+
+    def handle_error(self, request, client_address):
+        # Clients closing kept-alive connections are not errors
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        '''
+        Serve from a background thread (used by benchmark.py)
+        '''
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+
+def main():
+    server = MockServer(('0.0.0.0', port), latency_ms, jitter_ms, error_rate, head_supported)
+    print(f'Mock image server on port {port}')
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
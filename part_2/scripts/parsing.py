@@ -0,0 +1,121 @@
+import io
+import os
+import re
+import json
+import gzip
+import dedup
+
+# Reading of the input dumps: plain, gzip or zstd files (told apart by their first bytes)
+# with one {"productId": "...", "image": "..."} json per line. Lines of that fixed shape
+# are read with a regular expression, anything else falls back to json.loads.
+# Large plain dumps are split into byte ranges ending on a newline, parsed by a pool.
+
+GZIP_MAGIC = b'\x1f\x8b'
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+# Fixed-shape line without escapes, the fast path
+LINE = re.compile(rb'\s*\{\s*"productId"\s*:\s*"([^"\\]*)"\s*,\s*"image"\s*:\s*"([^"\\]*)"\s*\}\s*$')
+
+
+def compression(path):
+    '''
+    Return 'gzip', 'zstd' or None for a plain dump
+    '''
+    with open(path, 'rb') as dump_file:
+        magic = dump_file.read(4)
+    if magic.startswith(GZIP_MAGIC):
+        return 'gzip'
+    if magic.startswith(ZSTD_MAGIC):
+        return 'zstd'
+    return None
+
+
+def open_dump(path):
+    '''
+    Open a dump for reading its (decompressed) bytes
+    '''
+    kind = compression(path)
+    if kind == 'gzip':
+        return gzip.open(path, 'rb')
+    if kind == 'zstd':
+        # Only imported for zstd input
+        import zstandard
+        # Buffered for reading lines
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(open(path, 'rb')))
+    return open(path, 'rb')
+
+
+def skip(dump_file, offset, chunk_size=1024 * 1024):
+    '''
+    Move a dump opened by open_dump forward to offset. Streams that cannot
+    seek (zstd) are read up to the offset, in chunks of chunk_size bytes
+    '''
+    if dump_file.seekable():
+        dump_file.seek(offset)
+        return
+    while offset > 0:
+        data = dump_file.read(min(offset, chunk_size))
+        if not data:
+            break
+        offset -= len(data)
+
+
+def parse_line(line):
+    '''
+    Return the (productId, image) of a line, or None when it is malformed
+    '''
+    match = LINE.match(line)
+    if match:
+        try:
+            return match.group(1).decode('utf-8'), match.group(2).decode('utf-8')
+        except UnicodeDecodeError:
+            return None
+    try:
+        payload = json.loads(line)
+    except ValueError:
+        return None
+    if isinstance(payload, dict) and 'productId' in payload and 'image' in payload:
+        return payload['productId'], payload['image']
+    return None
+
+
+def chunks(path, start, chunk_size):
+    '''
+    Return the (start, end) byte ranges of a plain dump from start,
+    each one ending after a newline (or at the end of the file)
+    '''
+    size = os.path.getsize(path)
+    ranges = []
+    with open(path, 'rb') as dump_file:
+        while start < size:
+            dump_file.seek(start + chunk_size)
+            # Rest of the line the range ends in
+            dump_file.readline()
+            end = min(dump_file.tell(), size)
+            ranges.append((start, end))
+            start = end
+    return ranges
+
+
+def parse_chunk(task):
+    '''
+    Parse the lines of a byte range of a plain dump, run in a pool process.
+    Return (end, lines, [(key, productId, image)], [(offset, malformed line)])
+    '''
+    path, start, end = task
+    with open(path, 'rb') as dump_file:
+        dump_file.seek(start)
+        data = dump_file.read(end - start)
+    pairs, malformed = [], []
+    offset = start
+    lines = 0
+    for line in data.splitlines(keepends=True):
+        lines += 1
+        if line.strip():
+            pair = parse_line(line)
+            if pair is None:
+                malformed.append((offset, line))
+            else:
+                pairs.append((dedup.pair_key(*pair),) + pair)
+        offset += len(line)
+    return end, lines, pairs, malformed
@@ -1,7 +1,15 @@
 import os
+import zlib
+import time
 import shutil
 import json
 import logging
+import datetime
+import collections
+import multiprocessing
+import dedup
+import parsing
+import checkpoints
 from celery import Celery
 
 # Load parameters
@@ -10,24 +18,291 @@ task = os.environ.get('CELERY_TASK')
 broker_url = os.environ.get('BROKER_ENDPOINT')
 input_path = os.environ.get('INPUT_PATH')
 processed_path = os.environ.get('PROCESSED_PATH')
+broker_compression = os.environ.get('BROKER_COMPRESSION') or None
+dedup_mode = os.environ.get('DEDUP_MODE', 'set')
+# With a batch size above 1, pairs are sent in batches to the batch task
+batch_size = int(os.environ.get('BATCH_SIZE', 1))
+batch_task = os.environ.get('BATCH_TASK', 'verify_images_batch')
+dedup_capacity = int(os.environ.get('DEDUP_CAPACITY', 0))
+dedup_error_rate = float(os.environ.get('DEDUP_ERROR_RATE', 0.001))
+# Delta mode: pairs of the previous run, kept in this index file, are not sent again
+delta_index = os.environ.get('DELTA_INDEX')
+# Progress in each dump is saved every checkpoint_every lines, to resume after a crash
+checkpoint_path = os.environ.get('CHECKPOINT_PATH')
+checkpoint_every = int(os.environ.get('CHECKPOINT_EVERY', 10000))
+# Directory of the run summaries (lines per second, lines skipped)
+summary_path = os.environ.get('SUMMARY_PATH')
+# Plain dumps of at least two chunks are parsed by parse_processes processes, in chunks
+# of about parse_chunk_size bytes (gzip and zstd dumps are read as a single stream)
+parse_processes = int(os.environ.get('PARSE_PROCESSES', 1))
+parse_chunk_size = int(os.environ.get('PARSE_CHUNK_SIZE', 16 * 1024 * 1024))
+# Malformed lines are counted, only the first ones of each dump are logged
+malformed_log_limit = int(os.environ.get('MALFORMED_LOG_LIMIT', 10))
+# With partitions, each product is sent to the queue <queue>.<partition> owned by one worker
+partitions = int(os.environ.get('PARTITIONS', 0))
 
-# Start celery app
-celery = Celery('challenge_part_2', broker=broker_url)
 
-# List all files to be processed
-for filename in os.listdir(input_path):
-    input_file = open(os.path.join(input_path, filename), 'r')
-    for line in input_file:
+def route(payload):
+    '''
+    Queue of a payload: the partition queue of its product, or the shared queue
+    '''
+    if not partitions or 'productId' not in payload:
+        return queue
+    # Same hash as src/partitions.py in the worker
+    return f'{queue}.{zlib.crc32(str(payload["productId"]).encode("utf-8")) % partitions}'
+
+
+def make_celery():
+    # Start celery app (each producer process needs its own, for its own broker connection)
+    celery = Celery('challenge_part_2', broker=broker_url)
+    celery.conf.task_compression = broker_compression
+    return celery
+
+
+def make_filters(filenames):
+    '''
+    Return the dedup filter of a run over filenames, the delta index of the
+    previous run and the index of this run (None when disabled)
+    '''
+    # Repeated (productId, image) pairs are dropped before being sent, in all files of this run.
+    # Without an expected number of pairs, assume one per 64 bytes of input.
+    capacity = dedup_capacity
+    if not capacity:
+        capacity = sum(os.path.getsize(os.path.join(input_path, filename)) for filename in filenames) // 64
+    seen = dedup.make_filter(dedup_mode, capacity, dedup_error_rate)
+
+    # The results of the previous run are still in shared memory, so in delta mode only
+    # pairs it did not send are sent. The pairs of this run replace the index at the end.
+    previous = current = None
+    if delta_index:
+        previous = dedup.HashSet64.load(delta_index)
+        current = seen if isinstance(seen, dedup.HashSet64) else dedup.HashSet64(capacity)
+    return seen, previous, current
+
+
+class Dispatcher:
+    '''
+    Sends the lines of dumps for async processing, dropping repeated pairs and,
+    in delta mode, pairs sent by the previous run
+    '''
+    def __init__(self, celery, seen=None, previous=None, current=None):
+        self.celery = celery
+        self.seen = seen
+        self.previous = previous
+        self.current = current
+        # Pending batch of each queue
+        self.batches = {}
+
+    def send(self, payload):
+        destination = route(payload)
+        if batch_size > 1:
+            batch = self.batches.setdefault(destination, [])
+            batch.append(payload)
+            if len(batch) >= batch_size:
+                self.celery.send_task(batch_task, args=[batch], queue=destination)
+                del self.batches[destination]
+        else:
+            self.celery.send_task(task, args=[payload], queue=destination)
+
+    def flush(self):
+        for destination, batch in self.batches.items():
+            self.celery.send_task(batch_task, args=[batch], queue=destination)
+        self.batches = {}
+
+    def remember(self, key):
+        '''
+        Add a pair to the dedup filter and the delta index without sending it
+        '''
+        if self.seen is not None:
+            self.seen.add(key)
+        if self.current is not None and self.current is not self.seen:
+            self.current.add(key)
+
+    def restore(self, path, offset):
+        '''
+        Add the pairs of the lines before offset, sent by an interrupted run, to the
+        filters of this run, so they are still dropped and kept in the delta index
+        '''
+        if self.seen is None and self.current is None:
+            return
+        position = 0
+        with parsing.open_dump(path) as input_file:
+            for line in input_file:
+                if position >= offset:
+                    break
+                position += len(line)
+                pair = parsing.parse_line(line)
+                if pair is not None:
+                    self.remember(dedup.pair_key(*pair))
+
+    def process_pair(self, key, product_id, image):
+        '''
+        Send a (productId, image) pair for async processing and return what was done with it
+        '''
         try:
-            # Load as dict and send for async processing
-            payload = json.loads(line)
-            celery.send_task(task, args=[payload], queue=queue)
+            if self.seen is not None and not self.seen.add(key):
+                return 'dropped'
+            if self.current is not None and self.current is not self.seen:
+                self.current.add(key)
+            if self.previous is not None and key in self.previous:
+                return 'unchanged'
+            self.send({'productId': product_id, 'image': image})
+            return 'sent'
         except Exception as e:
             # If anything goes wrong, log as error 
             logging.error(f'{e}')
-    
-    # Close input file
-    input_file.close()
+            return 'errors'
+
+    def process_line(self, line):
+        pair = parsing.parse_line(line)
+        if pair is None:
+            return 'malformed'
+        return self.process_pair(dedup.pair_key(*pair), *pair)
+
+    def read_serial(self, path, offset):
+        '''
+        Yield (offset after the line, status, (offset, line) when malformed) for the lines
+        of a dump from offset, offsets of compressed dumps being in the decompressed stream
+        '''
+        with parsing.open_dump(path) as input_file:
+            if offset:
+                parsing.skip(input_file, offset)
+            for line in input_file:
+                offset += len(line)
+                if not line.strip():
+                    yield offset, 'blank', None
+                    continue
+                status = self.process_line(line)
+                yield offset, status, (offset - len(line), line) if status == 'malformed' else None
+
+    def read_parallel(self, path, offset):
+        '''
+        Same as read_serial, parsing byte ranges of a plain dump in a pool while sending. Offsets
+        are only known at the end of each range, yielded with no status (ranges come back in dump
+        order, so checkpoints stay valid)
+        '''
+        tasks = [(path, start, end) for start, end in parsing.chunks(path, offset, parse_chunk_size)]
+        with multiprocessing.Pool(parse_processes) as pool:
+            for end, lines, pairs, malformed in pool.imap(parsing.parse_chunk, tasks):
+                for pair in pairs:
+                    yield None, self.process_pair(*pair), None
+                for line_offset, line in malformed:
+                    yield None, 'malformed', (line_offset, line)
+                for _ in range(lines - len(pairs) - len(malformed)):
+                    yield None, 'blank', None
+                yield end, None, None
+
+    def process_file(self, filename):
+        '''
+        Send the lines of a dump, move it to the processed folder and return its summary
+        '''
+        path = os.path.join(input_path, filename)
+        started = time.time()
+        compressed = parsing.compression(path) is not None
+
+        # Resume after the lines a previous (interrupted) run already sent. Their pairs are
+        # read again (and not sent) for the dedup filter and the delta index of this run.
+        # Offsets of compressed dumps are in the decompressed stream, so they cannot be
+        # checked against the size.
+        state = None
+        if checkpoint_path:
+            state = checkpoints.load(checkpoint_path, filename, None if compressed else os.path.getsize(path))
+        offset = state['offset'] if state else 0
+        lines = skipped = state['lines'] if state else 0
+        counts = collections.Counter()
+        if offset:
+            self.restore(path, offset)
+
+        if not (state and state['done']):
+            # Pool processes (e.g. the producers of watch.py) cannot start a pool of their own
+            parallel = (parse_processes > 1 and not compressed and not multiprocessing.current_process().daemon
+                        and os.path.getsize(path) - offset >= 2 * parse_chunk_size)
+            read = self.read_parallel if parallel else self.read_serial
+            since_checkpoint = 0
+            for line_end, status, malformed in read(path, offset):
+                if status is not None:
+                    counts[status] += 1
+                    lines += 1
+                    since_checkpoint += 1
+                if malformed is not None and counts['malformed'] <= malformed_log_limit:
+                    line_offset, line = malformed
+                    logging.warning(f'{filename}: malformed line at byte {line_offset}: {line[:200]!r}')
+                if line_end is None:
+                    continue
+                offset = line_end
+                # Pending messages are sent before the checkpoint covering them is written
+                if checkpoint_path and since_checkpoint >= checkpoint_every:
+                    self.flush()
+                    checkpoints.save(checkpoint_path, filename, offset, lines)
+                    since_checkpoint = 0
+
+            # Send the last (incomplete) batch
+            self.flush()
+
+            if checkpoint_path:
+                checkpoints.save(checkpoint_path, filename, offset, lines, done=True)
+
+        elapsed = time.time() - started
+        print(f'{filename}: {counts["sent"]} lines sent, {counts["dropped"]} repeated lines dropped, '
+              f'{counts["unchanged"]} unchanged lines skipped, {counts["malformed"]} malformed lines, '
+              f'{skipped} lines skipped from the checkpoint')
+
+        # Move file to the processed folder, then forget its checkpoint
+        shutil.move(path, os.path.join(processed_path, filename))
+        if checkpoint_path:
+            checkpoints.remove(checkpoint_path, filename)
+
+        return dict(filename=filename, lines=lines, read=lines - skipped, skipped=skipped,
+                    sent=counts['sent'], dropped=counts['dropped'], unchanged=counts['unchanged'],
+                    malformed=counts['malformed'], errors=counts['errors'], seconds=round(elapsed, 3),
+                    lines_per_second=round((lines - skipped) / elapsed, 1) if elapsed else None)
+
+    def finish(self, merge=None):
+        '''
+        Save the delta index, once every file of the run was sent
+        (so an interrupted run keeps the previous index). With merge, the
+        pairs of the run are added to the index saved at that path instead
+        '''
+        if self.seen is not None:
+            print(f'{len(self.seen)} distinct pairs, {self.seen.nbytes} bytes used by the {dedup_mode} dedup')
+        if self.current is not None:
+            if merge:
+                self.current.merge(merge)
+            else:
+                self.current.save(delta_index)
+            print(f'{len(self.current)} pairs in the delta index, {len(self.previous)} in the previous one')
+
+
+def write_summary(run_started, summary, name='startup'):
+    if not summary_path:
+        return
+    os.makedirs(summary_path, exist_ok=True)
+    elapsed = time.time() - run_started
+    read = sum(item['read'] for item in summary)
+    run = dict(started_at=datetime.datetime.fromtimestamp(run_started).isoformat(),
+               seconds=round(elapsed, 3),
+               lines_per_second=round(read / elapsed, 1) if elapsed else None,
+               read=read,
+               skipped=sum(item['skipped'] for item in summary),
+               files=summary)
+    summary_filename = (datetime.datetime.fromtimestamp(run_started).strftime('%Y_%m_%d-%H_%M_%S')
+                        + f'-{name}-summary.json')
+    with open(os.path.join(summary_path, summary_filename), 'w') as summary_file:
+        json.dump(run, summary_file, indent=2)
+
+
+def main():
+    # List all files to be processed
+    filenames = os.listdir(input_path)
+    if checkpoint_path:
+        os.makedirs(checkpoint_path, exist_ok=True)
+
+    run_started = time.time()
+    dispatcher = Dispatcher(make_celery(), *make_filters(filenames))
+    summary = [dispatcher.process_file(filename) for filename in filenames]
+    dispatcher.finish()
+    write_summary(run_started, summary)
+
 
-    # Move file to the processed folder
-    shutil.move(os.path.join(input_path, filename), os.path.join(processed_path, filename))
+if __name__ == '__main__':
+    main()
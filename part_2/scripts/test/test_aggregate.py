@@ -0,0 +1,211 @@
+import os
+import asyncio
+import mock
+import pytest
+import aggregate
+
+def run(coroutine):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        loop.close()
+
+class FakeChecker:
+    '''
+    Answers from a dict of verdicts, recording the checks and how many ran at once
+    '''
+    def __init__(self, verdicts):
+        self.verdicts = verdicts
+        self.checked = []
+        self.running = 0
+        self.max_running = 0
+
+    async def check(self, image):
+        self.checked.append(image)
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.001)
+        self.running -= 1
+        return self.verdicts[image]
+
+@mock.patch.object(aggregate, 'max_images', 3)
+@mock.patch.object(aggregate, 'product_inflight', 3)
+class TestVerifyProduct:
+
+    def test_stops_at_max_valid_images(self):
+        '''
+        Case where the first images are valid: no check starts once the product is complete
+        '''
+        checker = FakeChecker({f'{number}.png': True for number in range(1, 7)})
+        images = [f'{number}.png' for number in range(1, 7)]
+
+        assert run(aggregate.verify_product(checker, images)) == ['1.png', '2.png', '3.png']
+        assert checker.checked == ['1.png', '2.png', '3.png']
+
+    def test_invalid_images_are_replaced(self):
+        '''
+        Case where invalid images are replaced by the next candidates, keeping the dump order
+        '''
+        verdicts = {'1.png': True, '5.png': False, '2.png': False, '3.png': True, '4.png': True, '6.png': True}
+        checker = FakeChecker(verdicts)
+        images = ['1.png', '5.png', '2.png', '3.png', '4.png', '6.png']
+
+        assert run(aggregate.verify_product(checker, images)) == ['1.png', '3.png', '4.png']
+        assert checker.checked == ['1.png', '5.png', '2.png', '3.png', '4.png']
+        assert checker.max_running <= 3
+
+    def test_missing_verdicts_are_not_valid(self):
+        '''
+        Case where the image server kept failing for an image (no verdict)
+        '''
+        checker = FakeChecker({'1.png': None, '2.png': True})
+
+        assert run(aggregate.verify_product(checker, ['1.png', '2.png'])) == ['2.png']
+
+    def test_inflight_checks_are_bounded(self):
+        '''
+        Case where only one check per product may be in flight
+        '''
+        checker = FakeChecker({f'{number}.png': False for number in range(10)})
+        with mock.patch.object(aggregate, 'product_inflight', 1):
+            assert run(aggregate.verify_product(checker, [f'{number}.png' for number in range(10)])) == []
+        assert checker.max_running == 1
+        assert len(checker.checked) == 10
+
+class TestImageChecker:
+
+    @mock.patch('aggregate.check_image')
+    def test_shared_image_checked_once(self, mock_check_image):
+        '''
+        Case where products share an image: a single request is made for all of them
+        '''
+        async def check_image(session, image):
+            await asyncio.sleep(0.001)
+            return image != 'http://a/5.png'
+        mock_check_image.side_effect = check_image
+
+        async def verify():
+            checker = aggregate.ImageChecker(None)
+            results = await asyncio.gather(
+                aggregate.verify_product(checker, ['http://a/1.png', 'http://a/5.png']),
+                aggregate.verify_product(checker, ['http://a/5.png', 'http://a/1.png', 'http://a/2.png'])
+            )
+            return results, checker.requests
+
+        results, requests = run(verify())
+        assert results == [['http://a/1.png'], ['http://a/1.png', 'http://a/2.png']]
+        assert requests == 3
+        assert sorted(call[0][1] for call in mock_check_image.call_args_list) == [
+            'http://a/1.png', 'http://a/2.png', 'http://a/5.png'
+        ]
+
+    @mock.patch('aggregate.check_image')
+    def test_stored_verdicts_are_not_requested(self, mock_check_image):
+        '''
+        Case where the verdict store already knows the image
+        '''
+        store = mock.Mock()
+        store.get.return_value = True
+        checker = aggregate.ImageChecker(None, store)
+
+        assert run(checker.check('http://a/1.png')) is True
+        assert checker.cached == 1
+        mock_check_image.assert_not_called()
+
+    @mock.patch.object(aggregate, 'verdict_store_batch', 2)
+    @mock.patch('aggregate.check_image')
+    def test_new_verdicts_are_stored_in_batches(self, mock_check_image):
+        '''
+        Case where the verdicts of requested images are written to the store a batch at a time
+        '''
+        async def check_image(session, image):
+            return image != 'http://a/2.png'
+        mock_check_image.side_effect = check_image
+        store = mock.Mock()
+        store.get.return_value = None
+        checker = aggregate.ImageChecker(None, store)
+
+        async def check():
+            for number in range(3):
+                await checker.check(f'http://a/{number}.png')
+
+        run(check())
+        store.put_many.assert_called_once_with([('http://a/0.png', 200), ('http://a/1.png', 200)])
+        assert checker.unstored == [('http://a/2.png', 404)]
+
+class TestMain:
+
+    @pytest.fixture
+    def folders(self, tmp_path):
+        paths = {name: tmp_path / name for name in ['input', 'output', 'processed']}
+        for path in paths.values():
+            path.mkdir()
+        (paths['input'] / 'dump.json').write_text(
+            '{"productId": "pid1", "image": "http://a/1.png"}\n'
+            '{"productId": "pid1", "image": "http://a/2.png"}\n'
+            '{"productId": "pid2", "image": "http://a/3.png"}\n'
+        )
+        with mock.patch.object(aggregate, 'input_path', str(paths['input'])), \
+                mock.patch.object(aggregate, 'output_path', str(paths['output'])), \
+                mock.patch.object(aggregate, 'processed_path', str(paths['processed'])), \
+                mock.patch.object(aggregate, 'verdict_store_url', None), \
+                mock.patch.object(aggregate, 'max_images', 1):
+            yield paths
+
+    def aggregate(self, verdicts):
+        async def check_image(session, image):
+            return verdicts[image]
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            with mock.patch('aggregate.check_image', side_effect=check_image):
+                aggregate.main()
+        finally:
+            asyncio.set_event_loop(None)
+            loop.close()
+
+    def test_dumps_are_moved_once_aggregated(self, folders):
+        '''
+        Case where a failed check did not matter: pid1 has its image without it
+        '''
+        self.aggregate({'http://a/1.png': True, 'http://a/2.png': None, 'http://a/3.png': False})
+
+        assert os.listdir(str(folders['processed'])) == ['dump.json']
+        output = folders['output'] / os.listdir(str(folders['output']))[0]
+        assert output.read_text() == ('{"productId": "pid1", "images": ["http://a/1.png"]}\n'
+                                      '{"productId": "pid2", "images": []}\n')
+
+    def test_failed_checks_leave_the_dumps(self, folders):
+        '''
+        Case where a product may miss an image because its check kept failing:
+        no output is written and the dumps are left to be aggregated again
+        '''
+        with pytest.raises(SystemExit) as exit:
+            self.aggregate({'http://a/1.png': False, 'http://a/2.png': True, 'http://a/3.png': None})
+
+        assert exit.value.code == 1
+        assert os.listdir(str(folders['input'])) == ['dump.json']
+        assert os.listdir(str(folders['output'])) == []
+
+class TestWriteOutput:
+
+    def test_output_is_renamed_once_complete(self, tmp_path):
+        '''
+        Case where the output dump is written to a hidden file and renamed
+        '''
+        with mock.patch.object(aggregate, 'output_path', str(tmp_path)):
+            filename = aggregate.write_output({'pid1': None}, {'pid1': ['http://a/1.png']})
+
+        assert os.listdir(str(tmp_path)) == [filename]
+        assert (tmp_path / filename).read_text() == '{"productId": "pid1", "images": ["http://a/1.png"]}\n'
+
+    def test_failed_output_leaves_no_dump(self, tmp_path):
+        '''
+        Case where writing fails halfway: no truncated dump is left behind
+        '''
+        with mock.patch.object(aggregate, 'output_path', str(tmp_path)):
+            with pytest.raises(KeyError):
+                aggregate.write_output({'pid1': None, 'pid2': None}, {'pid1': ['http://a/1.png']})
+
+        assert os.listdir(str(tmp_path)) == []
@@ -0,0 +1,162 @@
+import gzip
+import mock
+import pytest
+import checkpoints
+import dedup
+import startup
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class Crash(BaseException):
+    '''
+    Stops a run the way a killed process would (not caught by the dispatcher)
+    '''
+
+class TestCheckpoints:
+
+    def test_save_load_and_remove(self, tmp_path):
+        '''
+        Case where a checkpoint is written, replaced, read and removed
+        '''
+        checkpoints.save(str(tmp_path), 'dump.json', 100, 10)
+        checkpoints.save(str(tmp_path), 'dump.json', 200, 20)
+
+        assert checkpoints.load(str(tmp_path), 'dump.json', 300) == {'offset': 200, 'lines': 20, 'done': False}
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['dump.json.checkpoint']
+
+        checkpoints.remove(str(tmp_path), 'dump.json')
+        assert checkpoints.load(str(tmp_path), 'dump.json', 300) is None
+        checkpoints.remove(str(tmp_path), 'dump.json')
+
+    def test_checkpoint_past_the_end_of_the_dump(self, tmp_path):
+        '''
+        Case where the dump is smaller than the checkpoint offset (a new file with the same name),
+        and where the size cannot be compared (compressed dumps)
+        '''
+        checkpoints.save(str(tmp_path), 'dump.json', 200, 20, done=True)
+
+        assert checkpoints.load(str(tmp_path), 'dump.json', 100) is None
+        assert checkpoints.load(str(tmp_path), 'dump.json', None)['done'] is True
+
+    def test_unreadable_checkpoint(self, tmp_path):
+        '''
+        Case where the checkpoint file is not json
+        '''
+        (tmp_path / 'dump.json.checkpoint').write_text('{"offset": 1')
+        assert checkpoints.load(str(tmp_path), 'dump.json', 100) is None
+
+def lines(count):
+    return [f'{{"productId": "pid{number}", "image": "http://a/{number}.png"}}\n' for number in range(count)]
+
+@pytest.fixture
+def folders(tmp_path):
+    '''
+    Input, processed and checkpoint folders of startup.py
+    '''
+    paths = {name: tmp_path / name for name in ['input', 'processed', 'checkpoints']}
+    for path in paths.values():
+        path.mkdir()
+    with mock.patch.object(startup, 'input_path', str(paths['input'])), \
+            mock.patch.object(startup, 'processed_path', str(paths['processed'])), \
+            mock.patch.object(startup, 'checkpoint_path', str(paths['checkpoints'])), \
+            mock.patch.object(startup, 'checkpoint_every', 3), \
+            mock.patch.object(startup, 'parse_processes', 1), \
+            mock.patch.object(startup, 'batch_size', 1), \
+            mock.patch.object(startup, 'partitions', 0):
+        yield paths
+
+def crash_after(sends):
+    '''
+    Celery app whose broker goes away after a number of messages
+    '''
+    celery = mock.Mock()
+    celery.send_task.side_effect = [None] * sends + [Crash()]
+    return celery
+
+def sent_images(celery):
+    return [call[1]['args'][0]['image'] for call in celery.send_task.call_args_list]
+
+class TestResume:
+
+    def resume(self, folders, write):
+        '''
+        Crash while sending the 8th line, then run again: return the images sent by each run
+        '''
+        write(folders['input'] / 'dump.json', ''.join(lines(10)).encode('utf-8'))
+
+        crashed = crash_after(7)
+        with pytest.raises(Crash):
+            startup.Dispatcher(crashed).process_file('dump.json')
+        assert checkpoints.load(str(folders['checkpoints']), 'dump.json', None)['lines'] == 6
+
+        celery = mock.Mock()
+        summary = startup.Dispatcher(celery).process_file('dump.json')
+
+        assert summary['skipped'] == 6 and summary['sent'] == 4
+        assert (folders['processed'] / 'dump.json').exists()
+        assert list(folders['checkpoints'].iterdir()) == []
+        return sent_images(crashed)[:7], sent_images(celery)
+
+    def test_resume_plain_dump(self, folders):
+        '''
+        Case where a plain dump is resumed from the offset of its last checkpoint
+        '''
+        first, second = self.resume(folders, lambda path, data: path.write_bytes(data))
+
+        assert second == [f'http://a/{number}.png' for number in range(6, 10)]
+        assert set(first + second) == {f'http://a/{number}.png' for number in range(10)}
+
+    def test_resume_gzip_dump(self, folders):
+        '''
+        Case where a gzip dump is resumed from an offset in its decompressed stream
+        '''
+        first, second = self.resume(folders, lambda path, data: path.write_bytes(gzip.compress(data)))
+
+        assert second == [f'http://a/{number}.png' for number in range(6, 10)]
+        assert set(first + second) == {f'http://a/{number}.png' for number in range(10)}
+
+    @pytest.mark.skipif(zstandard is None, reason='zstandard is not installed')
+    def test_resume_zstd_dump(self, folders):
+        '''
+        Case where a zstd dump (which cannot seek) is resumed from an offset in its decompressed stream
+        '''
+        compress = zstandard.ZstdCompressor().compress
+        first, second = self.resume(folders, lambda path, data: path.write_bytes(compress(data)))
+
+        assert second == [f'http://a/{number}.png' for number in range(6, 10)]
+        assert set(first + second) == {f'http://a/{number}.png' for number in range(10)}
+
+    def test_filters_are_restored(self, folders):
+        '''
+        Case where lines after the checkpoint repeat lines before it: they are still dropped,
+        and the delta index of the resumed run has the pairs of the whole dump
+        '''
+        data = ''.join(lines(10) + lines(3))
+        (folders['input'] / 'dump.json').write_text(data)
+        checkpoints.save(str(folders['checkpoints']), 'dump.json', len(''.join(lines(6))), 6)
+        celery = mock.Mock()
+        current = dedup.HashSet64()
+
+        summary = startup.Dispatcher(celery, dedup.BloomFilter(100), dedup.HashSet64(), current).process_file('dump.json')
+
+        assert sent_images(celery) == [f'http://a/{number}.png' for number in range(6, 10)]
+        assert summary['dropped'] == 3
+        assert len(current) == 10
+
+    def test_finished_dump_is_not_sent_again(self, folders):
+        '''
+        Case where the run stopped after the dump was sent, before it was moved
+        '''
+        data = ''.join(lines(4))
+        (folders['input'] / 'dump.json').write_text(data)
+        checkpoints.save(str(folders['checkpoints']), 'dump.json', len(data), 4, done=True)
+        celery = mock.Mock()
+
+        summary = startup.Dispatcher(celery).process_file('dump.json')
+
+        celery.send_task.assert_not_called()
+        assert summary['skipped'] == 4
+        assert (folders['processed'] / 'dump.json').exists()
@@ -0,0 +1,120 @@
+import io
+import os
+import mock
+import pytest
+import consolidate
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+class FakePool:
+    '''
+    Pool rendering each batch when it is submitted, recording how many were not collected yet
+    '''
+    def __init__(self):
+        self.pending = 0
+        self.max_pending = 0
+
+    def apply_async(self, function, args):
+        self.pending += 1
+        self.max_pending = max(self.max_pending, self.pending)
+        result = mock.Mock()
+        def get():
+            self.pending -= 1
+            return function(*args)
+        result.get.side_effect = get
+        return result
+
+def batches(count):
+    return [[f'pid{batch}-{number}' for number in range(2)] for batch in range(count)]
+
+def render_batch(keys):
+    return [consolidate.render_entry(key, {f'http://a/{key}.png': '1'}) for key in keys]
+
+@mock.patch('consolidate.render_batch', render_batch)
+class TestConsolidate:
+
+    @mock.patch.object(consolidate, 'inflight_batches', 3)
+    @mock.patch('consolidate.scan_batches')
+    def test_pool_batches_are_bounded(self, mock_scan):
+        '''
+        Case where the keyspace is scanned faster than batches are written:
+        only a few batches are handed to the pool ahead of the writer, and they are written in order
+        '''
+        mock_scan.return_value = iter(batches(10))
+        pool = FakePool()
+
+        lines = [line for batch in consolidate.pooled_batches(pool) for line in batch]
+
+        assert pool.max_pending == 3
+        assert lines == [entry for keys in batches(10) for entry in render_batch(keys)]
+
+    @pytest.mark.parametrize('compression', [
+        'none', 'gzip',
+        pytest.param('zstd', marks=pytest.mark.skipif(zstandard is None, reason='zstandard is not installed'))
+    ])
+    @mock.patch('consolidate.connect')
+    @mock.patch('consolidate.scan_batches')
+    @mock.patch('consolidate.os.fsync')
+    def test_output_is_synced_before_the_rename(self, mock_fsync, mock_scan, mock_connect, compression, tmp_path):
+        '''
+        Case where the output is complete: it is flushed to disk before it gets its final name
+        '''
+        mock_scan.return_value = iter(batches(2))
+        def fsync(fd):
+            # Not renamed yet
+            assert [name.startswith('.') for name in os.listdir(str(tmp_path))] == [True]
+        mock_fsync.side_effect = fsync
+
+        with mock.patch.object(consolidate, 'output_path', str(tmp_path)), \
+                mock.patch.object(consolidate, 'compression', compression), \
+                mock.patch.object(consolidate, 'output_index', None):
+            consolidate.main()
+
+        mock_fsync.assert_called_once()
+        filenames = os.listdir(str(tmp_path))
+        assert len(filenames) == 1 and filenames[0].endswith(consolidate.extensions[compression])
+
+class TestDeltaMode:
+
+    def run(self, memory, tmp_path):
+        '''
+        Consolidate a shared memory given as {productId: stored hash} in delta mode
+        and return the written lines
+        '''
+        index = str(tmp_path / 'output-index')
+        def render_batch(keys):
+            return [consolidate.render_entry(key, memory[key]) for key in keys]
+        with mock.patch.object(consolidate, 'output_index', index), \
+                mock.patch('consolidate.render_batch', render_batch), \
+                mock.patch('consolidate.scan_batches', return_value=iter([list(memory)])):
+            output_file = io.BytesIO()
+            current = consolidate.OutputIndex(index)
+            consolidate.consolidate(output_file, consolidate.PreviousIndex(index), current)
+            current.save()
+        return output_file.getvalue().decode('utf-8').splitlines()
+
+    def test_only_changed_and_gone_products_are_written(self, tmp_path):
+        '''
+        Case where the images of a product are stored in another order (unchanged), another
+        product gets a new valid image and a third one is not in shared memory anymore
+        '''
+        first = {
+            'pid1': {'http://a/1.png': '1', 'http://a/2.png': '1'},
+            'pid2': {'http://a/3.png': '1', 'http://a/4.png': '0'},
+            'pid3': {'http://a/5.png': '1'}
+        }
+        second = {
+            'pid1': {'http://a/2.png': '1', 'http://a/1.png': '1'},
+            'pid2': {'http://a/3.png': '1', 'http://a/4.png': '1'}
+        }
+
+        assert len(self.run(first, tmp_path)) == 3
+        assert self.run(second, tmp_path) == [
+            '{"productId": "pid2", "images": ["http://a/3.png", "http://a/4.png"]}',
+            '{"productId": "pid3", "images": []}'
+        ]
+        assert self.run(second, tmp_path) == []
+        assert sorted(path.name for path in tmp_path.iterdir()) == ['output-index', 'output-index.ids']
@@ -0,0 +1,111 @@
+import pytest
+import dedup
+
+def keys(count, start=0):
+    return [dedup.pair_key(f'pid{number}', f'http://a/{number}.png') for number in range(start, start + count)]
+
+class TestHashSet64:
+
+    def test_repeated_keys_are_found(self):
+        '''
+        Case where every added key is found again and new keys are not
+        '''
+        hash_set = dedup.HashSet64(100)
+        added = keys(100)
+
+        assert all(hash_set.add(key) for key in added)
+        assert not any(hash_set.add(key) for key in added)
+        assert all(key in hash_set for key in added)
+        assert not any(key in hash_set for key in keys(100, start=100))
+        assert len(hash_set) == 100
+
+    def test_grows_past_capacity(self):
+        '''
+        Case where many more keys than the capacity are added: none of them is lost
+        '''
+        hash_set = dedup.HashSet64(10)
+        size = hash_set.nbytes
+        added = keys(20000)
+        for key in added:
+            hash_set.add(key)
+
+        assert hash_set.nbytes > size
+        assert len(hash_set) == 20000
+        assert all(key in hash_set for key in added)
+
+    def test_key_zero_is_stored(self):
+        '''
+        Case where the low 64 bits of a key are 0, the value of an empty slot
+        '''
+        hash_set = dedup.HashSet64()
+        assert hash_set.add(1 << 64)
+        assert (1 << 64) in hash_set
+        assert not hash_set.add(1 << 64)
+
+    def test_save_and_load(self, tmp_path):
+        '''
+        Case where a set is written by one run and read by the next one
+        '''
+        path = str(tmp_path / 'index')
+        hash_set = dedup.HashSet64(10)
+        added = keys(5000)
+        for key in added:
+            hash_set.add(key)
+        hash_set.save(path)
+
+        loaded = dedup.HashSet64.load(path)
+        assert len(loaded) == 5000
+        assert all(key in loaded for key in added)
+        assert not any(key in loaded for key in keys(100, start=5000))
+        assert loaded.add(keys(1, start=5000)[0])
+        assert list(tmp_path.iterdir()) == [tmp_path / 'index']
+
+    def test_load_without_file(self, tmp_path):
+        '''
+        Case where there is no previous index
+        '''
+        assert len(dedup.HashSet64.load(str(tmp_path / 'index'))) == 0
+
+class TestBloomFilter:
+
+    def test_no_false_negatives(self):
+        '''
+        Case where every added key is reported as repeated
+        '''
+        bloom = dedup.BloomFilter(10000, 0.01)
+        added = keys(10000)
+        for key in added:
+            bloom.add(key)
+
+        assert not any(bloom.add(key) for key in added)
+
+    def test_false_positive_rate(self):
+        '''
+        Case where new keys are rarely taken for repeated ones at capacity
+        '''
+        bloom = dedup.BloomFilter(10000, 0.01)
+        for key in keys(10000):
+            bloom.add(key)
+
+        # Few probes, each new key also fills the filter a little more
+        false_positives = sum(not bloom.add(key) for key in keys(1000, start=10000))
+        assert false_positives < 30
+
+class TestMakeFilter:
+
+    def test_modes(self):
+        '''
+        Case where each dedup mode builds its structure
+        '''
+        assert isinstance(dedup.make_filter('set', 100), dedup.HashSet64)
+        assert isinstance(dedup.make_filter('bloom', 100), dedup.BloomFilter)
+        assert dedup.make_filter('off', 100) is None
+        with pytest.raises(ValueError):
+            dedup.make_filter('other', 100)
+
+    def test_pair_key_separates_fields(self):
+        '''
+        Case where the same characters are split differently between productId and image
+        '''
+        assert dedup.pair_key('pid1', 'http://a/1.png') == dedup.pair_key('pid1', 'http://a/1.png')
+        assert dedup.pair_key('pid1', '2.png') != dedup.pair_key('pid12', '.png')
@@ -0,0 +1,138 @@
+import gzip
+import json
+import pytest
+import dedup
+import parsing
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# zstd input needs the optional zstandard package
+needs_zstandard = pytest.mark.skipif(zstandard is None, reason='zstandard is not installed')
+
+def lines(count):
+    return [f'{{"productId": "pid{number}", "image": "http://a/{number}.png"}}\n'.encode('utf-8')
+            for number in range(count)]
+
+class TestParseLine:
+
+    @pytest.mark.parametrize('line', [
+        b'{"productId": "pid1", "image": "http://a/1.png"}\n',
+        b'  {"productId":"pid1","image":"http://a/1.png"}  \r\n',
+        '{"productId": "pidç", "image": "http://a/ç.png"}'.encode('utf-8'),
+    ])
+    def test_fast_path_matches_json(self, line):
+        '''
+        Case where a fixed-shape line is read by the regular expression, as json would read it
+        '''
+        assert parsing.LINE.match(line)
+        payload = json.loads(line)
+        assert parsing.parse_line(line) == (payload['productId'], payload['image'])
+
+    @pytest.mark.parametrize('line', [
+        b'{"productId": "pid\\"1", "image": "http://a/1.png"}\n',
+        b'{"productId": "pid\\u00e71", "image": "http://a/1.png"}\n',
+        b'{"image": "http://a/1.png", "productId": "pid1"}\n',
+        b'{"productId": "pid1", "image": "http://a/1.png", "size": 10}\n',
+        b'{"productId": 1, "image": "http://a/1.png"}\n',
+    ])
+    def test_json_fallback(self, line):
+        '''
+        Case where escapes, reordered or extra keys and non-string values go to json.loads
+        '''
+        assert not parsing.LINE.match(line)
+        payload = json.loads(line)
+        assert parsing.parse_line(line) == (payload['productId'], payload['image'])
+
+    @pytest.mark.parametrize('line', [
+        b'{"productId": "pid1", "image": "http://a/1.png"\n',
+        b'{"productId": "pid1"}\n',
+        b'["pid1", "http://a/1.png"]\n',
+        b'{"productId": "pid\xff", "image": "http://a/1.png"}\n',
+        b'not json\n',
+    ])
+    def test_malformed_lines(self, line):
+        '''
+        Case where truncated lines, missing keys, other json values and invalid utf-8 are malformed
+        '''
+        assert parsing.parse_line(line) is None
+
+class TestChunks:
+
+    def test_ranges_end_on_newlines(self, tmp_path):
+        '''
+        Case where a dump is split in ranges: each one ends after a line and together they cover it
+        '''
+        data = b''.join(lines(100))
+        path = tmp_path / 'dump.json'
+        path.write_bytes(data)
+
+        ranges = parsing.chunks(str(path), 0, 100)
+
+        assert ranges[0][0] == 0 and ranges[-1][1] == len(data)
+        assert all(end == next_start for (_, end), (next_start, _) in zip(ranges, ranges[1:]))
+        assert all(data[end - 1:end] == b'\n' for _, end in ranges)
+        assert len(ranges) > 10
+
+    def test_last_line_without_newline(self, tmp_path):
+        '''
+        Case where the dump does not end with a newline, starting from an offset
+        '''
+        data = b''.join(lines(10)).rstrip(b'\n')
+        path = tmp_path / 'dump.json'
+        path.write_bytes(data)
+        start = len(lines(1)[0])
+
+        ranges = parsing.chunks(str(path), start, 150)
+
+        assert ranges[0][0] == start and ranges[-1][1] == len(data)
+        assert parsing.chunks(str(path), len(data), 150) == []
+
+    def test_parse_chunk(self, tmp_path):
+        '''
+        Case where a range with a blank and a malformed line is parsed
+        '''
+        data = lines(2)[0] + b'\n' + b'{"productId": \n' + lines(2)[1]
+        path = tmp_path / 'dump.json'
+        path.write_bytes(data)
+
+        end, count, pairs, malformed = parsing.parse_chunk((str(path), 0, len(data)))
+
+        assert (end, count) == (len(data), 4)
+        assert pairs == [(dedup.pair_key(f'pid{number}', f'http://a/{number}.png'), f'pid{number}',
+                          f'http://a/{number}.png') for number in range(2)]
+        assert malformed == [(len(lines(1)[0]) + 1, b'{"productId": \n')]
+
+class TestOpenDump:
+
+    @pytest.mark.parametrize('compress', [
+        pytest.param(lambda data: data, id='plain'),
+        pytest.param(gzip.compress, id='gzip'),
+        pytest.param(lambda data: zstandard.ZstdCompressor().compress(data), id='zstd', marks=needs_zstandard),
+    ])
+    def test_resume_from_offset(self, tmp_path, compress):
+        '''
+        Case where a dump is read again from an offset of its decompressed stream
+        '''
+        dump = lines(1000)
+        path = tmp_path / 'dump'
+        path.write_bytes(compress(b''.join(dump)))
+        offset = sum(len(line) for line in dump[:600])
+
+        with parsing.open_dump(str(path)) as dump_file:
+            parsing.skip(dump_file, offset, chunk_size=1000)
+            assert list(dump_file) == dump[600:]
+
+    @needs_zstandard
+    def test_offset_past_the_end(self, tmp_path):
+        '''
+        Case where a compressed stream ends before the offset
+        '''
+        path = tmp_path / 'dump'
+        path.write_bytes(zstandard.ZstdCompressor().compress(b''.join(lines(10))))
+
+        with parsing.open_dump(str(path)) as dump_file:
+            parsing.skip(dump_file, 10 ** 6)
+            assert dump_file.read() == b''
@@ -0,0 +1,92 @@
+import mock
+import dedup
+import startup
+
+def pair(number):
+    product_id, image = f'pid{number}', f'http://a/{number}.png'
+    return dedup.pair_key(product_id, image), product_id, image
+
+def sent(celery):
+    return [call[1]['args'][0] for call in celery.send_task.call_args_list]
+
+@mock.patch.object(startup, 'batch_size', 1)
+@mock.patch.object(startup, 'partitions', 0)
+@mock.patch.object(startup, 'task', 'test_task')
+@mock.patch.object(startup, 'queue', 'test_queue')
+class TestDeltaMode:
+
+    def test_pairs_of_the_previous_run_are_not_sent(self):
+        '''
+        Case where half the pairs were sent by the previous run
+        '''
+        previous = dedup.HashSet64()
+        for number in range(5):
+            previous.add(pair(number)[0])
+        celery = mock.Mock()
+        dispatcher = startup.Dispatcher(celery, dedup.HashSet64(), previous, None)
+        dispatcher.current = dispatcher.seen
+
+        statuses = [dispatcher.process_pair(*pair(number)) for number in range(10)]
+
+        assert statuses == ['unchanged'] * 5 + ['sent'] * 5
+        assert sent(celery) == [{'productId': f'pid{number}', 'image': f'http://a/{number}.png'}
+                                for number in range(5, 10)]
+        assert all(pair(number)[0] in dispatcher.current for number in range(10))
+
+    def test_index_is_kept_beside_a_bloom_filter(self):
+        '''
+        Case where the dedup filter is a Bloom filter: every pair, repeated or not, is in the
+        index of this run, and repeated pairs are still dropped
+        '''
+        celery = mock.Mock()
+        dispatcher = startup.Dispatcher(celery, dedup.BloomFilter(100), dedup.HashSet64(), dedup.HashSet64())
+
+        statuses = [dispatcher.process_pair(*pair(number)) for number in [1, 2, 1]]
+
+        assert statuses == ['sent', 'sent', 'dropped']
+        assert len(dispatcher.current) == 2
+        assert celery.send_task.call_count == 2
+
+    def test_index_replaced_at_the_end_of_the_run(self, tmp_path):
+        '''
+        Case where a run sends new pairs: the next run only sends pairs it has not seen
+        '''
+        index = str(tmp_path / 'delta.index')
+        previous = dedup.HashSet64()
+        previous.add(pair(0)[0])
+        previous.save(index)
+        input_path = tmp_path / 'input'
+        input_path.mkdir()
+        (input_path / 'dump.json').write_text('x' * 6400)
+
+        with mock.patch.object(startup, 'delta_index', index), \
+                mock.patch.object(startup, 'input_path', str(input_path)), \
+                mock.patch.object(startup, 'dedup_mode', 'set'):
+            celery = mock.Mock()
+            dispatcher = startup.Dispatcher(celery, *startup.make_filters(['dump.json']))
+            assert [dispatcher.process_pair(*pair(number)) for number in range(2)] == ['unchanged', 'sent']
+            dispatcher.finish()
+
+            celery = mock.Mock()
+            dispatcher = startup.Dispatcher(celery, *startup.make_filters(['dump.json']))
+            assert [dispatcher.process_pair(*pair(number)) for number in range(3)] == [
+                'unchanged', 'unchanged', 'sent'
+            ]
+            assert sent(celery) == [{'productId': 'pid2', 'image': 'http://a/2.png'}]
+
+    def test_interrupted_run_keeps_the_previous_index(self, tmp_path):
+        '''
+        Case where the run stops before finish: the index of the previous run is not replaced
+        '''
+        index = str(tmp_path / 'delta.index')
+        previous = dedup.HashSet64()
+        previous.add(pair(0)[0])
+        previous.save(index)
+
+        with mock.patch.object(startup, 'delta_index', index), \
+                mock.patch.object(startup, 'dedup_capacity', 100):
+            dispatcher = startup.Dispatcher(mock.Mock(), *startup.make_filters([]))
+            dispatcher.process_pair(*pair(1))
+
+        loaded = dedup.HashSet64.load(index)
+        assert len(loaded) == 1 and pair(0)[0] in loaded
@@ -0,0 +1,177 @@
+import multiprocessing
+import mock
+import pytest
+import dedup
+import startup
+import watch
+
+class Stop(BaseException):
+    '''
+    Ends the watch loop of a test
+    '''
+
+class FakeWatch:
+    '''
+    inotify watch reporting a dump written after the watch started, then nothing
+    '''
+    def __init__(self, input_path, rounds):
+        self.input_path = input_path
+        self.rounds = rounds
+        self.calls = 0
+
+    def read(self, timeout):
+        self.calls += 1
+        if self.calls > self.rounds:
+            raise Stop()
+        if self.calls == 1:
+            (self.input_path / 'dump.json').write_text('{"productId": "pid1", "image": "http://a/1.png"}\n')
+            return {'dump.json'}
+        return set()
+
+def result(error=None):
+    '''
+    Finished pool result of a producer
+    '''
+    async_result = mock.Mock()
+    async_result.ready.return_value = True
+    if error:
+        async_result.get.side_effect = error
+    else:
+        async_result.get.return_value = {'filename': 'dump.json', 'read': 1, 'skipped': 0}
+    return async_result
+
+@mock.patch('watch.signal.signal')
+@mock.patch('watch.startup.make_celery')
+@mock.patch.object(watch, 'consolidate_when_drained', False)
+@mock.patch.object(startup, 'checkpoint_path', None)
+class TestWatch:
+
+    @mock.patch.object(watch, 'retry_delay', 0)
+    @mock.patch('watch.logging')
+    @mock.patch('watch.multiprocessing.Pool')
+    def test_failed_dump_is_retried(self, mock_pool, mock_logging, mock_make_celery, mock_signal, tmp_path):
+        '''
+        Case where the producer of a dump reported by inotify fails: it is sent again
+        '''
+        pool = mock_pool.return_value
+        pool.apply_async.side_effect = [result(ValueError('broker down')), result()]
+
+        with mock.patch.object(startup, 'input_path', str(tmp_path)), \
+                mock.patch('watch.open_watch', return_value=FakeWatch(tmp_path, rounds=4)):
+            with pytest.raises(Stop):
+                watch.main()
+
+        assert pool.apply_async.call_args_list == [mock.call(watch.process_dump, ('dump.json',))] * 2
+        mock_logging.error.assert_called_once_with('dump.json: broker down')
+        pool.join.assert_called_once()
+
+    @mock.patch.object(watch, 'retry_delay', 60)
+    @mock.patch('watch.logging')
+    @mock.patch('watch.multiprocessing.Pool')
+    def test_failed_dump_waits_before_retrying(self, mock_pool, mock_logging, mock_make_celery, mock_signal, tmp_path):
+        '''
+        Case where the producer of a dump fails: it is not sent again before the retry delay
+        '''
+        pool = mock_pool.return_value
+        pool.apply_async.side_effect = [result(ValueError('broker down')), result()]
+
+        with mock.patch.object(startup, 'input_path', str(tmp_path)), \
+                mock.patch('watch.open_watch', return_value=FakeWatch(tmp_path, rounds=4)):
+            with pytest.raises(Stop):
+                watch.main()
+
+        assert pool.apply_async.call_count == 1
+
+    @mock.patch.object(watch, 'retry_delay', 0)
+    @mock.patch.object(watch, 'max_attempts', 2)
+    @mock.patch('watch.logging')
+    @mock.patch('watch.multiprocessing.Pool')
+    def test_failing_dump_is_quarantined(self, mock_pool, mock_logging, mock_make_celery, mock_signal, tmp_path):
+        '''
+        Case where the producer of a dump keeps failing: the dump is moved to the quarantine folder
+        '''
+        input_path, quarantine_path = tmp_path / 'input', tmp_path / 'quarantine'
+        input_path.mkdir()
+        pool = mock_pool.return_value
+        pool.apply_async.side_effect = lambda function, args: result(ValueError('broker down'))
+
+        with mock.patch.object(startup, 'input_path', str(input_path)), \
+                mock.patch.object(watch, 'quarantine_path', str(quarantine_path)), \
+                mock.patch('watch.open_watch', return_value=FakeWatch(input_path, rounds=6)):
+            with pytest.raises(Stop):
+                watch.main()
+
+        assert pool.apply_async.call_count == 2
+        assert list(input_path.iterdir()) == []
+        assert [path.name for path in quarantine_path.iterdir()] == ['dump.json']
+        mock_logging.error.assert_called_with(f'dump.json: failed 2 times, moved to {quarantine_path}')
+
+def pairs(dump):
+    return [(f'pid{dump}-{number}', f'http://a/{dump}/{number}.png') for number in range(200)]
+
+def test_concurrent_dumps_share_the_delta_index(tmp_path):
+    '''
+    Case where producers finish their dumps at the same time in delta mode:
+    the pairs of every dump end up in the index
+    '''
+    input_path, processed_path = tmp_path / 'input', tmp_path / 'processed'
+    input_path.mkdir()
+    processed_path.mkdir()
+    filenames = [f'dump{dump}.json' for dump in range(8)]
+    for dump, filename in enumerate(filenames):
+        (input_path / filename).write_text(''.join(
+            f'{{"productId": "{product_id}", "image": "{image}"}}\n' for product_id, image in pairs(dump)
+        ))
+    index = str(tmp_path / 'delta.index')
+
+    # Settings and producer are inherited by the forked producers
+    with mock.patch.object(startup, 'input_path', str(input_path)), \
+            mock.patch.object(startup, 'processed_path', str(processed_path)), \
+            mock.patch.object(startup, 'delta_index', index), \
+            mock.patch.object(startup, 'dedup_mode', 'set'), \
+            mock.patch.object(startup, 'checkpoint_path', None), \
+            mock.patch.object(startup, 'batch_size', 1), \
+            mock.patch.object(watch, 'producer', mock.Mock()):
+        with multiprocessing.get_context('fork').Pool(4) as pool:
+            summaries = pool.map(watch.process_dump, filenames)
+
+    assert [summary['sent'] for summary in summaries] == [200] * 8
+    loaded = dedup.HashSet64.load(index + '.cycle')
+    assert len(loaded) == 1600
+    assert all(dedup.pair_key(*pair) in loaded for dump in range(8) for pair in pairs(dump))
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['delta.index.cycle', 'delta.index.cycle.lock',
+                                                                 'input', 'processed']
+
+def test_delta_index_is_replaced_once_consolidated(tmp_path):
+    '''
+    Case where a dump repeats a pair of the previous cycle and a pair sent earlier in this cycle:
+    only its new pair is sent, and the pairs of this cycle replace the index once consolidated
+    '''
+    input_path, processed_path = tmp_path / 'input', tmp_path / 'processed'
+    input_path.mkdir()
+    processed_path.mkdir()
+    dump = pairs(0)[:3]
+    (input_path / 'dump.json').write_text(''.join(
+        f'{{"productId": "{product_id}", "image": "{image}"}}\n' for product_id, image in dump
+    ))
+    index = str(tmp_path / 'delta.index')
+    stale = ('old', 'http://a/old.png')
+    for path, saved_pairs in ((index, [dump[0], stale]), (index + '.cycle', [dump[1]])):
+        saved = dedup.HashSet64()
+        for pair in saved_pairs:
+            saved.add(dedup.pair_key(*pair))
+        saved.save(path)
+
+    with mock.patch.object(startup, 'input_path', str(input_path)), \
+            mock.patch.object(startup, 'processed_path', str(processed_path)), \
+            mock.patch.object(startup, 'delta_index', index), \
+            mock.patch.object(startup, 'checkpoint_path', None), \
+            mock.patch.object(watch, 'producer', mock.Mock()):
+        summary = watch.process_dump('dump.json')
+        watch.rotate_delta_index()
+
+    assert (summary['sent'], summary['unchanged']) == (1, 2)
+    loaded = dedup.HashSet64.load(index)
+    assert len(loaded) == 3
+    assert dedup.pair_key(*stale) not in loaded
+    assert not (tmp_path / 'delta.index.cycle').exists()
@@ -0,0 +1,296 @@
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import shutil
+import signal
+import ctypes
+import struct
+import logging
+import subprocess
+import multiprocessing
+import dedup
+import startup
+
+# Long running alternative to startup.py: new dumps in INPUT_PATH are noticed with
+# inotify (polling when it is not available), sent by a pool of producer processes
+# and consolidate.py runs once the workers drained everything sent.
+# In delta mode, a consolidation cycle plays the part of a startup.py run: the pairs
+# sent during the cycle are merged into DELTA_INDEX.cycle, which replaces DELTA_INDEX
+# once the cycle is consolidated (so the index never holds more than two cycles).
+
+# Load parameters
+processes = int(os.environ.get('WATCH_PROCESSES', 4))
+poll_interval = float(os.environ.get('WATCH_POLL_INTERVAL', 5))
+# A dump is taken when its size and mtime did not change for this long (with inotify,
+# only dumps already there at start, the others are taken when they are closed or moved in)
+settle_seconds = float(os.environ.get('WATCH_SETTLE', 10))
+consolidate_when_drained = os.environ.get('WATCH_CONSOLIDATE', 'True') == 'True'
+drain_interval = float(os.environ.get('WATCH_DRAIN_INTERVAL', 15))
+# Consolidate anyway when the workers are still busy after this long (retries can take hours)
+drain_timeout = float(os.environ.get('WATCH_DRAIN_TIMEOUT', 60 * 60))
+# A dump whose producer failed is sent again after retry_delay seconds, doubled after each
+# failure. After max_attempts it is moved to QUARANTINE_PATH (without one, it is left in
+# place and only sent again when inotify reports it written again)
+max_attempts = int(os.environ.get('WATCH_MAX_ATTEMPTS', 5))
+retry_delay = float(os.environ.get('WATCH_RETRY_DELAY', 30))
+quarantine_path = os.environ.get('QUARANTINE_PATH')
+
+# inotify events of a file completely written in (or moved into) the folder
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+_EVENT = struct.Struct('iIII')
+
+
+class Inotify:
+    '''
+    Minimal inotify watch of a folder through libc (Linux only)
+    '''
+    def __init__(self, path):
+        self._libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        watch = self._libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+        if watch < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), f'inotify_add_watch failed for {path}')
+
+    def read(self, timeout):
+        '''
+        Wait up to timeout seconds and return the names of the files completed meanwhile
+        '''
+        names = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return names
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                return names
+            raise
+        offset = 0
+        while offset < len(data):
+            _, _, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+
+def open_watch(path):
+    try:
+        return Inotify(path)
+    except (OSError, AttributeError) as e:
+        logging.error(f'inotify not available, polling {path} every {poll_interval}s: {e}')
+        return None
+
+
+def is_dump(filename):
+    # Hidden and temporary files are still being written by whoever produces the dumps
+    return not filename.startswith('.') and not filename.endswith(('.tmp', '.part'))
+
+
+# Celery app of a producer process
+producer = None
+
+
+def init_producer():
+    # Own celery app, and so own broker connection, in each producer process
+    global producer
+    producer = startup.make_celery()
+    # The pool stops its processes with SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def cycle_index():
+    return f'{startup.delta_index}.cycle'
+
+
+def process_dump(filename):
+    '''
+    Send a dump as its own run: dedup over the dump and, in delta mode, against the
+    index of the previous cycle and the dumps sent before it in this cycle (only dumps
+    sent completely are in the index)
+    '''
+    seen, previous, current = startup.make_filters([filename])
+    if previous is not None:
+        previous.update(dedup.HashSet64.load(cycle_index()))
+    dispatcher = startup.Dispatcher(producer, seen, previous, current)
+    summary = dispatcher.process_file(filename)
+    # Other producers save their dumps to the same index
+    dispatcher.finish(merge=cycle_index())
+    return summary
+
+
+def rotate_delta_index():
+    '''
+    Replace the delta index with the pairs of the cycle that was just consolidated
+    '''
+    path = cycle_index()
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            os.replace(path, startup.delta_index)
+
+
+def drained(celery):
+    '''
+    Return True when the queues are empty and no worker holds a task
+    (running, prefetched or waiting for a retry countdown)
+    '''
+    queues = [startup.queue]
+    if startup.partitions:
+        queues = [f'{startup.queue}.{index}' for index in range(startup.partitions)]
+    with celery.connection_for_write() as connection:
+        for queue in queues:
+            # A failed passive declare closes its channel, so each queue gets its own
+            channel = connection.channel()
+            try:
+                _, messages, _ = channel.queue_declare(queue=queue, passive=True)
+            except connection.channel_errors:
+                # Queue not declared yet by any worker
+                messages = 0
+            finally:
+                try:
+                    channel.close()
+                except Exception:
+                    pass
+            if messages:
+                return False
+    inspect = celery.control.inspect(timeout=5)
+    for replies in (inspect.active(), inspect.reserved(), inspect.scheduled()):
+        if any(tasks for tasks in (replies or {}).values()):
+            return False
+    return True
+
+
+def quarantine(filename):
+    '''
+    Move a dump that failed max_attempts times out of the input folder, return True when moved
+    '''
+    if not quarantine_path:
+        logging.error(f'{filename}: failed {max_attempts} times, left in the input folder')
+        return False
+    try:
+        os.makedirs(quarantine_path, exist_ok=True)
+        shutil.move(os.path.join(startup.input_path, filename), os.path.join(quarantine_path, filename))
+    except OSError as e:
+        logging.error(f'{filename}: failed {max_attempts} times, not moved to {quarantine_path}: {e}')
+        return False
+    logging.error(f'{filename}: failed {max_attempts} times, moved to {quarantine_path}')
+    return True
+
+
+def consolidate():
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'consolidate.py')
+    subprocess.run([sys.executable, script], check=True)
+
+
+def main():
+    if startup.checkpoint_path:
+        os.makedirs(startup.checkpoint_path, exist_ok=True)
+    # Stop on docker stop as on Ctrl+C, letting the dumps being sent finish
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    watch = open_watch(startup.input_path)
+    celery = startup.make_celery()
+    pool = multiprocessing.Pool(processes, initializer=init_producer)
+    running = {}
+    # Files seen while polling: (size, mtime, since when they did not change)
+    candidates = {}
+    completed = set()
+    # Dumps whose producer failed, sent again from their checkpoint: (attempts, when)
+    failed = {}
+    existing = set(os.listdir(startup.input_path))
+    drain_started = None
+    next_drain_check = 0
+    run_started = time.time()
+    summary = []
+
+    try:
+        while True:
+            now = time.time()
+            ready = set()
+            if watch is not None:
+                completed |= watch.read(poll_interval)
+
+            # Also list the folder: dumps present at start and events that were missed
+            for filename in filter(is_dump, os.listdir(startup.input_path)):
+                if filename in running:
+                    continue
+                if filename in completed:
+                    # Written again, its failures are forgotten
+                    failed.pop(filename, None)
+                    ready.add(filename)
+                    continue
+                if filename in failed:
+                    attempts, retry_at = failed[filename]
+                    if attempts < max_attempts and now >= retry_at:
+                        ready.add(filename)
+                    continue
+                if watch is not None and filename not in existing:
+                    continue
+                try:
+                    stat = os.stat(os.path.join(startup.input_path, filename))
+                except FileNotFoundError:
+                    continue
+                size, mtime, since = candidates.get(filename, (None, None, now))
+                if (stat.st_size, stat.st_mtime) != (size, mtime):
+                    since = now
+                candidates[filename] = (stat.st_size, stat.st_mtime, since)
+                if now - since >= settle_seconds and now - stat.st_mtime >= settle_seconds:
+                    ready.add(filename)
+
+            for filename in ready:
+                candidates.pop(filename, None)
+                completed.discard(filename)
+                running[filename] = pool.apply_async(process_dump, (filename,))
+
+            for filename, result in list(running.items()):
+                if result.ready():
+                    del running[filename]
+                    try:
+                        summary.append(result.get())
+                        failed.pop(filename, None)
+                    except Exception as e:
+                        # The dump stays in the input folder and is retried from its checkpoint
+                        logging.error(f'{filename}: {e}')
+                        attempts = failed.get(filename, (0, None))[0] + 1
+                        failed[filename] = attempts, time.time() + retry_delay * 2 ** (attempts - 1)
+                        if attempts >= max_attempts and quarantine(filename):
+                            del failed[filename]
+                    drain_started = drain_started or time.time()
+
+            # Consolidate once every dump was sent and the workers are done with them
+            if (consolidate_when_drained and drain_started and not running and not ready
+                    and time.time() >= next_drain_check):
+                next_drain_check = time.time() + drain_interval
+                timed_out = time.time() - drain_started >= drain_timeout
+                if timed_out or drained(celery):
+                    if timed_out:
+                        logging.error(f'Workers not drained after {drain_timeout}s, consolidating anyway')
+                    try:
+                        consolidate()
+                    except subprocess.CalledProcessError as e:
+                        # Tried again after the drain interval
+                        logging.error(f'Consolidation failed: {e}')
+                    else:
+                        if startup.delta_index:
+                            rotate_delta_index()
+                        startup.write_summary(run_started, summary, name='watch')
+                        drain_started, run_started, summary = None, time.time(), []
+
+            if watch is None:
+                time.sleep(poll_interval)
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    main()
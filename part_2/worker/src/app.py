@@ -1,9 +1,15 @@
 import os
 import redis
-import requests
 import src.settings as settings
 import src.exceptions as exceptions
+import src.metrics as metrics
+import src.verdicts as verdicts
+import src.layout as layout
+import src.partitions as partitions
+import src.http_client as http_client
 from celery import Celery
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from celery.signals import worker_init, worker_process_shutdown, task_prerun, task_postrun
 from celery.utils.log import get_task_logger
 
 # Celery worker defined in settings file
@@ -20,6 +26,48 @@ pool = redis.ConnectionPool(host=os.environ.get('SHARED_MEMORY_HOST'),
                             db=0)
 shared_memory = redis.StrictRedis(connection_pool=pool)
 
+# Layout of the verdicts in shared memory (read by consolidate.py too)
+storage = layout.from_settings(settings.storage_layout,
+                              settings.compact_buckets or layout.bucket_count(settings.expected_images))
+
+# Products of the owned partitions kept in memory (partitioned mode only)
+product_states = None
+if settings.partitions:
+    product_states = partitions.ProductStates(storage, settings.partition_cache_size)
+
+# HTTP client shared by the tasks of this process (pools are only filled after the fork)
+image_client = http_client.ImageClient(
+    pool_size=settings.http_pool_size,
+    max_per_host=settings.http_max_per_host,
+    rate=settings.http_rate,
+    burst=settings.http_burst,
+    timeout=settings.http_timeout,
+    use_head=settings.http_use_head
+)
+
+# Optional verdict cache keyed by image url, kept across runs
+verdict_store = None
+if settings.verdict_store:
+    verdict_store = verdicts.from_url(settings.verdict_store, settings.verdict_positive_ttl,
+                                      settings.verdict_negative_ttl)
+
+# Metrics exporter and task timing (no-ops when metrics are disabled)
+@worker_init.connect
+def start_metrics_exporter(**kwargs):
+    metrics.start_exporter(settings.metrics_port)
+
+@worker_process_shutdown.connect
+def stop_metrics_process(pid=None, **kwargs):
+    metrics.process_dead(pid or os.getpid())
+
+@task_prerun.connect
+def start_task_timer(task_id=None, **kwargs):
+    metrics.task_started(task_id)
+
+@task_postrun.connect
+def stop_task_timer(task_id=None, task=None, **kwargs):
+    metrics.task_finished(task_id, task.name)
+
 # Task definition
 @app.task(name='verify_image', bind=True, ignore_result=True)
 def verify_image(self, payload):
@@ -29,29 +77,48 @@ def verify_image(self, payload):
         image_name = payload['image'].split('/')[-1]
         
         # Check if image was already sent to the server
-        images = list(shared_memory.hgetall(product_id))
-        if image in images:
+        with metrics.stage('verify_image', 'redis_read'):
+            images = read_product(product_id)
+        if storage.field(product_id, image) in images:
+            metrics.count_already_sent('hit')
             msg = f'Image already sent to server - Product ID: {product_id}, Image Name: {image_name}'
             raise exceptions.ImageAlreadySent(msg)
 
-        # Check image in image server
-        res = requests.get(settings.image_server + image_name)
+        # Check if the product already has enough valid images (no request needed)
+        if sum(1 for valid in images.values() if valid == '1') >= settings.max_images:
+            metrics.count_already_sent('complete')
+            msg = f'Product already has {settings.max_images} valid images - Product ID: {product_id}, Image Name: {image_name}'
+            raise exceptions.ProductComplete(msg)
+        metrics.count_already_sent('miss')
+
+        # Check image in the verdict cache (it may have been checked for another product or run)
+        # and in image server when it is not there
+        status = cached_status(image)
+        if status is None:
+            with metrics.stage('verify_image', 'http'):
+                status = image_client.status(settings.image_server + image_name)
+            if status in (200, 404) and verdict_store is not None:
+                verdict_store.put(image, status)
 
-        if res.status_code == 200:
+        if status == 200:
             # Server has the image. Store this info in memory.
-            shared_memory.hset(product_id, image, 1)
+            with metrics.stage('verify_image', 'redis_write'):
+                store_verdict(product_id, image, 1)
+            metrics.count_image('valid')
             msg = f'Image found in server - Product ID: {product_id}, Image Name: {image_name}'
             logger.info(msg)
 
-        elif res.status_code == 404:
+        elif status == 404:
             # Server does not have image. Store this info in memory.
-            shared_memory.hset(product_id, image, 0)
+            with metrics.stage('verify_image', 'redis_write'):
+                store_verdict(product_id, image, 0)
+            metrics.count_image('invalid')
             msg = f'Image not found in server - Product ID: {product_id}, Image Name: {image_name}'
             logger.info(msg)
 
         else:
             # Some problem happened to image server. Try again latter.
-            msg = f'Unexpected response: {res.status_code} - Product ID: {product_id}, Image Name: {image_name}'
+            msg = f'Unexpected response: {status} - Product ID: {product_id}, Image Name: {image_name}'
             raise Exception(msg)
 
     except (KeyError, IndexError) as e:
@@ -64,7 +131,180 @@ def verify_image(self, payload):
         logger.info(f'{e}')
         return
 
+    except exceptions.ProductComplete as e:
+        # Product is already complete. No need to check the image.
+        logger.info(f'{e}')
+        return
+
     except Exception as e:
         # In case of error, retry after 5 minutes (maximum of 20 retries)  
         logger.error(f'Error message: {e}')
+        metrics.count_retry('verify_image')
         raise self.retry(countdown=300, max_retries=20)
+
+
+# Batch definition: many {productId, image} pairs per message
+@app.task(name='verify_images_batch', bind=True, ignore_result=True)
+def verify_images_batch(self, payloads):
+    # Group images by product, in message order and without repetitions
+    products = {}
+    for payload in payloads:
+        try:
+            products.setdefault(payload['productId'], {})[payload['image']] = None
+        except (KeyError, TypeError):
+            logger.error(f'Product id or image name ill formatted')
+
+    try:
+        # Stored results of the images and valid images of each product, in a single round trip
+        with metrics.stage('verify_images_batch', 'redis_read'):
+            stored_values = read_products(products)
+
+        candidates, valid = {}, {}
+        for product_id, (stored, valid_images) in stored_values.items():
+            valid[product_id] = valid_images
+            candidates[product_id] = [image for image, value in zip(products[product_id], stored) if value is None]
+            metrics.count_already_sent('hit', len(products[product_id]) - len(candidates[product_id]))
+
+        results, failed = check_products(candidates, valid)
+
+        # Write all results back in a single round trip, before the message is acked
+        # (in partitioned mode the products in memory are updated too)
+        if results:
+            verdicts = [(product_id, image, 1 if status == 200 else 0) for product_id, image, status in results]
+            with metrics.stage('verify_images_batch', 'redis_write'):
+                if product_states is not None:
+                    product_states.write(shared_memory, verdicts)
+                else:
+                    pipe = shared_memory.pipeline(transaction=False)
+                    for product_id, image, value in verdicts:
+                        storage.write(pipe, product_id, image, value)
+                    pipe.execute()
+        logger.info(f'{len(results)} images verified in batch, {len(failed)} failed')
+    except Exception as e:
+        # Whole batch is retried, already stored images are not checked again
+        logger.error(f'Error message: {e}')
+        metrics.count_retry('verify_images_batch')
+        raise self.retry(countdown=300, max_retries=20)
+
+    if failed:
+        # Only the images that could not be checked are retried
+        metrics.count_retry('verify_images_batch', len(failed))
+        raise self.retry(args=[failed], countdown=300, max_retries=20)
+
+
+def check_products(candidates, valid):
+    '''
+    Check the candidate images of each product concurrently, in order, until the product
+    has max_images valid images. Return the (productId, image, status) results and the
+    payloads that could not be checked.
+    '''
+    cached = {}
+    if verdict_store is not None:
+        with metrics.stage('verify_images_batch', 'verdict_read'):
+            cached = verdict_store.get_many(image for images in candidates.values() for image in images)
+
+    results, failed, checked = [], [], []
+    pending = {product_id: iter(images) for product_id, images in candidates.items()}
+    inflight = {product_id: 0 for product_id in candidates}
+    futures = {}
+
+    def schedule(executor, product_id):
+        # No more checks than valid images still missing
+        while inflight[product_id] < settings.max_images - valid[product_id]:
+            image = next(pending[product_id], None)
+            if image is None:
+                return
+            if image in cached:
+                record(product_id, image, 200 if cached[image] else 404)
+                metrics.count_verdict_cache('hit')
+                continue
+            if verdict_store is not None:
+                metrics.count_verdict_cache('miss')
+            futures[executor.submit(request_status, image)] = (product_id, image)
+            inflight[product_id] += 1
+
+    def record(product_id, image, status):
+        results.append((product_id, image, status))
+        metrics.count_image('valid' if status == 200 else 'invalid')
+        if status == 200:
+            valid[product_id] += 1
+
+    with ThreadPoolExecutor(max_workers=settings.batch_concurrency) as executor:
+        for product_id in candidates:
+            schedule(executor, product_id)
+        while futures:
+            done, _ = wait(list(futures), return_when=FIRST_COMPLETED)
+            for future in done:
+                product_id, image = futures.pop(future)
+                inflight[product_id] -= 1
+                try:
+                    status = future.result()
+                except Exception as e:
+                    status = f'{e}'
+                if status in (200, 404):
+                    record(product_id, image, status)
+                    checked.append((image, status))
+                else:
+                    logger.error(f'Unexpected response: {status} - Product ID: {product_id}, Image: {image}')
+                    failed.append({'productId': product_id, 'image': image})
+                schedule(executor, product_id)
+
+    if checked and verdict_store is not None:
+        verdict_store.put_many(checked)
+    return results, failed
+
+
+def read_products(products):
+    '''
+    Return {productId: (stored value of each image, number of valid images)}
+    for {productId: images}, in a single round trip
+    '''
+    product_ids = list(products)
+    if product_states is not None:
+        # Products of the owned partitions, only the ones not in memory are read
+        states = product_states.get_many(shared_memory, product_ids)
+        stored_values = {}
+        for product_id in product_ids:
+            state = states[product_id]
+            stored = [state.get(storage.field(product_id, image)) for image in products[product_id]]
+            stored_values[product_id] = stored, sum(1 for value in state.values() if value == '1')
+        return stored_values
+
+    pipe = shared_memory.pipeline(transaction=False)
+    for product_id in product_ids:
+        storage.queue_read(pipe, product_id, list(products[product_id]))
+    replies = iter(pipe.execute())
+    return {product_id: storage.parse_read(replies, product_id, list(products[product_id]))
+            for product_id in product_ids}
+
+
+def read_product(product_id):
+    if product_states is not None:
+        return product_states.get(shared_memory, product_id)
+    return storage.read(shared_memory, product_id)
+
+
+def store_verdict(product_id, image, value):
+    if product_states is not None:
+        product_states.write(shared_memory, [(product_id, image, value)])
+    else:
+        storage.write(shared_memory, product_id, image, value)
+
+
+def request_status(image):
+    with metrics.stage('verify_images_batch', 'http'):
+        return image_client.status(settings.image_server + image.split('/')[-1])
+
+
+def cached_status(image):
+    '''
+    Return 200 or 404 when the verdict cache knows the image, otherwise None
+    '''
+    if verdict_store is None:
+        return None
+    with metrics.stage('verify_image', 'verdict_read'):
+        verdict = verdict_store.get(image)
+    metrics.count_verdict_cache('miss' if verdict is None else 'hit')
+    if verdict is None:
+        return None
+    return 200 if verdict else 404
@@ -3,3 +3,10 @@ class ImageAlreadySent(Exception):
     Raised when the image was already sent to the server
     '''
     pass
+
+
+class ProductComplete(Exception):
+    '''
+    Raised when the product already has the maximum number of valid images
+    '''
+    pass
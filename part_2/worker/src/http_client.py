@@ -0,0 +1,110 @@
+import time
+import threading
+import requests
+import src.metrics as metrics
+from urllib.parse import urlparse
+from requests.adapters import HTTPAdapter
+
+# Statuses meaning the server does not answer HEAD requests (GET is used instead)
+HEAD_NOT_SUPPORTED = (405, 501)
+
+# Bodies of GET responses up to this size are read so the connection can be reused
+MAX_DRAINED_BODY = 64 * 1024
+
+
+class TokenBucket:
+    '''
+    Allows `rate` requests per second on average and bursts of up to `burst` requests.
+    The tokens are those of a single process (see http_rate in settings)
+    '''
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        # At least one token, or a request could never be made
+        self.burst = max(1, burst or rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class _Host:
+    def __init__(self, max_connections, rate, burst):
+        self.semaphore = threading.BoundedSemaphore(max_connections) if max_connections else None
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.head_supported = True
+
+
+class ImageClient:
+    '''
+    HTTP client of a worker process: keep-alive connection pools, HEAD requests
+    (with GET fallback, body never downloaded), per-host concurrency cap and rate limit
+    '''
+    def __init__(self, pool_size=10, max_per_host=0, rate=0, burst=None, timeout=10, use_head=True):
+        self.max_per_host = max_per_host
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.use_head = use_head
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, host):
+        state = self._hosts.get(host)
+        if state is None:
+            with self._lock:
+                state = self._hosts.setdefault(host, _Host(self.max_per_host, self.rate, self.burst))
+        return state
+
+    def status(self, url):
+        '''
+        Return the status code the server answers for url
+        '''
+        host = urlparse(url).netloc
+        state = self._host(host)
+        if state.semaphore is not None:
+            state.semaphore.acquire()
+        try:
+            if self.use_head and state.head_supported:
+                status = self._request(state, host, 'HEAD', url)
+                if status not in HEAD_NOT_SUPPORTED:
+                    return status
+                state.head_supported = False
+            return self._request(state, host, 'GET', url)
+        finally:
+            if state.semaphore is not None:
+                state.semaphore.release()
+
+    def _request(self, state, host, method, url):
+        if state.bucket is not None:
+            state.bucket.acquire()
+        started = time.monotonic()
+        try:
+            # stream=True: the body is only read when it is small enough to keep the connection
+            with self.session.request(method, url, timeout=self.timeout, stream=True,
+                                      allow_redirects=True) as res:
+                status = res.status_code
+                if method == 'GET' and 0 <= int(res.headers.get('Content-Length', -1)) <= MAX_DRAINED_BODY:
+                    res.content
+        except requests.RequestException as e:
+            metrics.count_host_error(host, type(e).__name__)
+            raise
+        finally:
+            metrics.observe_host(host, method, time.monotonic() - started)
+        if status >= 500 or status == 429:
+            metrics.count_host_error(host, str(status))
+        return status
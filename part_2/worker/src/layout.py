@@ -0,0 +1,160 @@
+import zlib
+import hashlib
+
+# Layouts of the image verdicts in shared memory.
+#
+# 'hash' is one redis hash per product: {image url: 1 or 0}.
+# 'compact' groups products into a fixed number of bucket hashes, small enough for
+# redis to keep them listpack encoded (hash-max-listpack-entries, 128 by default,
+# hash-max-ziplist-entries before redis 7): see bucket_count for their number.
+# Each verdict is the field "<productId>/<prefix id>/<file name>" with value 1 or 0,
+# where the prefix id is a short hash of the url up to its last '/'. The prefixes
+# are stored in the bucket itself as "#<prefix id>" fields, written with the verdict,
+# so a bucket can always be decoded without any other key.
+
+
+class HashLayout:
+    '''
+    One hash per product, keyed by the full image url
+    '''
+    def field(self, product_id, image):
+        return image
+
+    def read(self, client, product_id):
+        '''
+        Return {field: '1' or '0'} for the stored images of a product
+        '''
+        return client.hgetall(product_id)
+
+    def queue_read_all(self, pipe, product_id):
+        pipe.hgetall(product_id)
+
+    def parse_read_all(self, replies, product_id):
+        return next(replies)
+
+    def queue_read(self, pipe, product_id, images):
+        pipe.hmget(product_id, images)
+        pipe.hvals(product_id)
+
+    def parse_read(self, replies, product_id, images):
+        '''
+        Consume the replies of queue_read and return the stored value of each image
+        (None when not stored) and the number of valid images of the product
+        '''
+        stored, values = next(replies), next(replies)
+        return stored, sum(1 for value in values if value == '1')
+
+    def write(self, client, product_id, image, value):
+        client.hset(product_id, image, value)
+
+
+class CompactLayout:
+    '''
+    Products grouped in bucket hashes, image urls split in an interned prefix and a file name
+    '''
+    def __init__(self, buckets, key_prefix='images:'):
+        self.buckets = buckets
+        self.key_prefix = key_prefix
+
+    def bucket(self, product_id):
+        # crc32 is the same in every process (unlike hash())
+        return f'{self.key_prefix}{zlib.crc32(product_id.encode("utf-8")) % self.buckets}'
+
+    def field(self, product_id, image):
+        prefix, name = split_url(image)
+        return f'{product_id}/{prefix_id(prefix)}/{name}'
+
+    def _product_entries(self, product_id, bucket):
+        return {field: value for field, value in bucket.items()
+                if field.rsplit('/', 2)[0] == product_id}
+
+    def read(self, client, product_id):
+        # Only the verdicts of the product are sent back (see queue_read)
+        entries = client.hscan_iter(self.bucket(product_id), match=glob_escape(product_id) + '/*',
+                                    count=scan_count)
+        return self._product_entries(product_id, dict(entries))
+
+    def queue_read_all(self, pipe, product_id):
+        pipe.hgetall(self.bucket(product_id))
+
+    def parse_read_all(self, replies, product_id):
+        return self._product_entries(product_id, next(replies))
+
+    def queue_read(self, pipe, product_id, images):
+        bucket = self.bucket(product_id)
+        pipe.hmget(bucket, [self.field(product_id, image) for image in images])
+        # Only the verdicts of the product are sent back. A listpack encoded bucket is
+        # scanned in a single call, a larger one may only be partly counted (so some
+        # images are checked again, never skipped).
+        pipe.hscan(bucket, 0, match=glob_escape(product_id) + '/*', count=scan_count)
+
+    def parse_read(self, replies, product_id, images):
+        stored, (_, entries) = next(replies), next(replies)
+        entries = self._product_entries(product_id, entries)
+        return stored, sum(1 for value in entries.values() if value == '1')
+
+    def write(self, client, product_id, image, value):
+        prefix = split_url(image)[0]
+        client.hset(self.bucket(product_id), mapping={
+            self.field(product_id, image): value,
+            '#' + prefix_id(prefix): prefix,
+        })
+
+
+# Fields of a bucket scanned per HSCAN call (above the listpack limit)
+scan_count = 1000
+
+# Fields per bucket aimed at by bucket_count, below the listpack limit of 128 to leave
+# room for the prefix fields and for products hashing to the fullest buckets
+fields_per_bucket = 100
+
+
+def bucket_count(expected_images):
+    '''
+    Number of compact buckets for the expected number of stored images. With more images,
+    buckets get converted to hash tables, unless hash-max-listpack-entries is raised
+    in redis.conf (to about twice the images per bucket).
+    '''
+    return max(1, -(-expected_images // fields_per_bucket))
+
+
+def glob_escape(text):
+    '''
+    Escape the characters of text that have a meaning in a SCAN match pattern
+    '''
+    return ''.join('\\' + char if char in '*?[]\\' else char for char in text)
+
+
+def split_url(image):
+    '''
+    Split an image url after its last '/' (the prefix keeps the '/')
+    '''
+    index = image.rfind('/') + 1
+    return image[:index], image[index:]
+
+
+def prefix_id(prefix):
+    return hashlib.blake2b(prefix.encode('utf-8'), digest_size=4).hexdigest()
+
+
+def decode_bucket(bucket):
+    '''
+    Return {productId: {image url: '1' or '0'}} from the contents of a compact bucket,
+    images in the order they were stored
+    '''
+    prefixes = {field[1:]: value for field, value in bucket.items() if '/' not in field}
+    products = {}
+    for field, value in bucket.items():
+        if '/' not in field:
+            continue
+        product_id, prefix, name = field.rsplit('/', 2)
+        products.setdefault(product_id, {})[prefixes[prefix] + name] = value
+    return products
+
+
+def from_settings(name, buckets):
+    if name == 'hash':
+        return HashLayout()
+    if name == 'compact':
+        return CompactLayout(buckets)
+    raise ValueError(f'Unsupported storage layout: {name}')
@@ -0,0 +1,161 @@
+import os
+import time
+import src.settings as settings
+
+# Task instrumentation, exported in Prometheus format by an http server started with the worker.
+# With a prefork pool, set PROMETHEUS_MULTIPROC_DIR so the values of every child process are merged.
+# When disabled, every helper returns right away and prometheus_client is not even imported.
+enabled = False
+registry = None
+
+# Start time of the running tasks, by task id
+_started = {}
+
+
+def enable():
+    '''
+    Create the metrics in a registry of their own and turn the instrumentation on
+    '''
+    global enabled, registry, prometheus_client, TASK_SECONDS, STAGE_SECONDS, IMAGES, ALREADY_SENT, VERDICT_CACHE, RETRIES, HOST_SECONDS, HOST_ERRORS
+    import prometheus_client
+
+    registry = prometheus_client.CollectorRegistry()
+    TASK_SECONDS = prometheus_client.Histogram(
+        'images_worker_task_seconds',
+        'Total run time of each task',
+        ['task'],
+        registry=registry
+    )
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'images_worker_stage_seconds',
+        'Time spent in each stage of a task',
+        ['task', 'stage'],
+        registry=registry
+    )
+    IMAGES = prometheus_client.Counter(
+        'images_worker_images_total',
+        'Images checked in the image server, by result',
+        ['result'],
+        registry=registry
+    )
+    ALREADY_SENT = prometheus_client.Counter(
+        'images_worker_already_sent_total',
+        'Lookups of the images already sent to the server, by result',
+        ['result'],
+        registry=registry
+    )
+    VERDICT_CACHE = prometheus_client.Counter(
+        'images_worker_verdict_cache_total',
+        'Lookups of the verdict cache keyed by image url, by result',
+        ['result'],
+        registry=registry
+    )
+    RETRIES = prometheus_client.Counter(
+        'images_worker_retries_total',
+        'Images sent back to the retry path',
+        ['task'],
+        registry=registry
+    )
+    HOST_SECONDS = prometheus_client.Histogram(
+        'images_worker_host_request_seconds',
+        'Latency of the requests to each image host',
+        ['host', 'method'],
+        registry=registry
+    )
+    HOST_ERRORS = prometheus_client.Counter(
+        'images_worker_host_errors_total',
+        'Failed requests to each image host, by status code or exception',
+        ['host', 'reason'],
+        registry=registry
+    )
+    enabled = True
+
+
+def disable():
+    global enabled
+    enabled = False
+
+
+if settings.metrics_enabled:
+    enable()
+
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_null_timer = _NullTimer()
+
+
+def stage(task, name):
+    '''
+    Context manager timing one stage of a task
+    '''
+    if not enabled:
+        return _null_timer
+    return STAGE_SECONDS.labels(task, name).time()
+
+
+def count_image(result):
+    if enabled:
+        IMAGES.labels(result).inc()
+
+
+def count_already_sent(result, amount=1):
+    if enabled and amount:
+        ALREADY_SENT.labels(result).inc(amount)
+
+
+def count_verdict_cache(result):
+    if enabled:
+        VERDICT_CACHE.labels(result).inc()
+
+
+def count_retry(task, amount=1):
+    if enabled and amount:
+        RETRIES.labels(task).inc(amount)
+
+
+def observe_host(host, method, seconds):
+    if enabled:
+        HOST_SECONDS.labels(host, method).observe(seconds)
+
+
+def count_host_error(host, reason):
+    if enabled:
+        HOST_ERRORS.labels(host, reason).inc()
+
+
+def task_started(task_id):
+    if enabled:
+        _started[task_id] = time.monotonic()
+
+
+def task_finished(task_id, task):
+    if enabled:
+        started = _started.pop(task_id, None)
+        if started is not None:
+            TASK_SECONDS.labels(task).observe(time.monotonic() - started)
+
+
+def start_exporter(port):
+    '''
+    Serve the metrics of the worker (of all its child processes in multiprocess mode)
+    '''
+    if not enabled:
+        return
+    exported = registry
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        exported = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(exported)
+    prometheus_client.start_http_server(port, registry=exported)
+
+
+def process_dead(pid):
+    if enabled and os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(pid)
@@ -0,0 +1,95 @@
+import sys
+import zlib
+import collections
+import src.settings as settings
+
+# Products are hashed onto a fixed number of partition queues (<queue>.<partition>) and
+# each worker consumes the partitions with partition % worker_count == worker_index.
+# The number of partitions never changes, so a product always lands in the same queue;
+# when workers are added or removed only the owners of whole partitions change.
+# A partition consumed by a single process lets it keep its products in memory.
+
+
+def partition(product_id, partitions):
+    # crc32 is the same in every process (unlike hash()), startup.py uses it too
+    return zlib.crc32(product_id.encode('utf-8')) % partitions
+
+
+def queue_name(queue, index):
+    return f'{queue}.{index}'
+
+
+def owned(partitions, worker_index, worker_count):
+    return [index for index in range(partitions) if index % worker_count == worker_index]
+
+
+def worker_queues():
+    '''
+    Queues consumed by this worker: its partitions, or the shared queue when not partitioned
+    '''
+    if not settings.partitions:
+        return [settings.queue]
+    indexes = owned(settings.partitions, settings.worker_index, settings.worker_count)
+    if not indexes:
+        # Nothing is sent to the shared queue in partitioned mode, the worker would stay idle
+        raise ValueError(f'Worker {settings.worker_index} owns no partition: PARTITIONS '
+                         f'({settings.partitions}) must be at least WORKER_COUNT ({settings.worker_count})')
+    return [queue_name(settings.queue, index) for index in indexes]
+
+
+class ProductStates:
+    '''
+    Stored images of the products of the owned partitions, kept in process memory
+    (least recently used products are dropped first). The verdicts of a task are written
+    in a single round trip before it returns, so nothing is lost once its message is acked.
+    '''
+    def __init__(self, storage, size):
+        self.storage = storage
+        self.size = size
+        self._states = collections.OrderedDict()
+
+    def get_many(self, client, product_ids):
+        '''
+        Return {productId: {field: value}}, reading the products not in memory in a single round trip
+        '''
+        missing = [product_id for product_id in product_ids if product_id not in self._states]
+        if missing:
+            pipe = client.pipeline(transaction=False)
+            for product_id in missing:
+                self.storage.queue_read_all(pipe, product_id)
+            replies = iter(pipe.execute())
+            for product_id in missing:
+                self._states[product_id] = self.storage.parse_read_all(replies, product_id)
+        states = {}
+        for product_id in product_ids:
+            self._states.move_to_end(product_id)
+            states[product_id] = self._states[product_id]
+        while len(self._states) > self.size:
+            self._states.popitem(last=False)
+        return states
+
+    def get(self, client, product_id):
+        return self.get_many(client, [product_id])[product_id]
+
+    def write(self, client, verdicts):
+        '''
+        Write [(productId, image, value)] to the shared memory, then to the products in memory
+        (a failed write leaves them as they were, the task is retried)
+        '''
+        pipe = client.pipeline(transaction=False)
+        for product_id, image, value in verdicts:
+            self.storage.write(pipe, product_id, image, value)
+        pipe.execute()
+        for product_id, image, value in verdicts:
+            state = self._states.get(product_id)
+            if state is not None:
+                state[self.storage.field(product_id, image)] = str(value)
+
+
+if __name__ == '__main__':
+    # Used by the Procfile: python -m src.partitions prints the queues of this worker
+    # and fails (so the worker is not started) when it owns no partition
+    try:
+        print(','.join(worker_queues()))
+    except ValueError as e:
+        sys.exit(str(e))
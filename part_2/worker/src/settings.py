@@ -7,14 +7,72 @@ broker_url = os.environ.get('BROKER_ENDPOINT')
 timezone = 'America/Sao_Paulo'
 enable_utc = True
 task_serializer = 'json'
+task_compression = os.environ.get('BROKER_COMPRESSION') or None
 
 # Assign queue to task
+queue = os.environ.get('QUEUE')
 task_routes = {
     'insert_into_database':
         {
-            'queue': os.environ.get('QUEUE')
+            'queue': queue
+        },
+    'verify_images_batch':
+        {
+            'queue': queue
         }
 }
 
+# Partitioned mode (partitions above 0): products are hashed onto <queue>.<partition> queues
+# and this worker consumes the partitions with partition % worker_count == worker_index,
+# keeping the state of up to partition_cache_size products in memory. Verdicts are still
+# written to the shared memory by the task that found them, before its message is acked.
+partitions = int(os.environ.get('PARTITIONS', 0))
+worker_index = int(os.environ.get('WORKER_INDEX', 0))
+worker_count = int(os.environ.get('WORKER_COUNT', 1))
+partition_cache_size = int(os.environ.get('PARTITION_CACHE_SIZE', 100000))
+if partitions:
+    # A single process per worker, so a product is only ever handled by its owner
+    # (requests are still concurrent inside verify_images_batch)
+    worker_concurrency = 1
+else:
+    # Processes of this worker (celery's default is one per cpu)
+    worker_concurrency = int(os.environ.get('WORKER_CONCURRENCY') or 0) or os.cpu_count() or 1
+
 # Image server (mock)
 image_server = os.environ.get('IMAGE_SERVER')
+
+# Images of a product are no longer checked once this many are valid (the output keeps 3)
+max_images = int(os.environ.get('MAX_IMAGES', 3))
+
+# Layout of the verdicts in shared memory: 'hash' (one hash per product, keyed by image url)
+# or 'compact' (products grouped in buckets, urls stored as prefix id and file name).
+# Unless COMPACT_BUCKETS is set, there is a bucket per 100 of the expected stored images,
+# so buckets stay listpack encoded.
+storage_layout = os.environ.get('STORAGE_LAYOUT', 'hash')
+expected_images = int(os.environ.get('EXPECTED_IMAGES', 1000000))
+compact_buckets = int(os.environ.get('COMPACT_BUCKETS') or 0)
+
+# HTTP client of each worker process: connections kept per host, maximum concurrent
+# requests per host (0 = no limit), requests per second per host (0 = no limit) and burst.
+# The rate limit is kept in each process: HTTP_RATE and HTTP_BURST are the limits of all the
+# WORKER_COUNT workers together, split between their worker_concurrency processes.
+http_pool_size = int(os.environ.get('HTTP_POOL_SIZE', 16))
+http_max_per_host = int(os.environ.get('HTTP_MAX_PER_HOST', 0))
+http_processes = worker_count * worker_concurrency
+http_rate = float(os.environ.get('HTTP_RATE', 0)) / http_processes
+http_burst = float(os.environ.get('HTTP_BURST', 0)) / http_processes or None
+http_timeout = float(os.environ.get('HTTP_TIMEOUT', 10))
+http_use_head = os.environ.get('HTTP_USE_HEAD', 'True') == 'True'
+
+# Concurrent requests to the image server made by a verify_images_batch task
+batch_concurrency = int(os.environ.get('BATCH_CONCURRENCY', 16))
+
+# Verdict cache keyed by image url (sqlite:///path or redis://host:port/db), disabled when empty.
+# Valid images are trusted for the positive ttl, missing ones for the negative ttl (seconds).
+verdict_store = os.environ.get('VERDICT_STORE')
+verdict_positive_ttl = int(os.environ.get('VERDICT_POSITIVE_TTL', 24 * 60 * 60))
+verdict_negative_ttl = int(os.environ.get('VERDICT_NEGATIVE_TTL', 60 * 60))
+
+# Metrics exporter (started with the worker when enabled)
+metrics_enabled = os.environ.get('METRICS_ENABLED') == 'True'
+metrics_port = int(os.environ.get('METRICS_PORT', 9100))
\ No newline at end of file
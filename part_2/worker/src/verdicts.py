@@ -0,0 +1,158 @@
+import os
+import time
+import sqlite3
+import threading
+from urllib.parse import urlparse
+
+# Image verdicts keyed by url, kept across runs: a valid image (200) is trusted
+# for positive_ttl seconds and a missing one (404) for negative_ttl seconds.
+
+
+class SQLiteVerdictStore:
+    '''
+    Verdicts in a local SQLite file (one connection per process, so it survives forks)
+    '''
+    def __init__(self, path, positive_ttl, negative_ttl, commit_every=1):
+        self.path = path
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.commit_every = commit_every
+        self._connection = None
+        self._pid = None
+        self._uncommitted = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._connection.execute('PRAGMA journal_mode=WAL')
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS verdicts '
+                '(url TEXT PRIMARY KEY, status INTEGER NOT NULL, checked_at REAL NOT NULL)'
+            )
+            self._connection.commit()
+            self._pid = os.getpid()
+        return self._connection
+
+    def get(self, url):
+        return self.get_many([url]).get(url)
+
+    def get_many(self, urls):
+        '''
+        Return {url: True/False} for the urls with a verdict that did not expire
+        '''
+        urls = list(urls)
+        verdicts = {}
+        with self._lock:
+            connection = self._connect()
+            # SQLite limits the number of parameters of a statement
+            for index in range(0, len(urls), 500):
+                chunk = urls[index:index + 500]
+                rows = connection.execute(
+                    f'SELECT url, status, checked_at FROM verdicts WHERE url IN ({",".join("?" * len(chunk))})',
+                    chunk
+                )
+                for url, status, checked_at in rows:
+                    verdict = self._verdict(status, checked_at)
+                    if verdict is not None:
+                        verdicts[url] = verdict
+        return verdicts
+
+    def put(self, url, status, checked_at=None):
+        self.put_many([(url, status)], checked_at)
+
+    def put_many(self, items, checked_at=None):
+        '''
+        Store (url, status) pairs, status being 200 or 404
+        '''
+        checked_at = checked_at or time.time()
+        with self._lock:
+            connection = self._connect()
+            rows = [(url, status, checked_at) for url, status in items]
+            connection.executemany('INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)', rows)
+            self._uncommitted += len(rows)
+            if self._uncommitted >= self.commit_every:
+                connection.commit()
+                self._uncommitted = 0
+
+    def flush(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.commit()
+                self._uncommitted = 0
+
+    def _verdict(self, status, checked_at):
+        ttl = self.positive_ttl if status == 200 else self.negative_ttl
+        if time.time() - checked_at >= ttl:
+            return None
+        return status == 200
+
+
+class RedisVerdictStore:
+    '''
+    Verdicts as redis keys expiring with their ttl, shared by every worker
+    '''
+    def __init__(self, client, positive_ttl, negative_ttl, prefix='verdict:'):
+        self.client = client
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.prefix = prefix
+
+    def get(self, url):
+        return self.get_many([url]).get(url)
+
+    def get_many(self, urls):
+        urls = list(urls)
+        if not urls:
+            return {}
+        values = self.client.mget([self.prefix + url for url in urls])
+        verdicts = {}
+        for url, value in zip(urls, values):
+            if value is not None:
+                # Value is "<status>:<checked_at>"
+                status = value.decode() if isinstance(value, bytes) else value
+                verdicts[url] = status.split(':', 1)[0] == '200'
+        return verdicts
+
+    def put(self, url, status, checked_at=None):
+        self.put_many([(url, status)], checked_at)
+
+    def put_many(self, items, checked_at=None):
+        checked_at = checked_at or time.time()
+        pipe = self.client.pipeline(transaction=False)
+        for url, status in items:
+            ttl = self.positive_ttl if status == 200 else self.negative_ttl
+            pipe.set(self.prefix + url, f'{status}:{checked_at}', ex=int(ttl))
+        pipe.execute()
+
+    def flush(self):
+        pass
+
+
+def redis_store(url, positive_ttl, negative_ttl):
+    import redis
+    return RedisVerdictStore(redis.StrictRedis.from_url(url.geturl()), positive_ttl, negative_ttl)
+
+
+# Available backends, indexed by url scheme
+backends = {
+    'sqlite': lambda url, positive_ttl, negative_ttl, **options:
+        SQLiteVerdictStore(url.path, positive_ttl, negative_ttl, **options),
+    'redis': lambda url, positive_ttl, negative_ttl, **options:
+        redis_store(url, positive_ttl, negative_ttl),
+}
+
+
+def from_url(url, positive_ttl, negative_ttl, **options):
+    '''
+    Build a verdict store from an url such as sqlite:///data/verdicts.db or redis://redis:6379/1
+    '''
+    parsed = urlparse(url)
+    try:
+        backend = backends[parsed.scheme]
+    except KeyError:
+        raise ValueError(f'Unsupported verdict store: {parsed.scheme}')
+    return backend(parsed, positive_ttl, negative_ttl, **options)
@@ -0,0 +1,136 @@
+import os
+import time
+import importlib
+import mock
+import pytest
+import requests
+import src.metrics as metrics
+import src.settings as settings
+import src.http_client as http_client
+
+def response(status):
+    res = mock.MagicMock()
+    res.status_code = status
+    res.headers = {'Content-Length': '14'}
+    res.__enter__.return_value = res
+    return res
+
+class TestImageClient:
+
+    def test_head_request(self):
+        '''
+        Case where the image server answers HEAD requests (no body is downloaded)
+        '''
+        client = http_client.ImageClient()
+        with mock.patch.object(client.session, 'request', return_value=response(404)) as mock_request:
+            assert client.status('http://mock/images/5.png') == 404
+        mock_request.assert_called_once_with('HEAD', 'http://mock/images/5.png', timeout=10,
+                                             stream=True, allow_redirects=True)
+
+    def test_get_fallback_is_remembered(self):
+        '''
+        Case where the image server refuses HEAD requests (GET is used from then on)
+        '''
+        client = http_client.ImageClient()
+        responses = [response(405), response(200), response(200)]
+        with mock.patch.object(client.session, 'request', side_effect=responses) as mock_request:
+            assert client.status('http://mock/images/1.png') == 200
+            assert client.status('http://mock/images/2.png') == 200
+        methods = [call[0][0] for call in mock_request.call_args_list]
+        assert methods == ['HEAD', 'GET', 'GET']
+
+    def test_head_disabled(self):
+        '''
+        Case where HEAD requests are disabled by configuration
+        '''
+        client = http_client.ImageClient(use_head=False)
+        with mock.patch.object(client.session, 'request', return_value=response(200)) as mock_request:
+            client.status('http://mock/images/1.png')
+        assert mock_request.call_args[0][0] == 'GET'
+
+    def test_errors_are_counted_per_host(self):
+        '''
+        Case where failed requests are counted by host and reason
+        '''
+        metrics.enable()
+        try:
+            client = http_client.ImageClient()
+            side_effect = [response(503), requests.ConnectionError('refused')]
+            with mock.patch.object(client.session, 'request', side_effect=side_effect):
+                assert client.status('http://mock/images/1.png') == 503
+                with pytest.raises(requests.ConnectionError):
+                    client.status('http://mock/images/1.png')
+
+            labels = {'host': 'mock', 'reason': '503'}
+            assert metrics.registry.get_sample_value('images_worker_host_errors_total', labels) == 1
+            labels = {'host': 'mock', 'reason': 'ConnectionError'}
+            assert metrics.registry.get_sample_value('images_worker_host_errors_total', labels) == 1
+            labels = {'host': 'mock', 'method': 'HEAD'}
+            assert metrics.registry.get_sample_value('images_worker_host_request_seconds_count', labels) == 2
+        finally:
+            metrics.disable()
+
+    def test_concurrency_cap_per_host(self):
+        '''
+        Case where each host gets its own concurrency cap
+        '''
+        client = http_client.ImageClient(max_per_host=2)
+        first, second = client._host('a'), client._host('b')
+        assert first is client._host('a')
+        assert first.semaphore is not second.semaphore
+        assert first.semaphore.acquire(blocking=False) and first.semaphore.acquire(blocking=False)
+        assert not first.semaphore.acquire(blocking=False)
+        assert second.semaphore.acquire(blocking=False)
+
+class TestTokenBucket:
+
+    def test_rate_is_limited_after_burst(self):
+        '''
+        Case where requests beyond the burst wait for new tokens
+        '''
+        bucket = http_client.TokenBucket(rate=50, burst=5)
+        started = time.monotonic()
+        for _ in range(10):
+            bucket.acquire()
+        elapsed = time.monotonic() - started
+        # 5 requests of burst, then 5 more at 50 per second
+        assert 0.08 <= elapsed < 0.5
+
+    def test_burst_below_one_token(self):
+        '''
+        Case where the burst of a process is less than a request: one request at a time is allowed
+        '''
+        bucket = http_client.TokenBucket(rate=100, burst=0.25)
+        started = time.monotonic()
+        for _ in range(3):
+            bucket.acquire()
+        assert time.monotonic() - started < 0.5
+
+class TestRateSettings:
+
+    def reload(self, environ):
+        with mock.patch.dict(os.environ, environ):
+            importlib.reload(settings)
+        try:
+            return settings.worker_concurrency, settings.http_rate, settings.http_burst
+        finally:
+            importlib.reload(settings)
+
+    def test_rate_split_between_processes(self):
+        '''
+        Case where the image server limits are shared by every process of every worker
+        '''
+        environ = {'HTTP_RATE': '120', 'HTTP_BURST': '24', 'WORKER_COUNT': '3', 'WORKER_CONCURRENCY': '4',
+                   'PARTITIONS': '0'}
+        assert self.reload(environ) == (4, 10, 2)
+
+    def test_default_concurrency(self):
+        '''
+        Case where celery starts one process per cpu, or a single one in partitioned mode
+        '''
+        environ = {'HTTP_RATE': '64', 'HTTP_BURST': '0', 'WORKER_COUNT': '1', 'WORKER_CONCURRENCY': '',
+                   'PARTITIONS': '0'}
+        with mock.patch('os.cpu_count', return_value=8):
+            assert self.reload(environ) == (8, 8, None)
+        environ['PARTITIONS'] = '16'
+        assert self.reload(environ) == (1, 64, None)
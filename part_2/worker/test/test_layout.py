@@ -0,0 +1,100 @@
+import mock
+import src.layout as layout
+
+class HashClient:
+    '''
+    Hashes kept in a dict, with the string values redis returns
+    '''
+    def __init__(self):
+        self.hashes = {}
+
+    def hgetall(self, key):
+        return dict(self.hashes.get(key, {}))
+
+    def hset(self, key, mapping):
+        self.hashes.setdefault(key, {}).update({field: str(value) for field, value in mapping.items()})
+
+    def hscan_iter(self, key, match, count):
+        return iter(self.hscan(key, 0, match, count)[1].items())
+
+    def hmget(self, key, fields):
+        return [self.hashes.get(key, {}).get(field) for field in fields]
+
+    def hscan(self, key, cursor, match, count):
+        # Prefix matches only
+        return 0, {field: value for field, value in self.hashes.get(key, {}).items()
+                   if field.startswith(match.rstrip('*').replace('\\', ''))}
+
+class TestCompactLayout:
+
+    def test_verdicts_are_read_back(self):
+        '''
+        Case where products sharing a bucket only see their own images
+        '''
+        storage = layout.CompactLayout(buckets=1)
+        client = HashClient()
+        storage.write(client, 'pid1', 'http://image-server/images/1.png', 1)
+        storage.write(client, 'pid1', 'http://image-server/images/5.png', 0)
+        storage.write(client, 'pid2', 'http://image-server/images/1.png', 1)
+
+        images = storage.read(client, 'pid1')
+        assert images == {storage.field('pid1', 'http://image-server/images/1.png'): '1',
+                          storage.field('pid1', 'http://image-server/images/5.png'): '0'}
+        assert storage.field('pid2', 'http://image-server/images/1.png') not in images
+        assert list(client.hashes) == ['images:0']
+
+    def test_fields_are_short(self):
+        '''
+        Case where the url prefix is replaced by a short id
+        '''
+        storage = layout.CompactLayout(buckets=16)
+        field = storage.field('pid1', 'http://image-server/images/123.png')
+        assert field.startswith('pid1/') and field.endswith('/123.png')
+        assert len(field) < len('http://image-server/images/123.png')
+        assert storage.bucket('pid1') == storage.bucket('pid1')
+
+    def test_batch_read(self):
+        '''
+        Case where stored values and valid images are read from a pipeline reply
+        '''
+        storage = layout.CompactLayout(buckets=1)
+        client = HashClient()
+        storage.write(client, 'pid1', 'http://a/images/1.png', 1)
+        storage.write(client, 'pid1', 'http://a/images/5.png', 0)
+        storage.write(client, 'pid1/2', 'http://a/images/2.png', 1)
+        images = ['http://a/images/5.png', 'http://a/images/2.png']
+        pipe = mock.Mock()
+
+        storage.queue_read(pipe, 'pid1', images)
+        fields = [storage.field('pid1', image) for image in images]
+        pipe.hmget.assert_called_once_with('images:0', fields)
+        pipe.hscan.assert_called_once_with('images:0', 0, match='pid1/*', count=layout.scan_count)
+        pipe.hgetall.assert_not_called()
+        replies = iter([client.hmget('images:0', fields), client.hscan('images:0', 0, 'pid1/*', 1000)])
+        stored, valid = storage.parse_read(replies, 'pid1', images)
+        assert stored == ['0', None]
+        assert valid == 1
+
+    def test_bucket_count(self):
+        '''
+        Case where buckets are sized to keep about 100 images each
+        '''
+        assert layout.bucket_count(0) == 1
+        assert layout.bucket_count(1000001) == 10001
+        assert layout.glob_escape('pid*[1]?') == 'pid\\*\\[1\\]\\?'
+
+    def test_decode_bucket(self):
+        '''
+        Case where a bucket is decoded back into full urls, in storage order
+        '''
+        storage = layout.CompactLayout(buckets=1)
+        client = HashClient()
+        storage.write(client, 'pid/1', 'http://a/images/2.png', 1)
+        storage.write(client, 'pid2', 'https://b/3.png', 0)
+        storage.write(client, 'pid/1', 'http://a/images/1.png', 1)
+        storage.write(client, 'pid2', 'no-slash.png', 1)
+
+        assert layout.decode_bucket(client.hgetall('images:0')) == {
+            'pid/1': {'http://a/images/2.png': '1', 'http://a/images/1.png': '1'},
+            'pid2': {'https://b/3.png': '0', 'no-slash.png': '1'},
+        }
@@ -0,0 +1,95 @@
+import mock
+import pytest
+import src.layout as layout
+import src.settings as settings
+import src.partitions as partitions
+
+class TestPartitions:
+
+    def test_every_partition_has_one_owner(self):
+        '''
+        Case where partitions are spread over workers, each one owned by a single worker
+        '''
+        for worker_count in (1, 3, 16):
+            owners = [index for worker_index in range(worker_count)
+                      for index in partitions.owned(16, worker_index, worker_count)]
+            assert sorted(owners) == list(range(16))
+
+    def test_product_keeps_its_partition(self):
+        '''
+        Case where a product is routed to the same partition in every process
+        '''
+        assert partitions.partition('pid123', 16) == partitions.partition('pid123', 16)
+        assert len({partitions.partition(f'pid{number}', 16) for number in range(1000)}) == 16
+
+    @mock.patch.object(settings, 'queue', 'verify_image')
+    @mock.patch.object(settings, 'worker_count', 2)
+    @mock.patch.object(settings, 'worker_index', 1)
+    def test_worker_queues(self):
+        '''
+        Case where a worker consumes its partition queues, or the shared queue when not partitioned
+        '''
+        with mock.patch.object(settings, 'partitions', 4):
+            assert partitions.worker_queues() == ['verify_image.1', 'verify_image.3']
+        with mock.patch.object(settings, 'partitions', 0):
+            assert partitions.worker_queues() == ['verify_image']
+
+    @mock.patch.object(settings, 'partitions', 2)
+    @mock.patch.object(settings, 'worker_count', 3)
+    @mock.patch.object(settings, 'worker_index', 2)
+    def test_worker_without_partition(self):
+        '''
+        Case where there are more workers than partitions: the worker left without one does not start
+        '''
+        with pytest.raises(ValueError):
+            partitions.worker_queues()
+
+class TestProductStates:
+
+    def test_products_are_read_once(self):
+        '''
+        Case where products already in memory are not read from the shared memory again
+        '''
+        states = partitions.ProductStates(layout.HashLayout(), size=10)
+        client = mock.Mock()
+        pipe = client.pipeline.return_value
+        pipe.execute.return_value = [{'http://a/1.png': '1'}, {}]
+
+        assert states.get_many(client, ['pid1', 'pid2']) == {'pid1': {'http://a/1.png': '1'}, 'pid2': {}}
+        assert states.get(client, 'pid1') == {'http://a/1.png': '1'}
+        pipe.hgetall.assert_has_calls([mock.call('pid1'), mock.call('pid2')])
+        pipe.execute.assert_called_once_with()
+
+    def test_verdicts_are_written_together(self):
+        '''
+        Case where the verdicts of a task are written in a single round trip and kept in memory
+        '''
+        states = partitions.ProductStates(layout.HashLayout(), size=10)
+        client = mock.Mock()
+        pipe = client.pipeline.return_value
+        pipe.execute.return_value = [{}]
+        states.get(client, 'pid1')
+        pipe.reset_mock()
+
+        states.write(client, [('pid1', 'http://a/1.png', 1), ('pid1', 'http://a/5.png', 0)])
+
+        pipe.hset.assert_has_calls([mock.call('pid1', 'http://a/1.png', 1), mock.call('pid1', 'http://a/5.png', 0)])
+        pipe.execute.assert_called_once_with()
+        assert states.get(client, 'pid1') == {'http://a/1.png': '1', 'http://a/5.png': '0'}
+
+    def test_failed_write_is_not_kept_in_memory(self):
+        '''
+        Case where the shared memory cannot be written: the product in memory is left unchanged,
+        so the retried task checks the image again
+        '''
+        states = partitions.ProductStates(layout.HashLayout(), size=10)
+        client = mock.Mock()
+        pipe = client.pipeline.return_value
+        pipe.execute.return_value = [{}]
+        states.get(client, 'pid1')
+        pipe.execute.side_effect = ConnectionError('redis is down')
+
+        with pytest.raises(ConnectionError):
+            states.write(client, [('pid1', 'http://a/1.png', 1)])
+
+        assert states.get(client, 'pid1') == {}
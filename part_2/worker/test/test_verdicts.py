@@ -0,0 +1,75 @@
+import time
+import mock
+import pytest
+import src.verdicts as verdicts
+
+class TestSQLiteVerdictStore:
+
+    def test_verdicts_are_kept_across_instances(self, tmp_path):
+        '''
+        Case where verdicts stored by a run are read by the next one
+        '''
+        path = str(tmp_path / 'verdicts.db')
+        store = verdicts.SQLiteVerdictStore(path, 3600, 60)
+        store.put_many([('http://a/1.png', 200), ('http://a/5.png', 404)])
+
+        store = verdicts.SQLiteVerdictStore(path, 3600, 60)
+        assert store.get('http://a/1.png') is True
+        assert store.get('http://a/5.png') is False
+        assert store.get('http://a/2.png') is None
+
+    def test_negative_verdicts_expire_first(self, tmp_path):
+        '''
+        Case where the negative ttl is shorter than the positive one
+        '''
+        store = verdicts.SQLiteVerdictStore(str(tmp_path / 'verdicts.db'), 3600, 60)
+        store.put_many([('http://a/1.png', 200), ('http://a/5.png', 404)], checked_at=time.time() - 120)
+
+        assert store.get_many(['http://a/1.png', 'http://a/5.png']) == {'http://a/1.png': True}
+
+    def test_commits_are_batched(self, tmp_path):
+        '''
+        Case where verdicts are committed every commit_every puts or on flush
+        '''
+        path = str(tmp_path / 'verdicts.db')
+        store = verdicts.SQLiteVerdictStore(path, 3600, 60, commit_every=10)
+        store.put('http://a/1.png', 200)
+        assert verdicts.SQLiteVerdictStore(path, 3600, 60).get('http://a/1.png') is None
+
+        store.flush()
+        assert verdicts.SQLiteVerdictStore(path, 3600, 60).get('http://a/1.png') is True
+
+class TestRedisVerdictStore:
+
+    def test_verdicts_expire_with_their_ttl(self):
+        '''
+        Case where each verdict is written with the ttl of its result
+        '''
+        client = mock.Mock()
+        store = verdicts.RedisVerdictStore(client, 3600, 60)
+        store.put_many([('http://a/1.png', 200), ('http://a/5.png', 404)], checked_at=10)
+
+        pipe = client.pipeline.return_value
+        pipe.set.assert_has_calls([
+            mock.call('verdict:http://a/1.png', '200:10', ex=3600),
+            mock.call('verdict:http://a/5.png', '404:10', ex=60),
+        ])
+        pipe.execute.assert_called_once_with()
+
+    def test_get_many(self):
+        '''
+        Case where verdicts are read with a single mget
+        '''
+        client = mock.Mock()
+        client.mget.return_value = ['200:10', None, b'404:10']
+        store = verdicts.RedisVerdictStore(client, 3600, 60)
+
+        result = store.get_many(['http://a/1.png', 'http://a/2.png', 'http://a/5.png'])
+        assert result == {'http://a/1.png': True, 'http://a/5.png': False}
+
+def test_unsupported_backend():
+    '''
+    Case where the verdict store url has an unknown scheme
+    '''
+    with pytest.raises(ValueError):
+        verdicts.from_url('memcached://cache', 3600, 60)
@@ -1,8 +1,11 @@
 import pytest
 import mock
 import src.settings as settings
+import src.metrics as metrics
+import src.layout as layout
+import src.partitions as partitions
 from celery.exceptions import Retry
-from src.app import verify_image
+from src.app import verify_image, verify_images_batch
 
 class TestVerifyImage:
 
@@ -62,8 +65,72 @@ class TestVerifyImage:
         mock_hgetall.assert_called_once_with(product_id)
         mock_logger.info.assert_called_once_with(msg)
 
+    @mock.patch('src.app.verdict_store')
+    @mock.patch('src.app.shared_memory.hset')
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory.hgetall')
+    @mock.patch('src.app.logger')
+    def test_image_in_verdict_cache(self, mock_logger, mock_hgetall, mock_requests, mock_hset, mock_store):
+        '''
+        Case where the image was checked recently (for another product or in a previous run)
+        '''
+        payload = {'productId': 'pid123', 'image': 'http://image-server/images/123.png'}
+        product_id = payload['productId']
+        image = payload['image']
+        mock_hgetall.return_value = {}
+        mock_store.get.return_value = False
+        msg = f'Image not found in server - Product ID: {product_id}, Image Name: 123.png'
+
+        verify_image(payload)
+        mock_requests.assert_not_called()
+        mock_store.get.assert_called_once_with(image)
+        mock_hset.assert_called_once_with(product_id, image, 0)
+        mock_logger.info.assert_called_once_with(msg)
+
+    @mock.patch('src.app.verdict_store')
+    @mock.patch('src.app.shared_memory.hset')
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory.hgetall')
+    @mock.patch('src.app.logger')
+    def test_verdict_is_cached(self, mock_logger, mock_hgetall, mock_requests, mock_hset, mock_store):
+        '''
+        Case where the verdict of the image server is stored in the verdict cache
+        '''
+        payload = {'productId': 'pid123', 'image': 'http://image-server/images/123.png'}
+        settings.image_server = 'http://test-server/'
+        mock_hgetall.return_value = {}
+        mock_store.get.return_value = None
+        mock_requests.return_value = 200
+
+        verify_image(payload)
+        mock_requests.assert_called_once_with('http://test-server/123.png')
+        mock_store.put.assert_called_once_with(payload['image'], 200)
+
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory.hgetall')
+    @mock.patch('src.app.logger')
+    def test_product_already_complete(self, mock_logger, mock_hgetall, mock_requests):
+        '''
+        Case where the product already has 3 valid images (image is not checked)
+        '''
+        payload = {'productId': 'pid123', 'image': 'http://image-server/images/123.png'}
+        product_id = payload['productId']
+        image_name = payload['image'].split('/')[-1]
+        settings.max_images = 3
+        mock_hgetall.return_value = {
+            'http://image-server/images/1.png': '1',
+            'http://image-server/images/2.png': '0',
+            'http://image-server/images/3.png': '1',
+            'http://image-server/images/4.png': '1',
+        }
+        msg = f'Product already has 3 valid images - Product ID: {product_id}, Image Name: {image_name}'
+
+        verify_image(payload)
+        mock_requests.assert_not_called()
+        mock_logger.info.assert_called_once_with(msg)
+
     @mock.patch('src.app.verify_image.retry')
-    @mock.patch('src.app.requests.get')
+    @mock.patch('src.app.image_client.status')
     @mock.patch('src.app.shared_memory.hgetall')
     @mock.patch('src.app.logger')
     def test_failure_in_image_server(self, mock_logger, mock_hgetall, mock_requests, mock_retry):
@@ -89,7 +156,7 @@ class TestVerifyImage:
 
     @mock.patch('src.app.verify_image.retry')
     @mock.patch('src.app.shared_memory.hset')
-    @mock.patch('src.app.requests.get')
+    @mock.patch('src.app.image_client.status')
     @mock.patch('src.app.shared_memory.hgetall')
     @mock.patch('src.app.logger')
     def test_response_200_failure_in_set_method(self, mock_logger, mock_hgetall, mock_requests, 
@@ -105,7 +172,7 @@ class TestVerifyImage:
         msg = 'Failure in hset method'
         exc = Exception(msg)
         mock_hset.side_effect = exc
-        mock_requests.return_value.status_code = 200
+        mock_requests.return_value = 200
         mock_hgetall.return_value = {}
         mock_retry.side_effect = Retry()
         
@@ -118,7 +185,7 @@ class TestVerifyImage:
         mock_retry.assert_called_once_with(countdown=300, max_retries=20)
 
     @mock.patch('src.app.shared_memory.hset')
-    @mock.patch('src.app.requests.get')
+    @mock.patch('src.app.image_client.status')
     @mock.patch('src.app.shared_memory.hgetall')
     @mock.patch('src.app.logger')
     def test_response_200_success_case(self, mock_logger, mock_hgetall, mock_requests, mock_hset):
@@ -131,7 +198,7 @@ class TestVerifyImage:
         image_name = payload['image'].split('/')[-1]
         settings.image_server = 'http://test-server/'
         mock_hset.return_value = 1
-        mock_requests.return_value.status_code = 200
+        mock_requests.return_value = 200
         mock_hgetall.return_value = {}
         
         verify_image(payload)
@@ -142,9 +209,59 @@ class TestVerifyImage:
             f'Image found in server - Product ID: {product_id}, Image Name: {image_name}'
         )
 
+    @mock.patch('src.app.verdict_store', None)
+    @mock.patch('src.app.shared_memory')
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.logger')
+    def test_partitioned_product_in_memory(self, mock_logger, mock_requests, mock_memory):
+        '''
+        Case where the owner of a partition keeps the product in memory and writes its verdict
+        before the task returns
+        '''
+        states = partitions.ProductStates(layout.HashLayout(), size=10)
+        mock_memory.pipeline.return_value.execute.return_value = [{}]
+        settings.image_server = 'http://test-server/'
+        mock_requests.return_value = 200
+
+        with mock.patch('src.app.product_states', states):
+            verify_image({'productId': 'pid123', 'image': 'http://image-server/images/1.png'})
+            verify_image({'productId': 'pid123', 'image': 'http://image-server/images/1.png'})
+
+        mock_requests.assert_called_once_with('http://test-server/1.png')
+        mock_memory.pipeline.return_value.hgetall.assert_called_once_with('pid123')
+        mock_memory.hset.assert_not_called()
+        mock_memory.pipeline.return_value.hset.assert_called_once_with(
+            'pid123', 'http://image-server/images/1.png', 1
+        )
+
+    @mock.patch('src.app.storage', layout.CompactLayout(buckets=8))
+    @mock.patch('src.app.verdict_store', None)
+    @mock.patch('src.app.shared_memory.hset')
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory.hscan_iter')
+    @mock.patch('src.app.logger')
+    def test_compact_storage(self, mock_logger, mock_hscan_iter, mock_requests, mock_hset):
+        '''
+        Case where verdicts are stored in the compact layout (bucket hash, short fields)
+        '''
+        payload = {'productId': 'pid123', 'image': 'http://image-server/images/123.png'}
+        storage = layout.CompactLayout(buckets=8)
+        bucket = storage.bucket('pid123')
+        settings.image_server = 'http://test-server/'
+        mock_requests.return_value = 200
+        mock_hscan_iter.return_value = iter([(storage.field('pid123', 'http://image-server/images/5.png'), '0')])
+
+        verify_image(payload)
+        mock_hscan_iter.assert_called_once_with(bucket, match='pid123/*', count=layout.scan_count)
+        mock_requests.assert_called_once_with('http://test-server/123.png')
+        mock_hset.assert_called_once_with(bucket, mapping={
+            storage.field('pid123', 'http://image-server/images/123.png'): 1,
+            '#' + layout.prefix_id('http://image-server/images/'): 'http://image-server/images/',
+        })
+
     @mock.patch('src.app.verify_image.retry')
     @mock.patch('src.app.shared_memory.hset')
-    @mock.patch('src.app.requests.get')
+    @mock.patch('src.app.image_client.status')
     @mock.patch('src.app.shared_memory.hgetall')
     @mock.patch('src.app.logger')
     def test_response_404_failure_in_set_method(self, mock_logger, mock_hgetall, mock_requests, 
@@ -160,7 +277,7 @@ class TestVerifyImage:
         msg = 'Failure in hset method'
         exc = Exception(msg)
         mock_hset.side_effect = exc
-        mock_requests.return_value.status_code = 404
+        mock_requests.return_value = 404
         mock_hgetall.return_value = {}
         mock_retry.side_effect = Retry()
         
@@ -173,7 +290,7 @@ class TestVerifyImage:
         mock_retry.assert_called_once_with(countdown=300, max_retries=20)
 
     @mock.patch('src.app.shared_memory.hset')
-    @mock.patch('src.app.requests.get')
+    @mock.patch('src.app.image_client.status')
     @mock.patch('src.app.shared_memory.hgetall')
     @mock.patch('src.app.logger')
     def test_response_404_success_case(self, mock_logger, mock_hgetall, mock_requests, mock_hset):
@@ -186,7 +303,7 @@ class TestVerifyImage:
         image_name = payload['image'].split('/')[-1]
         settings.image_server = 'http://test-server/'
         mock_hset.return_value = 1
-        mock_requests.return_value.status_code = 404
+        mock_requests.return_value = 404
         mock_hgetall.return_value = {}
         
         verify_image(payload)
@@ -198,7 +315,7 @@ class TestVerifyImage:
         )
 
     @mock.patch('src.app.verify_image.retry')
-    @mock.patch('src.app.requests.get')
+    @mock.patch('src.app.image_client.status')
     @mock.patch('src.app.shared_memory.hgetall')
     @mock.patch('src.app.logger')
     def test_response_500(self, mock_logger, mock_hgetall, mock_requests, mock_retry):
@@ -210,10 +327,10 @@ class TestVerifyImage:
         image = payload['image']
         image_name = payload['image'].split('/')[-1]
         settings.image_server = 'http://test-server/'
-        mock_requests.return_value.status_code = 500
+        mock_requests.return_value = 500
         mock_hgetall.return_value = {}
         mock_retry.side_effect = Retry()
-        msg = f'Unexpected response: {mock_requests.return_value.status_code} - Product ID: {product_id}, Image Name: {image_name}'
+        msg = f'Unexpected response: {mock_requests.return_value} - Product ID: {product_id}, Image Name: {image_name}'
         
         with pytest.raises(Retry):
             verify_image(payload)
@@ -222,4 +339,174 @@ class TestVerifyImage:
         mock_logger.error.assert_called_once_with(f'Error message: {msg}')
         mock_retry.assert_called_once_with(countdown=300, max_retries=20)
 
-    
\ No newline at end of file
+    
+
+class TestMetrics:
+
+    def setup_method(self):
+        metrics.enable()
+
+    def teardown_method(self):
+        metrics.disable()
+
+    @mock.patch('src.app.shared_memory.hset')
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory.hgetall')
+    @mock.patch('src.app.logger')
+    def test_verified_image_is_observed(self, mock_logger, mock_hgetall, mock_requests, mock_hset):
+        '''
+        Case where the redis and http stages of a verified image are observed
+        '''
+        payload = {'productId': 'pid123', 'image': 'http://image-server/images/123.png'}
+        settings.image_server = 'http://test-server/'
+        mock_hgetall.return_value = {}
+        mock_requests.return_value = 404
+
+        verify_image(payload)
+
+        for stage in ('redis_read', 'http', 'redis_write'):
+            labels = {'task': 'verify_image', 'stage': stage}
+            assert metrics.registry.get_sample_value('images_worker_stage_seconds_count', labels) == 1
+        assert metrics.registry.get_sample_value('images_worker_images_total', {'result': 'invalid'}) == 1
+        assert metrics.registry.get_sample_value('images_worker_already_sent_total', {'result': 'miss'}) == 1
+
+    @mock.patch('src.app.verify_image.retry')
+    @mock.patch('src.app.shared_memory.hgetall')
+    @mock.patch('src.app.logger')
+    def test_retry_is_counted(self, mock_logger, mock_hgetall, mock_retry):
+        '''
+        Case where a failure in the shared memory is counted as a retry
+        '''
+        payload = {'productId': 'pid123', 'image': 'http://image-server/images/123.png'}
+        mock_hgetall.side_effect = Exception('Failure in hgetall method')
+        mock_retry.side_effect = Retry()
+
+        with pytest.raises(Retry):
+            verify_image(payload)
+
+        assert metrics.registry.get_sample_value('images_worker_retries_total', {'task': 'verify_image'}) == 1
+
+
+class TestVerifyImagesBatch:
+
+    @staticmethod
+    def image_server(url):
+        # Images whose number is a multiple of 5 are missing, like in the mock server
+        number = int(url.split('/')[-1].split('.')[0])
+        return 404 if number % 5 == 0 else (500 if number == 7 else 200)
+
+    @mock.patch('src.app.verdict_store', None)
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory')
+    @mock.patch('src.app.logger')
+    def test_success_case(self, mock_logger, mock_memory, mock_requests):
+        '''
+        Case where stored images are skipped, products stop at 3 valid images
+        and all results are written in a single pipeline
+        '''
+        settings.image_server = 'http://test-server/'
+        settings.max_images = 3
+        settings.batch_concurrency = 4
+        read_pipe, write_pipe = mock.Mock(), mock.Mock()
+        mock_memory.pipeline.side_effect = [read_pipe, write_pipe]
+        read_pipe.execute.return_value = [
+            ['1', None, None, None, None, None], ['1'],
+            [None], ['1', '1', '1'],
+        ]
+        mock_requests.side_effect = self.image_server
+        payloads = [{'productId': 'pid1', 'image': f'http://image-server/images/{number}.png'}
+                    for number in (1, 5, 2, 3, 4, 6)]
+        payloads += [{'productId': 'pid2', 'image': 'http://image-server/images/8.png'}, {'image': 'x'}]
+
+        verify_images_batch(payloads)
+
+        read_pipe.hmget.assert_has_calls([
+            mock.call('pid1', [f'http://image-server/images/{number}.png' for number in (1, 5, 2, 3, 4, 6)]),
+            mock.call('pid2', ['http://image-server/images/8.png']),
+        ])
+        # pid1 had 1 valid image: 5 is missing and replaced by 3, 4 and 6 are never requested
+        requested = sorted(call[0][0] for call in mock_requests.call_args_list)
+        assert requested == ['http://test-server/2.png', 'http://test-server/3.png', 'http://test-server/5.png']
+        write_pipe.hset.assert_has_calls([
+            mock.call('pid1', 'http://image-server/images/2.png', 1),
+            mock.call('pid1', 'http://image-server/images/3.png', 1),
+            mock.call('pid1', 'http://image-server/images/5.png', 0),
+        ], any_order=True)
+        assert write_pipe.hset.call_count == 3
+        write_pipe.execute.assert_called_once_with()
+        mock_logger.error.assert_called_once_with('Product id or image name ill formatted')
+
+    @mock.patch('src.app.verdict_store', None)
+    @mock.patch('src.app.verify_images_batch.retry')
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory')
+    @mock.patch('src.app.logger')
+    def test_failed_images_are_retried(self, mock_logger, mock_memory, mock_requests, mock_retry):
+        '''
+        Case where only the images that could not be checked are retried
+        '''
+        settings.image_server = 'http://test-server/'
+        settings.max_images = 3
+        read_pipe, write_pipe = mock.Mock(), mock.Mock()
+        mock_memory.pipeline.side_effect = [read_pipe, write_pipe]
+        read_pipe.execute.return_value = [[None, None], []]
+        mock_requests.side_effect = self.image_server
+        mock_retry.side_effect = Retry()
+        payloads = [{'productId': 'pid1', 'image': 'http://image-server/images/7.png'},
+                    {'productId': 'pid1', 'image': 'http://image-server/images/1.png'}]
+
+        with pytest.raises(Retry):
+            verify_images_batch(payloads)
+
+        write_pipe.hset.assert_called_once_with('pid1', 'http://image-server/images/1.png', 1)
+        mock_retry.assert_called_once_with(args=[[payloads[0]]], countdown=300, max_retries=20)
+
+    @mock.patch('src.app.verdict_store', None)
+    @mock.patch('src.app.image_client.status')
+    @mock.patch('src.app.shared_memory')
+    @mock.patch('src.app.logger')
+    def test_partitioned_batch_is_written_before_returning(self, mock_logger, mock_memory, mock_requests):
+        '''
+        Case where the owner of a partition reads the products once and writes the verdicts
+        of the batch in a single pipeline before the task returns
+        '''
+        settings.image_server = 'http://test-server/'
+        settings.max_images = 3
+        states = partitions.ProductStates(layout.HashLayout(), size=10)
+        read_pipe, write_pipe = mock.Mock(), mock.Mock()
+        mock_memory.pipeline.side_effect = [read_pipe, write_pipe]
+        read_pipe.execute.return_value = [{'http://image-server/images/1.png': '1'}]
+        mock_requests.side_effect = self.image_server
+        payloads = [{'productId': 'pid1', 'image': f'http://image-server/images/{number}.png'}
+                    for number in (1, 2, 5)]
+
+        with mock.patch('src.app.product_states', states):
+            verify_images_batch(payloads)
+
+        read_pipe.hgetall.assert_called_once_with('pid1')
+        write_pipe.hset.assert_has_calls([
+            mock.call('pid1', 'http://image-server/images/2.png', 1),
+            mock.call('pid1', 'http://image-server/images/5.png', 0),
+        ], any_order=True)
+        write_pipe.execute.assert_called_once_with()
+        assert states.get(mock_memory, 'pid1') == {
+            'http://image-server/images/1.png': '1',
+            'http://image-server/images/2.png': '1',
+            'http://image-server/images/5.png': '0',
+        }
+
+    @mock.patch('src.app.verify_images_batch.retry')
+    @mock.patch('src.app.shared_memory')
+    @mock.patch('src.app.logger')
+    def test_failure_in_shared_memory(self, mock_logger, mock_memory, mock_retry):
+        '''
+        Case where the shared memory cannot be read (whole batch is retried)
+        '''
+        mock_memory.pipeline.return_value.execute.side_effect = Exception('Failure in pipeline')
+        mock_retry.side_effect = Retry()
+
+        with pytest.raises(Retry):
+            verify_images_batch([{'productId': 'pid1', 'image': 'http://image-server/images/1.png'}])
+
+        mock_logger.error.assert_called_once_with('Error message: Failure in pipeline')
+        mock_retry.assert_called_once_with(countdown=300, max_retries=20)